@@ -5,176 +5,374 @@
 # This Program is free software; you can redistribute it and/or
 # modify it under the terms of the GNU General Public
 # License as published by the Free Software Foundation; either
-# version 3 of the License, or (at your option) any later version.  
-
-import sys, time
-from pypilot.client import PypilotClient
-
-# list must be already sorted
-def unique(l):
-    if len(l) < 2:
-        return l
-    if l[0] == l[1]:
-        return unique(l[1:])
-    return [l[0]] + unique(l[1:])
-
-def frange(min, max, step):
-    def each(val):
-        if val > max:
-            return []
-        return [val] + each(val+step)
-    return each(min)
-
-class autogain(object):
-    def __init__(self):
-        self.search = [ \
-                       #{'name': 'ap.I', 'min': 0, 'max': .006, 'step': .003},
-                       #{'name': 'ap.P2', 'min': 0, 'max': .006, 'step': .006},
-                       #{'name': 'ap.P', 'min': .0015, 'max': .0025, 'step': .00025},
-                        {'name': 'ap.D', 'min': .07, 'max': .12, 'step': .001}
-                        #{'name': 'ap.DD', 'min': 0, 'max': .1, 'step': .01}
-        ]
-        self.variables = ['ap.heading_error', 'servo.watts']
-        self.settle_period = 20
-        self.period = 120
-
-        self.watchlist = ['ap.enabled']
-        for var in self.search:
-            self.watchlist.append(var['name'])
-        for var in self.variables:
-            self.watchlist.append(var)
-
-        def on_con(client):
-            for name in self.watchlist:
-                client.watch(name)
-
-        print('connecting to server...')
-        host = False
-        if len(sys.argv) > 1:
-            host = sys.argv[1]
-
-        while True:
-            try:
-                self.client = PypilotClient(on_con, host, autoreconnect=True)
-                break
-            except:
-                time.sleep(2)
-
-        print('connected')
-
-    def read_messages(self, log):
-        msgs = self.client.receive()
-        for name in msgs:
-            data = msgs[name]
-            value = data['value']
-
-            for var in self.search:
-                if name == var:
-                    name = name[3:]
-                    if abs(value - self.gains[name].value) > 1e-8:
-                        print('external program adjusting search variable!!, abort', name, value)
-                        exit(0)
-
-            if log:
-                for var in self.variables:
-                    if name == var:
-                        self.total[name]['total'] += abs(value)
-                        self.total[name]['count'] += 1
-            if name == 'ap.enabled' and not value:
-                #print('autopilot disabled!!')
-                #exit(0)
-                pass
-
-    def set(self, name, val):
-        print('setting', name, 'to', val)
-        self.searchval[name] = val
-        self.client.set(name, val)
-
-    def log(self):
-        print('logging for', self.searchval)
-        t0 = time.monotonic()
-        self.total = {}
-        for var in self.variables:
-            self.total[var] = {'total': 0, 'count': 0}
-        while time.monotonic() - t0 < self.period:
-            self.read_messages(time.monotonic() - t0 > self.settle_period)
-            time.sleep(.05)
-
-        for var in self.variables:
-            if not var in self.results:
-                self.results[var] = []
-            count = self.total[var]['count']
-            if count:
-                self.results[var].append((self.searchval.copy(), self.total[var]['total'] / count))
-            else:
-                print('warning, no results for', var)
-        
-    def run_search(self, search):
-        if search:
-            s = search[0]
-            for val in frange(s['min'], s['max'], s['step']):
-                self.set(s['name'], val)
-                self.run_search(search[1:])
+# version 3 of the License, or (at your option) any later version.
+
+# find gains for the basic pilot from a recording (see recorder.py)
+#
+# a boat response model is fitted to the engaged, non wind mode parts
+# of the recording: the rudder is the integral of the servo command
+# and yaw acceleration is linear in heading rate and rudder.  What the
+# model does not explain is kept as the disturbance from the sea, so
+# every candidate set of gains steers the model through the same waves
+# and the same course changes.
+#
+# the waves move the boat and the pilot steers against them, so the
+# rudder is correlated with the disturbance and a plain least squares
+# fit is biased.  The fit is refined with the rate and rudder of the
+# model steered by the recorded gains through the recorded heading
+# command alone as instruments, which are independent of the waves.
+# This requires the heading command to change during the recording.
+#
+# Nelder-Mead searches from several starting points in parallel, one
+# process per core, and the best gains found are ranked by the mean
+# squared heading error plus a weighted servo effort, which stands in
+# for servo.watts.
+
+import os, sys, time, math, multiprocessing
+import numpy
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from resolv import resolv
+from recorder import RecordingReader
+
+sample_rate = 10 # hz of the resampled recording and simulation
+rudder_limit = 3 # seconds at full command from center to the stop
+instrument_iterations = 5
+min_instrument = .05 # squared correlation of the instruments with rate and rudder
+check_tolerance = .25 # relative difference of simulated and recorded error rms
+
+# basic pilot gains which may be searched and their upper limits
+gain_limits = {'P': .03, 'I': .05, 'D': .24, 'DD': .24, 'PR': .02}
+
+# heading, heading command, heading error and servo command at the
+# sample rate, when engaged, and the basic pilot gains last recorded
+def load_recording(path, rate=sample_rate):
+    values = {'ap.enabled': False, 'ap.mode': 'compass', 'ap.pilot': 'basic', 'ap.heading': False,
+              'ap.heading_command': 0, 'ap.heading_error': 0, 'servo.command': 0}
+    heading, heading_command, error, command, engaged = [], [], [], [], []
+    gains = {}
+    t = False
+    for wall, name, value in RecordingReader(path):
+        if not t:
+            t = wall
+        while wall >= t + 1/rate:
+            t += 1/rate
+            heading.append(values['ap.heading'])
+            heading_command.append(values['ap.heading_command'])
+            error.append(values['ap.heading_error'])
+            command.append(values['servo.command'])
+            engaged.append(values['ap.enabled'] and not 'wind' in values['ap.mode'] and
+                           values['ap.heading'] is not False)
+        if name in values:
+            values[name] = value
+        elif name and name.startswith('ap.pilot.basic.') and name[15:] in gain_limits:
+            gains[name[15:]] = value
+
+    # unwrap heading so the rate is continuous, and the heading
+    # command with it
+    h = numpy.zeros(len(heading))
+    reference = numpy.zeros(len(heading))
+    for i in range(1, len(heading)):
+        if engaged[i] and engaged[i-1]:
+            h[i] = h[i-1] + resolv(heading[i] - heading[i-1])
+        if engaged[i]:
+            reference[i] = h[i] - resolv(heading[i] - heading_command[i])
+    engaged = numpy.array(engaged, dtype=bool)
+    if values['ap.pilot'] != 'basic':
+        gains = {} # recorded with another pilot
+    return {'heading': h, 'reference': reference, 'error': numpy.array(error, dtype=float),
+            'command': numpy.array(command, dtype=float), 'engaged': engaged, 'gains': gains}
+
+def correlation2(x, y):
+    x, y = x - numpy.mean(x), y - numpy.mean(y)
+    d = numpy.dot(x, x)*numpy.dot(y, y)
+    return numpy.dot(x, y)**2/d if d else 0
+
+# fit of yaw acceleration = a*rate + b*rudder + c, returns the model,
+# the disturbance, the recorded course changes and the fraction explained
+def fit_model(recording, rate=sample_rate):
+    heading, command, engaged = recording['heading'], recording['command'], recording['engaged']
+    gains = recording['gains']
+    if not gains:
+        raise Exception('no basic pilot gains in the recording to fit with')
+
+    # forward differences and rudder as simulate() steps them, so the
+    # recorded commands with the disturbance reproduce the recording
+    dt = 1/rate
+    hr = numpy.append(numpy.diff(heading)/dt, 0)
+    hrr = numpy.append(numpy.diff(hr)/dt, 0)
+    rudder = numpy.zeros(len(command))
+    r = 0
+    for i in range(len(command)):
+        r = min(max(r + command[i]*dt, -rudder_limit), rudder_limit) if engaged[i] else 0
+        rudder[i] = r
+
+    # only samples with engaged neighbors have valid differences
+    valid = engaged.copy()
+    valid[1:] &= engaged[:-1]
+    valid[:-2] &= engaged[1:-1] & engaged[2:]
+    valid[:1] = valid[-2:] = False
+    if numpy.sum(valid) < 10*rate:
+        raise Exception('not enough engaged data to fit')
+    course = numpy.append(numpy.diff(recording['reference']), 0)[valid]
+
+    A = numpy.column_stack([hr[valid], rudder[valid], numpy.ones(numpy.sum(valid))])
+    y = hrr[valid]
+    model = numpy.linalg.lstsq(A, y, rcond=None)[0]
+    quiet = numpy.zeros(len(y))
+    for i in range(instrument_iterations):
+        trace = simulate(gains, tuple(model), quiet, course, 0, rate, trace=True)[3]
+        Z = numpy.column_stack(trace + [numpy.ones(len(y))])
+        if i == 0 and min(correlation2(trace[j], A[:, j]) for j in range(2)) < min_instrument:
+            raise Exception('heading command did not change enough to fit the boat model')
+        model = numpy.linalg.solve(Z.T.dot(A), Z.T.dot(y))
+
+    disturbance = y - A.dot(model)
+    explained = 1 - numpy.var(disturbance)/numpy.var(y)
+    recording['valid'] = valid
+    return tuple(model), disturbance, course, explained
+
+# heading error recorded and simulated with the recorded gains, these
+# differ when the simulated pilot does not steer like the recorded one
+def check_model(recording, model, disturbance, course):
+    gains = recording['gains']
+    recorded = math.sqrt(numpy.mean(recording['error'][recording['valid']]**2))
+    return gains, recorded, simulate(gains, model, disturbance, course, 0)[1]
+
+def print_model(recording, model, disturbance, course, explained):
+    print('boat model %.3f %.3f %.3f explains %.0f%% of yaw acceleration' % (model + (100*explained,)))
+    gains, recorded, simulated = check_model(recording, model, disturbance, course)
+    print('recorded gains', gains, 'heading error rms %.3f, simulated %.3f' % (recorded, simulated))
+
+# steer the model through the disturbance and course changes with the
+# basic pilot, the pilot sees the rate and its rate from the last step
+def simulate(gains, model, disturbance, course, effort_weight, rate=sample_rate, trace=False):
+    a, b, c = model
+    dt = 1/rate
+    P, I, D, DD, PR = [gains.get(name, 0) for name in ['P', 'I', 'D', 'DD', 'PR']]
+    error = hr = hrr = hrr_last = rudder = error_int = 0
+    error2 = effort = 0
+    if trace:
+        hrs, rudders = numpy.zeros(len(disturbance)), numpy.zeros(len(disturbance))
+    for i in range(len(disturbance)):
+        command = P*error + I*error_int + D*hr + DD*hrr_last + PR*math.copysign(math.sqrt(abs(error)), error)
+        command = min(max(command, -1), 1)
+        hrr_last = hrr
+        hr += hrr*dt
+        rudder = min(max(rudder + command*dt, -rudder_limit), rudder_limit)
+        hrr = a*hr + b*rudder + c + disturbance[i]
+        if trace:
+            hrs[i], rudders[i] = hr, rudder
+        error = min(max(error + hr*dt - course[i], -60), 60)
+        error_int = min(max(error_int + error/1500*dt, -5), 5)
+        error2 += error**2
+        effort += abs(command)
+    n = len(disturbance)
+    result = error2/n + effort_weight*effort/n, math.sqrt(error2/n), effort/n
+    if trace:
+        return result + ([hrs, rudders],)
+    return result
+
+def nelder_mead(f, x0, step=.1, iterations=200, tolerance=1e-6):
+    n = len(x0)
+    simplex = [numpy.array(x0, dtype=float)]
+    for i in range(n):
+        x = simplex[0].copy()
+        x[i] += step
+        simplex.append(x)
+    values = [f(x) for x in simplex]
+    for iteration in range(iterations):
+        order = numpy.argsort(values)
+        simplex = [simplex[i] for i in order]
+        values = [values[i] for i in order]
+        if values[-1] - values[0] < tolerance:
+            break
+        centroid = numpy.mean(simplex[:-1], axis=0)
+        reflected = centroid + (centroid - simplex[-1])
+        r = f(reflected)
+        if r < values[0]:
+            expanded = centroid + 2*(centroid - simplex[-1])
+            e = f(expanded)
+            simplex[-1], values[-1] = (expanded, e) if e < r else (reflected, r)
+        elif r < values[-2]:
+            simplex[-1], values[-1] = reflected, r
         else:
-            self.log()
-
-    def result_range(self, results, name):
-        r = []
-        for result in results:
-            vars, val = result
-            r.append(vars[name])
-        return unique(sorted(r))
-
-    def result_value(self, results, vals):
-        values = []
-        for result in results:
-            vars, val = result
-            if vars == vals:
-                values.append(val)
-        if len(values) == 1:
-            return '%.4f' % values[0]
-        return values
-        
-    def print_results(self, results, search, vals):
-        l = len(search)
-        s = search[0]
-        if l < 2:
-            print(s['name'])
-            for val in self.result_range(results, s['name']):
-                vals[s['name']] = val
-                print(val, self.result_value(results, vals))
-        elif l > 2:
-            for val in self.result_range(results, s['name']):
-                print(s['name'], '=', val)
-                vals[s['name']] = val
-                self.print_results(results, search[1:], vals)
-                
-        elif l == 2:
-            t = search[1]
-            print(s['name'], '/', t['name'])
-            line = '\t'
-            s_range = self.result_range(results, s['name'])
-            for val0 in s_range:
-                line += '%.4f\t' % val0
-            print(line)
-            for val1 in self.result_range(results, t['name']):
-                line = '%.4f\t' % val1
-                vals[t['name']] = val1
-                for val0 in s_range:
-                    vals[s['name']] = val0
-                    line += str(self.result_value(results, vals)) + '\t'
-                print(line)
-            print('')
-
-    def run(self):
-        self.searchval = {}
-        self.results = {}
-        self.run_search(self.search)
-        for var in self.variables:
-            print('Results for', var)
-            self.print_results(self.results[var], self.search, {})
-            print('')
+            contracted = centroid + .5*(simplex[-1] - centroid)
+            c = f(contracted)
+            if c < values[-1]:
+                simplex[-1], values[-1] = contracted, c
+            else: # shrink toward the best
+                for i in range(1, n+1):
+                    simplex[i] = simplex[0] + .5*(simplex[i] - simplex[0])
+                    values[i] = f(simplex[i])
+    return simplex[0], values[0]
+
+# set in each search process
+search = {}
+def search_init(names, model, disturbance, course, effort_weight):
+    search.update({'names': names, 'model': model, 'disturbance': disturbance,
+                   'course': course, 'effort_weight': effort_weight})
+
+# gains are searched scaled by their limits to 0 to 1
+def search_gains(x):
+    return {name: round(min(max(v, 0), 1)*gain_limits[name], 5) for name, v in zip(search['names'], x)}
+
+def search_from(x0):
+    evaluated = {}
+    def f(x):
+        gains = search_gains(x)
+        key = tuple(gains.values())
+        if not key in evaluated:
+            evaluated[key] = simulate(gains, search['model'], search['disturbance'], search['course'],
+                                      search['effort_weight'])
+        return evaluated[key][0]
+    nelder_mead(f, x0)
+    return [(dict(zip(search['names'], key)), result) for key, result in evaluated.items()]
+
+# ranked list of (gains, (cost, error rms, effort))
+def optimize(names, model, disturbance, course, effort_weight=10, starts=False):
+    processes = multiprocessing.cpu_count()
+    starts = starts or max(processes, 4)
+    rand = numpy.random.RandomState(0)
+    x0s = [numpy.full(len(names), .3)] + [rand.uniform(.05, .8, len(names)) for i in range(starts-1)]
+    args = names, model, disturbance, course, effort_weight
+    with multiprocessing.Pool(min(processes, starts), search_init, args) as pool:
+        results = pool.map(search_from, x0s)
+
+    # keep the best of nearly equal gains
+    ranked = {}
+    for result in results:
+        for gains, value in result:
+            key = tuple(round(gains[name]/gain_limits[name], 2) for name in names)
+            if not key in ranked or value[0] < ranked[key][1][0]:
+                ranked[key] = gains, value
+    return sorted(ranked.values(), key=lambda r: r[1][0])
+
+def print_table(ranked, names, count=10):
+    print('rank ' + ''.join('%9s' % name for name in names) + '      cost  err rms  effort')
+    for i, (gains, (cost, error, effort)) in enumerate(ranked[:count]):
+        print('%4d ' % (i+1) + ''.join('%9.5f' % gains[name] for name in names) +
+              '  %8.3f  %7.3f  %6.3f' % (cost, error, effort))
+
+# set the gains on the server, in the given profile if any
+def push(gains, host, profile=False):
+    from client import pypilotClient
+    client = pypilotClient(host)
+    if not client.list_values(10):
+        print('failed to connect to', host)
+        return False
+    if profile:
+        client.set('profile', profile)
+    for name, value in gains.items():
+        client.set('ap.pilot.basic.' + name, value)
+    client.poll(1)
+    print('set', gains, 'profile', profile or 'current')
+    return True
+
+# simulated recording of a boat steered by a known pilot through
+# waves with a course change each minute, to check the fit and the search
+def benchmark(duration=1800, course_period=60):
+    import shutil, random, pyjson
+    from bufferedsocket import encode_value_frame
+    from recorder import Recorder
+
+    class value(object): # stands in for a server value
+        def __init__(self, id, name):
+            self.id, self.name = id, name
+        def get_frame(self):
+            return encode_value_frame(self.id, pyjson.dumps(self.value))
+
+    values = {}
+    def write(name, v, t):
+        if not name in values:
+            values[name] = value(len(values)+1, name)
+        values[name].value = v
+        recorder.write(values[name], t)
+
+    path = '/tmp/pypilot_autogain_benchmark'
+    shutil.rmtree(path, ignore_errors=True)
+    recorder = Recorder(path)
+    model = -.8, -6, 0 # yaw damping and rudder authority
+    dt, t = 1/20, time.monotonic()
+    write('ap.enabled', True, t)
+    write('ap.mode', 'compass', t)
+    write('ap.pilot.basic.P', .01, t)
+    write('ap.pilot.basic.D', .1, t)
+    heading, hr, rudder, command = 90, 0, 0, 0
+    random.seed(1)
+    for i in range(int(duration/dt)):
+        t += dt
+        s = i*dt
+        if i % int(course_period/dt) == 0:
+            heading_command = round(90 + random.uniform(-20, 20), 1)
+            write('ap.heading_command', heading_command, t)
+        wave = 3*math.sin(2*math.pi*s/7) + 1.5*math.sin(2*math.pi*s/3.3) + random.gauss(0, 1)
+        error = min(max(resolv(heading - heading_command), -60), 60)
+        command = min(max(.01*error + .1*hr, -1), 1)
+        rudder = min(max(rudder + command*dt, -rudder_limit), rudder_limit)
+        hr += (model[0]*hr + model[1]*rudder + wave)*dt
+        heading = resolv(heading + hr*dt, 180)
+        write('ap.heading', round(heading, 4), t)
+        write('ap.heading_error', round(error, 4), t)
+        write('servo.command', round(command, 4), t)
+    recorder.close()
+
+    t0 = time.monotonic()
+    recording = load_recording(path)
+    fitted, disturbance, course, explained = fit_model(recording)
+    t1 = time.monotonic()
+    print('actual model %.3f %.3f %.3f, loaded and fitted in %.2fs' % (model + (t1-t0,)))
+    print_model(recording, fitted, disturbance, course, explained)
+    names = ['P', 'D']
+    ranked = optimize(names, fitted, disturbance, course)
+    t2 = time.monotonic()
+    print_table(ranked, names)
+    print('searched in %.1fs on %d cores' % (t2-t1, multiprocessing.cpu_count()))
+    shutil.rmtree(path)
+
+def main():
+    import getopt
+    try:
+        args, paths = getopt.getopt(sys.argv[1:], 'g:w:n:p:r:fbh')
+    except Exception as e:
+        print('failed to parse command line arguments:', e)
+        return
+    args = dict(args)
+    if '-b' in args:
+        benchmark()
+        return
+    if '-h' in args or len(paths) != 1:
+        print(sys.argv[0] + ' [ARGS] RECORDING\n')
+        print('-g gains     -- comma separated basic pilot gains to search, default P,D')
+        print('-w weight    -- weight of servo effort against squared heading error, default 10')
+        print('-n starts    -- number of starting points, default the number of cores')
+        print('-p host      -- set the best gains on the pypilot server at host')
+        print('-r profile   -- profile to set the gains in')
+        print('-f           -- set the gains even if the simulation does not match the recording')
+        print('-b           -- benchmark with a simulated recording')
+        print('-h           -- Display this message')
+        return
+
+    names = args.get('-g', 'P,D').split(',')
+    for name in names:
+        if not name in gain_limits:
+            print('unknown gain', name, 'available gains', list(gain_limits))
+            return
+    recording = load_recording(paths[0])
+    try:
+        model, disturbance, course, explained = fit_model(recording)
+    except Exception as e:
+        print('failed to fit boat model:', e)
+        return
+    print_model(recording, model, disturbance, course, explained)
+    ranked = optimize(names, model, disturbance, course, float(args.get('-w', 10)), int(args.get('-n', 0)))
+    print_table(ranked, names)
+    if '-p' in args:
+        gains, recorded, simulated = check_model(recording, model, disturbance, course)
+        if abs(simulated - recorded) > check_tolerance*recorded and not '-f' in args:
+            print('not setting gains, simulated heading error rms %.3f differs from recorded %.3f' % (simulated, recorded))
+            return
+        push(ranked[0][0], args['-p'], args.get('-r', False))
 
 if __name__ == '__main__':
-    ag = autogain()
-    ag.run()
+    main()
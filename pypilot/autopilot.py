@@ -26,6 +26,9 @@ from values import *
 from boatimu import *
 from resolv import *
 import tacking, servo
+from scheduler import Scheduler
+from shadow import Shadow
+from seastate import SeaState
 from version import strversion
 from sensors import Sensors
 import pilots
@@ -86,14 +89,17 @@ class TimedQueue(object):
     return 0
         
 class Autopilot(object):
-    def __init__(self):
+    # replay (see replay.py) supplies the server, imu, sensor data
+    # and servo driver from a recording instead of the boat
+    def __init__(self, replay=False):
         super(Autopilot, self).__init__()
         self.watchdog_device = False
+        self.replay = replay
 
-        self.server = pypilotServer()
-        self.client = pypilotClient(self.server, use_udp=True)
-        self.boatimu = BoatIMU(self.client)
-        self.sensors = Sensors(self.client, self.boatimu)
+        self.server = replay.server if replay else pypilotServer()
+        self.client = pypilotClient(self.server, use_udp=not replay)
+        self.boatimu = BoatIMU(self.client, replay)
+        self.sensors = Sensors(self.client, self.boatimu, replay)
         self.servo = servo.Servo(self.client, self.sensors)
         self.version = self.register(Value, 'version', 'pypilot' + ' ' + strversion)
         self.timestamp = self.client.register(TimeStamp())
@@ -148,7 +154,17 @@ class Autopilot(object):
 
         self.runtime = self.register(TimeValue, 'runtime') #, persistent=True)
         self.timings = self.register(SensorValue, 'timings', False)
+        # time from imu sample to servo command
+        self.latency = self.register(HistogramValue, 'latency', [.005, .01, .02, .03, .05, .075, .1, .15, .2, .3, .5])
+        # time spent in each stage of the iteration
+        buckets = hdr_buckets(.0001, 1)
+        self.stage_timings = {}
+        for stage in ['server', 'sensors', 'imu', 'pilot', 'servo', 'shadow', 'iteration']:
+            self.stage_timings[stage] = self.register(HistogramValue, 'timing.' + stage, buckets)
         self.last_heading_mode = False
+        self.scheduler = Scheduler(self)
+        self.seastate = SeaState(self.client)
+        self.shadow = Shadow(self)
 
         '''
         device = '/dev/watchdog0'
@@ -160,10 +176,12 @@ class Autopilot(object):
         '''
 
         self.server.poll() # setup process before we switch main process to realtime
-        if os.system('sudo chrt -pf 1 %d 2>&1 > /dev/null' % os.getpid()):
-            print(_('warning: failed to make autopilot process realtime'))
-    
         self.lasttime = time.monotonic()
+        if replay:
+            return # not realtime and no child processes
+
+        if not self.scheduler.realtime():
+            print(_('warning: failed to make autopilot process realtime'))
 
         # setup all processes to exit on any signal
         self.childprocesses = [self.boatimu.imu, self.boatimu.auto_cal,
@@ -341,7 +359,7 @@ class Autopilot(object):
 
         # do waiting in client if not enabled to reduce lag
         period = 1/self.boatimu.rate.value
-        rdt = 0 if self.enabled.value else period# dt*.8
+        rdt = 0 if self.enabled.value or self.replay else period# dt*.8
 
         msgs = self.client.receive(rdt)
         for msg in msgs: # we aren't usually subscribed to anything
@@ -362,20 +380,10 @@ class Autopilot(object):
         t2 = time.monotonic()
         if t2-t1 > period/2:
             print(_('sensors is running too _slowly_'), t2-t1)
+        ts = t2
 
-        sp = 0
-        for tries in range(14): # try 14 times to read from imu
-            timu = time.monotonic()
-            t2 = time.monotonic()
-            data = self.boatimu.read()
-            if data:
-                break
-            pd10 = period/10
-            sp += pd10
-            time.sleep(pd10)
-
-            #if not data:
-            #print('autopilot failed to read imu at time:', time.monotonic(), period)
+        data = self.scheduler.read(self.boatimu, period)
+        t2 = self.scheduler.wake_time
 
         t3 = time.monotonic()
         if t3-t2 > period*2/3 and data and t2-self.starttime > 15:
@@ -383,6 +391,8 @@ class Autopilot(object):
 
         self.fix_compass_calibration_change(data, t0)
         self.compute_offsets()
+        if data:
+            self.seastate.update(data, self.boatimu.rate.value)
 
         pilot = self.pilots[self.pilot.value] # select pilot
 
@@ -471,6 +481,13 @@ class Autopilot(object):
 
         if self.enabled.value:
             self.servo.poll()
+            if data:
+                self.latency.add(time.monotonic() - data['timestamp'])
+
+        # other pilots evaluate the same inputs until the next sample is due
+        tshadow = time.monotonic()
+        self.shadow.process(self.scheduler.deadline or t0 + period)
+        tshadow = time.monotonic() - tshadow
 
         if self.starttime > 30:
             # make gps position/velocity prediction from inertial sensors            
@@ -491,6 +508,14 @@ class Autopilot(object):
             print(_('servo is running too _slowly_'), t5-t4)
 
         self.timings.set([t1-t0, t2-t1, t3-t2, t4-t3, t5-t4, t5-t0])
+        timings = self.stage_timings
+        timings['server'].add(t1-t0, t5)
+        timings['sensors'].add(ts-t1, t5)
+        timings['imu'].add(t3-t2, t5)
+        timings['pilot'].add(t4-t3, t5)
+        timings['servo'].add(t5-t4-tshadow, t5)
+        timings['shadow'].add(tshadow, t5)
+        timings['iteration'].add(t5-t0, t5)
         self.timestamp.set(t0-self.starttime)
           
         #if self.watchdog_device:
@@ -500,12 +525,8 @@ class Autopilot(object):
         if t6-t0 > period and t0-self.starttime > 5 and self.enabled.value:
             print(_('autopilot iteration running too slow'), t6-t0)
 
-        while self.enabled.value:  # sleep remainder of period
-            dt = period - (time.monotonic() - t0) + sp
-            if dt >= period or dt <= 0:
-                break
-
-            time.sleep(dt)
+        if self.enabled.value:
+            self.scheduler.sleep()
 
 
         #print("times", t1-t0, t2-t1, t3-t2, t4-t3, t5-t4, t6-t5)
@@ -23,6 +23,7 @@ try:
     from values import *
 
     from nonblockingpipe import NonBlockingPipe
+    from sensorbus import SensorBus
 except:
     import failedimports
 
@@ -36,8 +37,17 @@ class IMU(object):
     def __init__(self, server):
         self.client = pypilotClient(server)
         self.multiprocessing = server.multiprocessing
+        self.bus = False
         if self.multiprocessing:
-            self.pipe, pipe = NonBlockingPipe('imu pipe', self.multiprocessing)
+            try:
+                # samples are passed in shared memory rather than encoded through a pipe
+                self.bus = SensorBus()
+                self.pipe, pipe = False, False
+                import atexit
+                atexit.register(self.bus.close)
+            except Exception as e:
+                print(_('failed to create imu shared memory, using pipe'), e)
+                self.pipe, pipe = NonBlockingPipe('imu pipe', self.multiprocessing)
             self.process = multiprocessing.Process(target=self.process, args=(pipe,), daemon=True)
             self.process.start()
             return
@@ -137,7 +147,11 @@ class IMU(object):
             t0 = time.monotonic()
             data = self.read()
             t1 = time.monotonic()
-            pipe.send(data, not data)
+            if not pipe:
+                if data:
+                    self.bus.write(data)
+            else:
+                pipe.send(data, not data)
             t2 = time.monotonic()
 
             if not self.s.GyroBiasValid:
@@ -383,7 +397,7 @@ class AutomaticCalibrationProcess():
 
 
 class BoatIMU(object):
-    def __init__(self, client):
+    def __init__(self, client, replay=False):
         self.client = client
 
         self.rate = self.register(EnumProperty, 'rate', 20, [10, 20], persistent=True)
@@ -401,7 +415,7 @@ class BoatIMU(object):
         self.uptime = self.register(TimeValue, 'uptime')
         self.warning = self.register(StringValue, 'warning', '')
         
-        self.auto_cal = AutomaticCalibrationProcess(client.server)
+        self.auto_cal = replay.auto_cal if replay else AutomaticCalibrationProcess(client.server)
 
         self.lasttimestamp = 0
 
@@ -424,7 +438,7 @@ class BoatIMU(object):
         #sensornames += ['fusionQPose']
         self.SensorValues['fusionQPose'] = self.register(SensorValue, 'fusionQPose', fmt='%.10f')
     
-        self.imu = IMU(client.server)
+        self.imu = replay.imu if replay else IMU(client.server)
 
         self.last_imuread = time.monotonic() + 4 # ignore failed readings at startup
         self.cal_data = False
@@ -448,6 +462,8 @@ class BoatIMU(object):
         self.reset_alignment = True
 
     def IMUread(self):
+        if self.imu.bus:
+            return self.imu.bus.read()
         if self.imu.multiprocessing:
             lastdata = False
             while True:
@@ -457,6 +473,13 @@ class BoatIMU(object):
                 lastdata = data
         return self.imu.read()
 
+    # wait for the next imu sample, returns early when it arrives if possible
+    def wait(self, timeout):
+        if self.imu.bus:
+            return self.imu.bus.wait(timeout)
+        time.sleep(min(timeout, .1/self.rate.value))
+        return True
+
     def read(self):
         if not self.imu.multiprocessing:
             self.imu.poll()
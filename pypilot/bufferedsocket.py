@@ -7,7 +7,91 @@
 # License as published by the Free Software Foundation; either
 # version 3 of the License, or (at your option) any later version.  
 
-import time, select, socket, os
+import time, select, socket, os, struct
+import pyjson
+
+max_iov = 1024 # maximum buffers passed to sendmsg at once (IOV_MAX)
+
+# binary framing, optionally negotiated by clients in place of name=json lines
+# each frame is: kind byte, varint value id, varint payload length, payload
+FRAME_NAME, FRAME_TEXT, FRAME_JSON, FRAME_FLOAT32, FRAME_FLOAT64 = range(5)
+FRAME_ARRAY = 0x80 # flag for float kinds holding a list rather than a number
+
+def varint(n):
+    data = bytearray()
+    while n > 0x7f:
+        data.append(n & 0x7f | 0x80)
+        n >>= 7
+    data.append(n)
+    return data
+
+def encode_frame(kind, id, payload):
+    return bytes([kind]) + varint(id) + varint(len(payload)) + payload
+
+# encode the json text of a value, numbers and lists of numbers are packed
+# as float32 if they have few enough significant digits, otherwise float64
+def encode_value_frame(id, data):
+    array = data[:1] == '['
+    tokens = data[1:-1].split(',') if array else [data]
+    values = []
+    digits = 0
+    try:
+        for token in tokens:
+            token = token.strip()
+            if not '.' in token:
+                raise ValueError # integers, strings and nested lists remain json
+            values.append(float(token))
+            if 'e' in token or 'E' in token:
+                digits = 17
+            else:
+                digits = max(digits, len(token.replace('-', '').replace('.', '').lstrip('0')))
+    except ValueError:
+        return encode_frame(FRAME_JSON, id, data.encode())
+
+    kind, fmt = (FRAME_FLOAT32, '<%df') if digits <= 6 else (FRAME_FLOAT64, '<%dd')
+    if array:
+        kind |= FRAME_ARRAY
+    return encode_frame(kind, id, struct.pack(fmt % len(values), *values))
+
+# returns kind, id, payload and the position after the frame at pos
+# in buf, or False if the frame is incomplete
+def decode_frame(buf, pos=0):
+    try:
+        kind = buf[pos]
+        pos += 1
+        id, shift = 0, 0
+        while buf[pos] & 0x80:
+            id |= (buf[pos] & 0x7f) << shift
+            shift += 7
+            pos += 1
+        id |= buf[pos] << shift
+        pos += 1
+        length, shift = 0, 0
+        while buf[pos] & 0x80:
+            length |= (buf[pos] & 0x7f) << shift
+            shift += 7
+            pos += 1
+        length |= buf[pos] << shift
+        pos += 1
+    except IndexError:
+        return False # incomplete frame header
+    end = pos + length
+    if end > len(buf):
+        return False
+    return kind, id, bytes(buf[pos:end]), end
+
+def decode_value(kind, payload):
+    if kind == FRAME_JSON:
+        return pyjson.loads(payload)
+    if kind & 0x7f == FRAME_FLOAT32:
+        # sent with at most 6 significant digits, which float32 keeps,
+        # so rounding recovers the value as the text protocol has it
+        value = [float('%.6g' % v) for v in struct.unpack('<%df' % (len(payload)//4), payload)]
+    else:
+        value = struct.unpack('<%dd' % (len(payload)//8), payload)
+    if kind & FRAME_ARRAY:
+        return list(value)
+    return value[0]
 
 try:
   from pypilot.linebuffer import linebuffer
@@ -18,14 +102,18 @@ try:
 
         self.socket = connection
         self.address = address
-        self.out_buffer = ''
+        # output is a chain of encoded messages, which may be shared
+        # with other sockets, sent together with sendmsg
+        self.out_buffer = []
+        self.out_len = 0
 
         self.udp_port = False
-        self.udp_out_buffer = ''
+        self.udp_out_buffer = bytearray()
         self.udp_socket = False
 
-        self.pollout = select.poll()
-        self.pollout.register(connection, select.POLLOUT)
+        self.pending = None # set of connections with output, assigned by server
+        self.wait_pollout = False # server is waiting for this socket to be writable
+        self.binary = False # peer requested binary frames
         self.sendfail_msg = 1
         self.sendfail_cnt = 0
 
@@ -48,61 +136,89 @@ try:
     def readline(self):
         return self.b.line()
 
+    # data is str, or bytes which are queued without copying
     def write(self, data, udp=False):
+        if self.pending is not None:
+          self.pending.add(self)
+        if type(data) == str:
+          if self.binary:
+            data = encode_frame(FRAME_TEXT, 0, data.rstrip('\n').encode())
+          else:
+            data = data.encode()
         if udp and self.udp_port:
           self.udp_out_buffer += data
           if len(self.udp_out_buffer) > 400:
             print(_('overflow in pypilot udp socket'), self.address, len(self.udp_out_buffer))
-            self.udp_out_buffer = ''
+            self.udp_out_buffer = bytearray()
         else:
-          self.out_buffer += data
-          if len(self.out_buffer) > 65536:
-            print(_('overflow in pypilot socket'), self.address, len(self.out_buffer), os.getpid())
-            self.out_buffer = ''
+          self.out_buffer.append(data)
+          self.out_len += len(data)
+          if self.out_len > 65536:
+            print(_('overflow in pypilot socket'), self.address, self.out_len, os.getpid())
+            self.out_buffer = []
+            self.out_len = 0
             self.close()
-    
+
+    # returns True once all buffered data is sent
     def flush(self):
         if self.udp_out_buffer:
             try:
                 if not self.udp_socket:
                     self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                count = self.udp_socket.sendto(self.udp_out_buffer.encode(), (self.address[0], self.udp_port))
+                count = self.udp_socket.sendto(self.udp_out_buffer, (self.address[0], self.udp_port))
             except Exception as e:
                 print('udp socket failed to send', e)
                 count = 0
                 self.close()
             if count != len(self.udp_out_buffer):
                 print(_('failed to send udp packet'), self.address)
-            self.udp_out_buffer = ''
+            self.udp_out_buffer = bytearray()
         
         if not self.out_buffer:
-            return
+            return True
 
         try:
-            if not self.pollout.poll(0):
-                if self.sendfail_cnt >= self.sendfail_msg:
-                    print(_('pypilot socket failed to send to'), self.address, self.sendfail_cnt)
-                    self.sendfail_msg *= 10
-                self.sendfail_cnt += 1
-
-                if self.sendfail_cnt > 100:
-                    self.socket.close()
-                    return
-  
             t0 = time.monotonic()
-            count = self.socket.send(self.out_buffer.encode())
+            count = self.socket.sendmsg(self.out_buffer[:max_iov]) # scatter-gather
             #print('write', count, self.out_buffer, time.monotonic())
             t1 = time.monotonic()
 
             if t1-t0 > .1:
-                print(_('socket send took too long!?!?'), self.address, t1-t0, len(self.out_buffer))
+                print(_('socket send took too long!?!?'), self.address, t1-t0, self.out_len)
             if count < 0:
                 print(_('socket send error'), self.address, count)
-                self.socket.close()
-            self.out_buffer = self.out_buffer[count:]
+                self.close()
+                return False
+            self.consume(count)
+        except BlockingIOError:
+            # socket is not writable, rather than polling before each send
+            if self.sendfail_cnt >= self.sendfail_msg:
+                print(_('pypilot socket failed to send to'), self.address, self.sendfail_cnt)
+                self.sendfail_msg *= 10
+            self.sendfail_cnt += 1
+
+            if self.sendfail_cnt > 100:
+                self.close()
+            return False
         except Exception as e:
             print(_('pypilot socket exception'), self.address, e, os.getpid(), self.socket)
             self.close()
+            return False
+        return not self.out_buffer
+
+    # remove count bytes that were sent from the output chain
+    def consume(self, count):
+        self.out_len -= count
+        i = 0
+        for data in self.out_buffer:
+            l = len(data)
+            if count < l:
+                break
+            count -= l
+            i += 1
+        del self.out_buffer[:i]
+        if count:
+            self.out_buffer[0] = memoryview(self.out_buffer[0])[count:]
   
 except Exception as e:
   print(_('falling back to python nonblocking socket, will consume more cpu'), e)
@@ -114,32 +230,53 @@ except Exception as e:
         self.b = False # in python
         self.in_buffer = ''
         self.no_newline_pos = 0
-        self.out_buffer = ''
+        self.out_buffer = bytearray()
+        self.udp_port = False # udp output is not supported, send over tcp
+        self.udp_out_buffer = bytearray()
+
+        self.pending = None
+        self.wait_pollout = False
+        self.binary = False
 
     def close(self):
-        self.socket.close()
+        if self.socket:
+            self.socket.close()
+            self.socket = False
         
     def fileno(self):
-        return self.socket.fileno()
+        if self.socket:
+            return self.socket.fileno()
+        return 0
 
-    def write(self, data):
+    def write(self, data, udp=False):
+        if self.pending is not None:
+            self.pending.add(self)
+        if type(data) == str:
+            if self.binary:
+                data = encode_frame(FRAME_TEXT, 0, data.rstrip('\n').encode())
+            else:
+                data = data.encode()
         self.out_buffer += data
 
     def flush(self):
         if not len(self.out_buffer):
-            return
+            return True
         try:
-            count = self.socket.send(self.out_buffer.encode())
+            count = self.socket.send(self.out_buffer)
             if count < 0:
                 print(_('socket send error in server flush'))
-                self.out_buffer = ''
-                self.socket.close()
-                return
+                self.out_buffer = bytearray()
+                self.close()
+                return False
 
-            self.out_buffer = self.out_buffer[count:]
+            del self.out_buffer[:count]
+        except BlockingIOError:
+            return False
         except:
-            self.out_buffer = ''
-            self.socket.close()
+            self.out_buffer = bytearray()
+            self.close()
+            return False
+        return not self.out_buffer
 
     def recvdata(self):
         size = 4096
@@ -170,3 +307,50 @@ except Exception as e:
                 continue
             self.no_newline_pos += 1
         return ''
+
+# client side of binary framing, reads text lines until the server
+# acknowledges with binary=true, then decodes frames
+class BinaryFramedSocket(LineBufferedNonBlockingSocket):
+    def __init__(self, connection, address):
+        super(BinaryFramedSocket, self).__init__(connection, address)
+        self.in_buffer = bytearray()
+        self.framed = False
+        self.names = {} # value id to name table sent by server
+
+    def recvdata(self):
+        try:
+            data = self.socket.recv(65536)
+        except Exception as e:
+            return False
+        self.in_buffer += data
+        return len(data)
+
+    # returns a text line, or a tuple of name and decoded value
+    def readline(self):
+        buf = self.in_buffer
+        while not self.framed:
+            i = buf.find(b'\n')
+            if i < 0:
+                return ''
+            line = buf[:i+1].decode()
+            del buf[:i+1]
+            if line == 'binary=true\n':
+                self.framed = True
+            elif line.startswith('error=invalid unknown value: binary'):
+                continue # server does not support binary, remain text
+            else:
+                return line
+
+        while True:
+            frame = decode_frame(buf)
+            if not frame:
+                return '' # incomplete frame
+            kind, id, payload, end = frame
+            del buf[:end]
+            if kind == FRAME_NAME:
+                self.names[id] = payload.decode()
+                continue
+
+            if kind == FRAME_TEXT:
+                return payload.decode() + '\n'
+            return self.names[id], decode_value(kind, payload)
@@ -16,6 +16,7 @@ from values import *
 from client import pypilotClientFromArgs
     
 calibration_fit_period = 30  # run every 30 seconds
+refit_threshold = 1.5 # fit from initial guess if warm fit residual grows by this factor
 
 def lmap(*cargs):
     return list(map(*cargs))
@@ -23,7 +24,7 @@ def lmap(*cargs):
 def safedegasin(x):
     return math.degrees(math.asin(min(max(x, -1), 1)))
 
-def FitLeastSq(beta0, f, zpoints, debug, dimensions=1):
+def FitLeastSq(beta0, f, zpoints, debug, dimensions=1, jacobian=None, stats=False):
     try:
         import scipy.optimize
     except Exception as e:
@@ -32,12 +33,93 @@ def FitLeastSq(beta0, f, zpoints, debug, dimensions=1):
         return False
 
     t0 = time.monotonic()
-    leastsq = scipy.optimize.leastsq(f, beta0, zpoints)
+    leastsq = scipy.optimize.leastsq(f, beta0, zpoints, Dfun=jacobian, full_output=True)
     #print('scipy.optimize.leastsq took ', time.monotonic() - t0, leastsq)
-    if not leastsq[1] in [1, 2, 3, 4]:
+    if stats:
+        stats.iterations += leastsq[2]['nfev']
+    if not leastsq[4] in [1, 2, 3, 4]:
         return False
     return list(leastsq[0])
 
+# residuals of points from a sphere with bias origin + beta[:k] along basis
+# vectors and radius beta[k].  With dip, beta[k+1] is the sine of the angle
+# between the points and the down vectors given in the last 3 rows of x
+class SphereModel(object):
+    def __init__(self, origin, basis, dip=False):
+        self.origin = numpy.array(origin[:3], dtype=float)
+        self.basis = numpy.array(basis, dtype=float).reshape(-1, 3)
+        self.k = len(self.basis)
+        self.dip = dip
+        self.dimensions = 2 if dip else 1
+
+    def bias(self, beta):
+        return self.origin + numpy.dot(beta[:self.k], self.basis)
+
+    def f(self, beta, x):
+        m = x[:3].T - self.bias(beta)
+        n = numpy.sqrt(numpy.sum(m*m, axis=1))
+        r0 = beta[self.k] - n
+        if not self.dip:
+            return r0
+        dip = numpy.clip(numpy.sum(m*x[3:6].T, axis=1)/n, -1, 1)
+        return numpy.concatenate((r0, beta[self.k]*(beta[self.k+1] - dip)))
+
+    def jacobian(self, beta, x):
+        m = x[:3].T - self.bias(beta)
+        n = numpy.sqrt(numpy.sum(m*m, axis=1))
+        radius = beta[self.k]
+        j0 = numpy.column_stack((numpy.dot(m/n[:, None], self.basis.T), numpy.ones(len(n))))
+        if not self.dip:
+            return j0
+
+        g = x[3:6].T
+        mg = numpy.sum(m*g, axis=1)
+        dip = mg/n
+        ddip = g/n[:, None] - (mg/n**3)[:, None]*m
+        ddip[numpy.abs(dip) > 1] = 0 # clipped
+        j0 = numpy.column_stack((j0, numpy.zeros(len(n))))
+        j1 = numpy.column_stack((radius*numpy.dot(ddip, self.basis.T),
+                                 beta[self.k+1] - numpy.clip(dip, -1, 1),
+                                 numpy.full(len(n), radius)))
+        return numpy.vstack((j0, j1))
+
+    def rms(self, beta, x):
+        return math.sqrt(numpy.mean(self.f(beta, x)**2))
+
+    # convert between beta and bias, radius (and dip) independent of origin
+    def solution(self, beta):
+        return list(self.bias(beta)) + list(beta[self.k:])
+
+    def beta(self, solution):
+        return list(numpy.dot(self.basis, numpy.array(solution[:3]) - self.origin)) + list(solution[3:])
+
+# keep the previous solution of each fit so when only a few sigma points
+# changed the fit starts from there and converges in a few iterations.
+# A fit from the initial guess is only done if the residual grows too much
+class WarmStart(object):
+    def __init__(self):
+        self.solutions = {}
+        self.iterations = 0
+        self.refits = 0
+        self.key = False
+
+    def fit(self, debug, name, model, beta0, zpoints, valid):
+        if name in self.solutions:
+            solution, rms = self.solutions[name]
+            beta = FitLeastSq(model.beta(solution), model.f, zpoints, debug, model.dimensions, model.jacobian, self)
+            if beta and valid(beta) and model.rms(beta, zpoints) <= rms*refit_threshold:
+                self.solutions[name] = model.solution(beta), rms
+                return beta
+            self.refits += 1
+            debug('warm fit failed, refit', name)
+
+        beta = FitLeastSq(beta0, model.f, zpoints, debug, model.dimensions, model.jacobian, self)
+        if beta and valid(beta):
+            self.solutions[name] = model.solution(beta), model.rms(beta, zpoints)
+        else:
+            self.solutions.pop(name, None)
+        return beta
+
 def FitLeastSq_odr(beta0, f, zpoints, dimensions=1):
     try:
         import scipy.odr
@@ -129,40 +211,35 @@ def LinearFit(points):
     plane = [plane_fit, plane_dev**.5, max_plane_dev**.5]
     return line, plane
 
-def FitPointsAccel(debug, points):
-    zpoints = [[], [], []]
-    for i in range(3):
-        zpoints[i] = lmap(lambda x : x[i], points)
-        
+def FitPointsAccel(debug, points, warm=False):
+    if not warm:
+        warm = WarmStart()
+    zpoints = numpy.array(points).T
+
     # determine if we have 0D, 1D, 2D, or 3D set of points
     point_fit, point_dev, point_max_dev = PointFit(points)
     if point_max_dev < .1:
         debug('insufficient data for accel fit %.1f %.1f < 1' % (point_dev, point_max_dev))
         return False
 
-    def f_sphere3(beta, x):
-        bias = beta[:3]
-        b = numpy.matrix(lmap(lambda a, b : a - b, x[:3], bias))
-        m = list(numpy.array(b.transpose()))
-        r0 = lmap(lambda y : beta[3] - vector.norm(y), m)
-        return r0
-
-    sphere3d_fit = FitLeastSq([0, 0, 0, 1], f_sphere3, zpoints, debug)
+    sphere3 = SphereModel([0, 0, 0], numpy.identity(3))
+    sphere3d_fit = warm.fit(debug, 'sphere3', sphere3, [0, 0, 0, 1], zpoints,
+                            lambda beta : beta[3] >= 0)
     if not sphere3d_fit or sphere3d_fit[3] < 0:
         debug('FitLeastSq sphere failed!!!! ', len(points))
         return False
     debug('sphere3 fit', sphere3d_fit, ComputeDeviation(points, sphere3d_fit))
     return sphere3d_fit
 
-def FitPointsCompass(debug, points, current, norm):
+def FitPointsCompass(debug, points, current, norm, warm=False):
+    if not warm:
+        warm = WarmStart()
     # ensure current and norm are float
     current = lmap(float, current)
     norm = lmap(float, norm)
 
-    zpoints = [[], [], [], [], [], []]
-    for i in range(6):
-        zpoints[i] = lmap(lambda x : x[i], points)
-        
+    zpoints = numpy.array(points).T
+
     # determine if we have 0D, 1D, 2D, or 3D set of points
     point_fit, point_dev, point_max_dev = PointFit(points)
     if point_max_dev < 9:
@@ -206,19 +283,9 @@ def FitPointsCompass(debug, points, current, norm):
     debug('sphere1 fit', sphere1d_fit, ComputeDeviation(points, sphere1d_fit))
     '''
 
-    def f_new_sphere1(beta, x):
-        bias = lmap(lambda x, n: x + beta[0]*n, initial[:3], norm)
-        b = numpy.matrix(lmap(lambda a, b : a - b, x[:3], bias))
-        m = list(numpy.array(b.transpose()))
-        r0 = lmap(lambda y : beta[1] - vector.norm(y), m)
-        g = list(numpy.array(numpy.matrix(x[3:]).transpose()))
-        fac = 1 # weight deviation
-        def dip(y, z):
-            n = min(max(vector.dot(y, z)/vector.norm(y), -1), 1)
-            return n
-        r1 = lmap(lambda y, z : fac*beta[1]*(beta[2]-dip(y, z)), m, g)
-        return r0 + r1
-    new_sphere1d_fit = FitLeastSq([0, initial[3], 0], f_new_sphere1, zpoints, debug, 2)
+    new_sphere1 = SphereModel(initial, [norm], True)
+    new_sphere1d_fit = warm.fit(debug, 'new_sphere1', new_sphere1, [0, initial[3], 0], zpoints,
+                                lambda beta : beta[1] >= 0 and abs(beta[2]) <= 1)
     if not new_sphere1d_fit or new_sphere1d_fit[1] < 0 or abs(new_sphere1d_fit[2]) > 1:
         debug('FitLeastSq new_sphere1 failed!!!! ', len(points), new_sphere1d_fit)
         new_sphere1d_fit = current
@@ -258,20 +325,9 @@ def FitPointsCompass(debug, points, current, norm):
     debug('sphere2 fit', sphere2d_fit, ComputeDeviation(points, sphere2d_fit))
     '''
 
-    def f_new_sphere2(beta, x):
-        bias = lmap(lambda x, a, b: x + beta[0]*a + beta[1]*b, initial[:3], u, v)
-        b = numpy.matrix(lmap(lambda a, b : a - b, x[:3], bias))
-        m = list(numpy.array(b.transpose()))
-        r0 = lmap(lambda y : beta[2] - vector.norm(y), m)
-        #r0 = lmap(lambda y : 1 - vector.norm(y)/beta[2], m)
-        g = list(numpy.array(numpy.matrix(x[3:]).transpose()))
-        fac = 1 # weight deviation
-        def dip(y, z):
-            n = min(max(vector.dot(y, z)/vector.norm(y), -1), 1)
-            return n
-        r1 = lmap(lambda y, z : fac*beta[2]*(beta[3]-dip(y, z)), m, g)
-        return r0 + r1
-    new_sphere2d_fit = FitLeastSq([0, 0, initial[3], 0], f_new_sphere2, zpoints, debug, 2)
+    new_sphere2 = SphereModel(initial, [u, v], True)
+    new_sphere2d_fit = warm.fit(debug, 'new_sphere2', new_sphere2, [0, 0, initial[3], 0], zpoints,
+                                lambda beta : beta[2] >= 0 and abs(beta[3]) < 1)
     if not new_sphere2d_fit or new_sphere2d_fit[2] < 0 or abs(new_sphere2d_fit[3]) >= 1:
         debug('FitLeastSq sphere2 failed!!!! ', len(points), new_sphere2d_fit)
         return False
@@ -304,20 +360,9 @@ def FitPointsCompass(debug, points, current, norm):
         return False
     debug('sphere3 fit', sphere3d_fit, ComputeDeviation(points, sphere3d_fit))
     '''
-    def f_new_sphere3(beta, x):
-        b = numpy.matrix(lmap(lambda a, b : a - b, x[:3], beta[:3]))
-        m = list(numpy.array(b.transpose()))
-        r0 = lmap(lambda y : beta[3] - vector.norm(y), m)
-        #r0 = lmap(lambda y : 1 - vector.norm(y)/beta[3], m)
-        g = list(numpy.array(numpy.matrix(x[3:]).transpose()))
-        fac = 1 # weight deviation
-        def dip(y, z):
-            n = min(max(vector.dot(y, z)/vector.norm(y), -1), 1)
-            return n
-        r1 = lmap(lambda y, z : fac*beta[3]*(beta[4]-dip(y, z)), m, g)
-
-        return r0 + r1
-    new_sphere3d_fit = FitLeastSq(initial[:4] + [0], f_new_sphere3, zpoints, debug, 2)
+    new_sphere3 = SphereModel([0, 0, 0], numpy.identity(3), True)
+    new_sphere3d_fit = warm.fit(debug, 'new_sphere3', new_sphere3, initial[:4] + [0], zpoints,
+                                lambda beta : beta[3] >= 0 and abs(beta[4]) < 1)
     if not new_sphere3d_fit or new_sphere3d_fit[3] < 0 or abs(new_sphere3d_fit[4]) >= 1:
         debug('FitLeastSq sphere3 failed!!!! ', len(points))
         return False
@@ -348,11 +393,18 @@ class SigmaPoint(object):
 
 # store averaged sensore measurements over time for
 # calibration curve fitting
+#
+# points are kept in fixed arrays with a grid index of cell size sigma
+# so a matching point is found by looking at neighboring cells only.
+# The distances to the two nearest other points are kept up to date as
+# points are added, moved or removed to pick a replacement when full
 class SigmaPoints(object):
     def __init__(self, sigma, max_sigma_points, min_count):
         self.sigma = sigma
+        self.cell = math.sqrt(sigma) # a match is never more than 1 cell away
         self.max_sigma_points = max_sigma_points
         self.min_count = min_count
+        self.generation = 0 # changes whenever stored points change
         self.Reset()
         self.updated = False
         self.last_sample = False
@@ -365,17 +417,115 @@ class SigmaPoints(object):
 
     # forget all knowledge of stored sensor points
     def Reset(self):
-        self.sigma_points = []
+        self.generation += 1
+        n = self.max_sigma_points
+        self.size = 0
+        self.sensor = numpy.zeros((n, 3))
+        self.down = numpy.zeros((n, 3))
+        self.count = numpy.zeros(n, dtype=int)
+        self.time = numpy.zeros(n)
+        self.dist = numpy.full((n, n), numpy.inf) # distance between points
+        self.nearest = numpy.full((n, 2), numpy.inf) # to closest 2 points
+        self.cells = [None]*n
+        self.grid = {} # cell -> set of indexes
         self.lastpoint = False
 
     def Points(self, down=False):
-        def pt(p):
-            if down:
-                return p.sensor + p.down
-            else:
-                return p.sensor
+        if down:
+            return numpy.hstack((self.sensor[:self.size], self.down[:self.size])).tolist()
+        return self.sensor[:self.size].tolist()
+
+    def _cell(self, sensor):
+        return tuple(int(math.floor(x / self.cell)) for x in sensor)
 
-        return lmap(pt, self.sigma_points)
+    def _index(self, i):
+        cell = self._cell(self.sensor[i])
+        if cell == self.cells[i]:
+            return
+        self._unindex(i)
+        self.cells[i] = cell
+        self.grid.setdefault(cell, set()).add(i)
+
+    def _unindex(self, i):
+        cell = self.cells[i]
+        if cell is None:
+            return
+        points = self.grid[cell]
+        points.discard(i)
+        if not points:
+            del self.grid[cell]
+        self.cells[i] = None
+
+    # closest point within sigma that can still take measurements
+    def _match(self, sensor):
+        x, y, z = self._cell(sensor)
+        best, bestd = False, self.sigma
+        for i in range(x-1, x+2):
+            for j in range(y-1, y+2):
+                for k in range(z-1, z+2):
+                    for index in self.grid.get((i, j, k), ()):
+                        if self.count[index] > 100:
+                            continue
+                        d = vector.dist2(self.sensor[index], sensor)
+                        if d < bestd:
+                            best, bestd = index, d
+        return best
+
+    # recompute the two nearest distances of the given rows
+    def _nearest(self, rows):
+        n = self.size
+        if n < 2:
+            self.nearest[rows] = numpy.inf
+            return
+        self.nearest[rows] = numpy.sort(numpy.partition(self.dist[rows, :n], 1, axis=1)[:, :2], axis=1)
+
+    # update distances after point i was added or moved
+    def _update(self, i):
+        self.generation += 1
+        n = self.size
+        old = self.dist[i, :n].copy()
+        d = numpy.sqrt(numpy.sum((self.sensor[:n] - self.sensor[i])**2, axis=1))
+        d[i] = numpy.inf
+        self.dist[i, :n] = d
+        self.dist[:n, i] = d
+
+        # points that had i as a nearest neighbor are recomputed
+        nearest = self.nearest[:n]
+        stale = old <= nearest[:, 1]
+        stale[i] = True
+        d = numpy.where(stale, numpy.inf, d)
+        nearest[:, 1] = numpy.where(d < nearest[:, 0], nearest[:, 0], numpy.minimum(nearest[:, 1], d))
+        nearest[:, 0] = numpy.minimum(nearest[:, 0], d)
+        self._nearest(numpy.flatnonzero(stale))
+
+    def _remove(self, i):
+        self.generation += 1
+        n = self.size - 1
+        old = self.dist[i, :self.size].copy()
+        self._unindex(i)
+        if i != n: # move last point into place
+            self._unindex(n)
+            for a in [self.sensor, self.down, self.count, self.time, self.nearest]:
+                a[i] = a[n]
+            self.dist[i] = self.dist[n]
+            self.dist[:, i] = self.dist[:, n]
+            self.dist[i, i] = numpy.inf
+            old[i] = old[n]
+            self._index(i)
+        self.dist[n] = numpy.inf
+        self.dist[:, n] = numpy.inf
+        self.nearest[n] = numpy.inf
+        self.size = n
+        self._nearest(numpy.flatnonzero(old[:n] <= self.nearest[:n, 1]))
+
+    def _set(self, i, sensor, down):
+        self.sensor[i] = sensor
+        if down:
+            self.down[i] = down
+        self.count[i] = 1
+        self.time[i] = time.monotonic()
+        self._index(i)
+        self._update(i)
 
     # store a new sensor
     def AddPoint(self, sensor, down=False):
@@ -396,88 +546,60 @@ class SigmaPoints(object):
         self.last_sample = sensor, down
         self.lastpoint = False
 
-        ind = 0
-        for point in self.sigma_points:
-            if point.count > 100:
-                continue
-            if vector.dist2(point.sensor, sensor) < self.sigma:
-                point.add_measurement(sensor, down)
-                if ind > 0:
-                    # move toward front of list to speed up future tests
-                    self.sigma_points = self.sigma_points[:ind-1] + [point] + [self.sigma_points[ind-1]] + self.sigma_points[ind+1:]
-                return
-            ind += 1
+        i = self._match(sensor)
+        if i is not False:
+            self.count[i] += 1
+            fac = max(1/self.count[i], .01)
+            self.sensor[i] += fac*(numpy.array(sensor) - self.sensor[i])
+            if down:
+                self.down[i] += fac*(numpy.array(down) - self.down[i])
+            self.time[i] = time.monotonic()
+            self._index(i)
+            self._update(i)
+            return
 
         self.updated = True
-        index = len(self.sigma_points)
-        p = SigmaPoint(sensor, down)
-        if index < self.max_sigma_points:
-            # push to front of list
-            self.sigma_points = [p] + self.sigma_points
+        if self.size < self.max_sigma_points:
+            self.size += 1
+            self._set(self.size-1, sensor, down)
             return
 
-
         # replace point that is closest to other points
-        mindi = 0
-        mind = 1e20
-        for i in range(len(self.sigma_points)):
-            dt = time.monotonic() - self.sigma_points[i].time
-            d = []
-            for j in range(len(self.sigma_points)):
-                if i == j:
-                    continue
-                dist = vector.dist(self.sigma_points[i].sensor, self.sigma_points[j].sensor)
-                count = min(self.sigma_points[i].count, 100)
-                d.append(dist)
-
-            d.sort()
-            # weight based on distance to closest 2 points and time
-            total = (d[0]+d[1])*1/dt**.2
-            if total < mind:
-                mindi = i
-                mind = total
-
-        self.sigma_points[mindi] = p
+        # weight based on distance to closest 2 points and time
+        n = self.size
+        dt = numpy.maximum(time.monotonic() - self.time[:n], 1e-3)
+        total = numpy.sum(self.nearest[:n], axis=1) / dt**.2
+        self._set(int(numpy.argmin(total)), sensor, down)
 
     def RemoveOlder(self, dt=3600):
-        p = []
-        for sigma in self.sigma_points:
-            if time.monotonic() - sigma.time < dt:
-                p.append(sigma)
-        self.sigma_points = p
+        old = time.monotonic() - self.time[:self.size] >= dt
+        for i in reversed(numpy.flatnonzero(old)):
+            self._remove(i)
 
     def RemoveOldest(self):
-        oldest_sigma = self.sigma_points[0]
-        for sigma in self.sigma_points:
-            if sigma.time < oldest_sigma.time:
-                oldest_sigma = sigma
-
+        if not self.size:
+            return
+        i = int(numpy.argmin(self.time[:self.size]))
         # don't remove if < 1 minute old
-        if time.monotonic() - oldest_sigma.time >= 60:
-            self.sigma_points.remove(oldest_sigma)
+        if time.monotonic() - self.time[i] >= 60:
+            self._remove(i)
 
 # calculate how well these datapoints cover the space by
 # counting how many 20 degree segments have at least 1 datapoint
 def ComputeCoverage(p, bias, norm):
     q = quaternion.vec2vec2quat(norm, [0, 0, 1])
-    def ang(p):
-        c = quaternion.rotvecquat(vector.sub(p[:3], bias), q)
-        d = quaternion.rotvecquat(p[3:6], q)
-        v = quaternion.rotvecquat(c, quaternion.vec2vec2quat(d, [0, 0, 1]))
-        v = vector.normalize(v)
-        return math.degrees(math.atan2(v[1], v[0]))
+    p = numpy.array(p)
+    c = quaternion.rotvecquat_array(p[:, :3] - bias, q)
+    d = quaternion.rotvecquat_array(p[:, 3:6], q)
+    v = quaternion.rotvecquat_array(c, quaternion.vec2vec2quat_array(d, [0, 0, 1]))
+    angles = numpy.degrees(numpy.arctan2(v[:, 1], v[:, 0]))
 
     spacing = 20 # 20 degree segments
-    angles = [False] * int(360 / spacing)
-    count = 0
-    for a in lmap(ang, p):
-        i = int(resolv(a, 180) / spacing)
-        if not angles[i]:
-            angles[i] = True
-            count += 1
-    return count
-
-def FitAccel(debug, accel_cal):
+    segments = int(360 / spacing)
+    i = numpy.minimum((numpy.mod(angles, 360) / spacing).astype(int), segments - 1)
+    return len(numpy.unique(i))
+
+def FitAccel(debug, accel_cal, warm=False):
     p = accel_cal.Points()
     if len(p) < 5:
         return False
@@ -491,7 +613,7 @@ def FitAccel(debug, accel_cal):
     if sum(diff) < 4.5:
         debug('need more spread', '%.4f' % sum(diff))
         return # require more spread
-    fit = FitPointsAccel(debug, p)
+    fit = FitPointsAccel(debug, p, warm)
     if not fit:
         debug('FitPointsAccel failed', fit)
         return False
@@ -503,12 +625,12 @@ def FitAccel(debug, accel_cal):
     dev = ComputeDeviation(p, fit)
     return [fit, dev]
 
-def FitCompass(debug, compass_points, compass_calibration, norm):
+def FitCompass(debug, compass_points, compass_calibration, norm, warm=False):
     p = compass_points.Points(True)
     if len(p) < 8:
         return
 
-    fit = FitPointsCompass(debug, p, compass_calibration, norm)
+    fit = FitPointsCompass(debug, p, compass_calibration, norm, warm)
     if not fit:
         return
     #debug('FitCompass', fit)
@@ -622,6 +744,9 @@ def RegisterCalibration(client, name, default):
     calibration.sigmapoints = client.register(RoundedValue(name+'.calibration.sigmapoints', False))
     calibration.points = client.register(RoundedValue(name+'.calibration.points', False, persistent=True))
     calibration.log = client.register(Property(name+'.calibration.log', ''))
+    calibration.fit_time = client.register(SensorValue(name+'.calibration.fit_time'))
+    calibration.fit_iterations = client.register(Value(name+'.calibration.fit_iterations', 0))
+    calibration.warm = WarmStart()
     return calibration
         
 def CalibrationProcess(cal_pipe, client):
@@ -656,6 +781,21 @@ def CalibrationProcess(cal_pipe, client):
 
     last_compass_coverage = 0
 
+    # fit only if the points, calibration or other fit arguments such
+    # as the down vector changed since the last fit
+    def timed_fit(calibration, points, fit, *args):
+        warm = calibration.warm
+        key = points.generation, str(calibration.value), str([arg for arg in args if arg is not points and not callable(arg)])
+        if key == warm.key:
+            return False
+        warm.key = key
+        warm.iterations = 0
+        t0 = time.monotonic()
+        result = fit(*args, warm)
+        calibration.fit_time.set(time.monotonic() - t0)
+        calibration.fit_iterations.set(warm.iterations)
+        return result
+
     warnings = {}
     def warnings_update(sensor, warning, value):
         if value:
@@ -765,7 +905,7 @@ def CalibrationProcess(cal_pipe, client):
             continue
 
         accel_points.RemoveOlder(10*60) # 10 minutes
-        fit = FitAccel(debug('accel'), accel_points)
+        fit = timed_fit(accel_calibration, accel_points, FitAccel, debug('accel'), accel_points)
         if fit: # reset compass sigmapoints on accel cal
             dist = vector.dist(fit[0][:3], accel_calibration.value[0][:3])
             if dist > .01: # only update when bias changes more than this
@@ -778,7 +918,7 @@ def CalibrationProcess(cal_pipe, client):
                 debug('accel')('calibration distance too small ', dist)
 
         compass_points.RemoveOlder(20*60) # 20 minutes
-        fit = FitCompass(debug('compass'), compass_points, compass_calibration.value[0], norm)
+        fit = timed_fit(compass_calibration, compass_points, FitCompass, debug('compass'), compass_points, compass_calibration.value[0], norm)
         if fit:
             # ignore decreasing compass coverage
             new_coverage = fit[1][2]
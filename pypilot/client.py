@@ -13,7 +13,7 @@ import heapq
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import pyjson
 import gettext_loader
-from bufferedsocket import LineBufferedNonBlockingSocket
+from bufferedsocket import LineBufferedNonBlockingSocket, BinaryFramedSocket
 from values import Value
 
 DEFAULT_PORT = 23322
@@ -106,10 +106,11 @@ class ClientValues(Value):
                 self.wvalues[name] = self.values[name].info
 
 class pypilotClient(object):
-    def __init__(self, host=False, use_udp=False):
+    def __init__(self, host=False, use_udp=False, binary=False):
         if sys.version_info[0] < 3:
             import failedimports
 
+        self.binary = binary # request binary frames from server, tcp only
         self.values = ClientValues(self)
         self.watches = {}
         self.wwatches = {}
@@ -205,7 +206,11 @@ class pypilotClient(object):
         except Exception as e:
             print(_('Exception writing config file:'), self.configfilename, e)
 
-        self.connection = LineBufferedNonBlockingSocket(self.connection_in_progress, self.config['host'])
+        if self.binary:
+            self.connection = BinaryFramedSocket(self.connection_in_progress, self.config['host'])
+            self.connection.write('binary=true\n')
+        else:
+            self.connection = LineBufferedNonBlockingSocket(self.connection_in_progress, self.config['host'])
         self.connection_in_progress = False
         self.poller = select.poll()
         self.poller.register(self.connection.socket, select.POLLIN)
@@ -349,6 +354,13 @@ class pypilotClient(object):
             if not line:
                 return
             #print('client line', line, time.monotonic())
+            if type(line) == tuple: # already decoded binary frame
+                name, value = line
+                if name in self.values.values:
+                    self.values.values[name].set(value)
+                else:
+                    self.received.append(line)
+                continue
             try:
                 name, data = line.rstrip().split('=', 1)
                 if name == 'error':
@@ -490,7 +502,8 @@ class pypilotClient(object):
             dt = timeout - (time.monotonic()-t0)
         if self.last_values_list == ret:
             return False
-        self.last_values_list = ret
+        # copy, the list is updated in place when values are added
+        self.last_values_list = dict(ret) if ret else ret
         return ret
 
     def info(self, name):
@@ -553,6 +566,88 @@ def nice_str(value):
     return str(value)
 
 
+def process_cpu(pid):
+    # user + system time in seconds
+    try:
+        f = open('/proc/%d/stat' % pid)
+        stat = f.readline().rsplit(')', 1)[1].split()
+        f.close()
+        return (int(stat[11]) + int(stat[12])) / os.sysconf('SC_CLK_TCK')
+    except Exception as e:
+        print('failed to read cpu time', e)
+    return 0
+
+# compare text and binary protocols receiving imu like values
+def benchmark(counts=[1, 10, 30], rate=100, duration=5):
+    import math, random
+    from server import pypilotServer
+    from values import SensorValue
+    from bufferedsocket import encode_value_frame
+    server = pypilotServer()
+    producer = pypilotClient(server)
+    values = [producer.register(SensorValue('benchmark.heading', 0, directional=True)),
+              producer.register(SensorValue('benchmark.fusionQPose', [1, 0, 0, 0], fmt='%.10f')),
+              producer.register(SensorValue('benchmark.accel', [0, 0, 1])),
+              producer.register(SensorValue('benchmark.gyro', [0, 0, 0])),
+              producer.register(SensorValue('benchmark.pitch', 0)),
+              producer.register(SensorValue('benchmark.roll', 0))]
+    server.poll() # start server process
+    producer.poll(1)
+
+    def update():
+        r = lambda : random.uniform(-1, 1)
+        values[0].set(random.uniform(0, 360))
+        q = [r(), r(), r(), r()]
+        d = math.sqrt(sum(map(lambda x : x*x, q)))
+        values[1].set(list(map(lambda x : x/d, q)))
+        values[2].set([r(), r(), 1+r()])
+        values[3].set([r(), r(), r()])
+        values[4].set(10*r())
+        values[5].set(10*r())
+
+    update()
+    text_size = binary_size = 0
+    for value in values:
+        msg = value.get_msg()
+        text_size += len(value.name) + len(msg) + 2
+        binary_size += len(encode_value_frame(1, msg))
+    print('bytes per update text', text_size, 'binary', binary_size)
+    print('mode    clients  msgs/s  client us/msg  server cpu %')
+    for binary in [False, True]:
+        for count in counts:
+            clients = []
+            for i in range(count):
+                client = pypilotClient('localhost', binary=binary)
+                client.connect()
+                for value in values:
+                    client.watch(value.name)
+                clients.append(client)
+
+            received, client_cpu = 0, 0
+            t0 = time.monotonic()
+            next_update = t0
+            cpu0 = process_cpu(server.process.pid)
+            while time.monotonic() - t0 < duration:
+                t = time.monotonic()
+                if t >= next_update:
+                    update()
+                    producer.poll()
+                    next_update += 1/rate
+                c0 = time.process_time()
+                for client in clients:
+                    received += len(client.receive())
+                client_cpu += time.process_time() - c0
+                dt = next_update - time.monotonic()
+                if dt > 0:
+                    time.sleep(dt)
+            server_cpu = process_cpu(server.process.pid) - cpu0
+            for client in clients:
+                client.disconnect()
+            print('%-6s  %7d  %6d  %13.1f  %12.1f' % ('binary' if binary else 'text', count, received/duration,
+                                                    1e6*client_cpu/max(received, 1), 100*server_cpu/duration))
+            time.sleep(.5) # allow server to remove sockets
+    server.process.terminate()
+
 # this simple test client for an autopilot server
 # connects, enumerates the values, and then requests
 # each value, printing them
@@ -562,13 +657,18 @@ def main():
         exit(0)
     signal.signal(signal.SIGINT, quit)
 
+    if '-b' in sys.argv:
+        benchmark()
+        exit(0)
+
     if '-h' in sys.argv:
-        print(_('usage'), sys.argv[0], '[-s host] -i -c -h [NAME[=VALUE]]...')
+        print(_('usage'), sys.argv[0], '[-s host] -i -c -b -h [NAME[=VALUE]]...')
         print('eg:', sys.argv[0], '-i imu.compass')
         print('   ', sys.argv[0], 'servo.max_slew_speed=10')
         print('-s', _('set the host or ip address'))
         print('-i', _('print info about each value type'))
         print('-c', _('continuous watch'))
+        print('-b', _('benchmark text and binary protocols'))
         print('-h', _('show this message'))
         exit(0)
 
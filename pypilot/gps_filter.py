@@ -12,7 +12,7 @@
 # wave height
 # boat speed
 
-import os
+import os, sys
 import multiprocessing
 import math
 
@@ -31,6 +31,8 @@ except:
     wmm2020 = False
             
 
+history_size = 128 # predictions kept to replay after delayed gps measurements
+
 earth_radius =  6378137.0
 earth_md = earth_radius*2*math.pi/360
 
@@ -133,16 +135,33 @@ class GPSFilter(object):
         self.Q = np.vstack((np.hstack((pos, cov)), np.hstack((cov, vel))))
         self.predict_t = 0
 
+        # preallocated state, covariance and matrices updated in place
+        self.c = c
+        n = 2*c
+        self.X = np.zeros(n)
+        self.P = np.identity(n)
+        self.I = np.identity(n)
+        self.F = np.identity(n)
+        self.F_dt = np.arange(c), np.arange(c, n) # elements of F set to dt
+        self.scratch = np.zeros((n, n))
+
+        # ring of predictions with the state after each one
+        self.history_t = np.zeros(history_size)
+        self.history_dt = np.zeros(history_size)
+        self.history_U = np.zeros((history_size, c))
+        self.history_X = np.zeros((history_size, n))
+        self.history_P = np.zeros((history_size, n, n))
+
         self.reset()
 
     def register(self, _type, name, *args, **kwargs):
         return self.client.register(_type(*(['gps.filtered.' + name] + list(args)), **kwargs))
 
     def reset(self):
-        c = 3 if self.use3d else 2
-        self.X = False
-        self.P = np.identity(2*c)
-        self.history = []
+        self.valid = False # no trusted measurement yet
+        self.P[:] = self.I
+        self.history_count = 0
+        self.history_index = 0 # next entry to write
         self.lastll = False
 
     def predict(self, accel, fusionQPose, t):
@@ -178,11 +197,18 @@ class GPSFilter(object):
             print('gpsfilter reset', dt)
             self.reset()
 
-        if type(self.X) == bool and not self.X: # filter was reset            
+        if not self.valid: # filter was reset
             return # do not have a trusted measurement yet, so cannot perform predictions
         
         self.apply_prediction(dt, U)
-        self.history.append({'t': t, 'dt': dt, 'U': U, 'X': self.X, 'P': self.P})
+        k = self.history_index
+        self.history_t[k] = t
+        self.history_dt[k] = dt
+        self.history_U[k] = U
+        self.history_X[k] = self.X
+        self.history_P[k] = self.P
+        self.history_index = (k + 1) % history_size
+        self.history_count = min(self.history_count + 1, history_size)
 
         # filtered position
         ll = xy_to_ll(self.X[0], self.X[1], *self.lastll)
@@ -210,16 +236,18 @@ class GPSFilter(object):
         
         dt = min(max(dt, .02), .1)
         dt2 = dt*dt/2
-        c = 3 if self.use3d else 2
-        i = np.identity(c)
-        B = np.vstack((dt2*i, dt*i))
-        F = np.vstack((np.hstack((i, dt*i)),
-                       np.hstack((np.zeros([c, c]), i))))
-        #X = F*X + B*U
-        self.X = F@self.X + B@U
+        c = self.c
+        #X = F*X + B*U  where F = [[I, dt*I], [0, I]] and B = [dt2*I, dt*I]
+        X = self.X
+        X[:c] += dt*X[c:] + dt2*U
+        X[c:] += dt*U
 
         #P = F*P*Ft + Q
-        self.P = F@self.P@F.transpose() + self.Q
+        F = self.F
+        F[self.F_dt] = dt
+        np.matmul(F, self.P, out=self.scratch)
+        np.matmul(self.scratch, F.T, out=self.P)
+        self.P += self.Q
 
     def update(self, data, t):
         if not self.enabled.value:
@@ -245,9 +273,13 @@ class GPSFilter(object):
 
         # adjust coordinate frame
         ll = data['lat'], data['lon']
-        if type(self.X) != bool:
+        if self.valid:
             pll = xy_to_ll(self.X[0], self.X[1], *self.lastll)
-            self.X[0], self.X[1] = ll_to_xy(pll[0], pll[1], *ll)
+            x, y = ll_to_xy(pll[0], pll[1], *ll)
+            # shift stored predictions into the new frame as well
+            self.history_X[:, 0] += x - self.X[0]
+            self.history_X[:, 1] += y - self.X[1]
+            self.X[0], self.X[1] = x, y
         self.lastll = ll
 
         # update magnetic declination from magnetic model once every few hours if available
@@ -279,21 +311,21 @@ class GPSFilter(object):
             return
 
         # based on the timestamp we need to rewind the filter to the prediction just before it
-        t0 = False
-        i = 0
-        for i in range(len(self.history)):
-            h = self.history[-i-1]
-            t0 = h['t']
-            if t0 < ts:
-                self.X = h['X']
-                self.P = h['P']
-                break
+        # history entries from newest to oldest, i of them are after the measurement
+        count = self.history_count
+        ks = (self.history_index - 1 - np.arange(count)) % history_size
+        older = self.history_t[ks] < ts
+        i = int(np.argmax(older)) if older.any() else max(count - 1, 0)
+        if count:
+            self.X[:] = self.history_X[ks[i]]
+            self.P[:] = self.history_P[ks[i]]
 
         # compute time offset prediction and filter it
         if i > 0 and 0: # disable for now
-            a0 = math.degrees(math.atan2(*self.history[-i-1]['X'][c:c+2]))
-            a1 = math.degrees(math.atan2(*self.history[-i]['X'][c:c+2]))
-            t1 = self.history[-i]['t']
+            t0 = self.history_t[ks[i]]
+            a0 = math.degrees(math.atan2(*self.history_X[ks[i]][c:c+2]))
+            a1 = math.degrees(math.atan2(*self.history_X[ks[i-1]][c:c+2]))
+            t1 = self.history_t[ks[i-1]]
 
             da = resolv(a1-a0)
             db = resolv(track-a0)
@@ -309,17 +341,17 @@ class GPSFilter(object):
             to = min(max(t0, 0), 2)
             self.gps_time_offset.update(to)
 
-        if type(self.X) == bool and not self.X: # filter was reset
-            self.X = Z
+        if not self.valid: # filter was reset
+            self.X[:] = Z
+            self.valid = True
 
-        # apply normal kalman measurement update
-        H = np.identity(2*c)
+        # apply normal kalman measurement update, H is identity
         
         #Y = Z - H*X
-        Y = Z - H@self.X
+        Y = Z - self.X
 
         #S = H*P*Ht + R
-        S = H@self.P@H.transpose() + self.R
+        S = self.P + self.R
 
         #K = P*Ht*S^-1
         try:
@@ -328,14 +360,15 @@ class GPSFilter(object):
             # failed to invert matrix, reset filter?
             print('gps filter failed to invert S')
             return
-        K = self.P@H.transpose()@invS
+        K = self.P@invS
 
         #x = x + K*Y
         curX = self.X.copy()
         self.X += K@Y
 
         #P = (I - K*H) * P
-        self.P = (np.identity(2*c) - K@H) @ self.P
+        np.matmul(self.I - K, self.P, out=self.scratch)
+        self.P[:] = self.scratch
 
         # adjust compass alignment based on the disagreement in corrections
         if 0 and speed > 2:
@@ -350,8 +383,84 @@ class GPSFilter(object):
                 d = .0005 # filter
                 self.compass_offset.set(resolv(self.compass_offset.value + d*comp_adj))
 
-        # fast forward previous measurements
-        for h in self.history[-i:]:
-            self.apply_prediction(h['dt'], h['U'])
-
-        self.history = self.history[-i:] # reset history
+        # fast forward previous predictions, storing the corrected states
+        # so a later measurement rewinds to a state including this one
+        if count:
+            self.history_X[ks[i]] = self.X
+            self.history_P[ks[i]] = self.P
+        for k in ks[:i][::-1]:
+            self.apply_prediction(self.history_dt[k], self.history_U[k])
+            self.history_X[k] = self.X
+            self.history_P[k] = self.P
+
+# feed a log of imu and gps samples through the filter and report the
+# cost per step and memory over time.  Log lines are either
+#   t imu ax ay az q0 q1 q2 q3
+#   t gps lat lon speed track timestamp
+# without a log, a boat turning circles is simulated for the given hours
+def benchmark(path=False, hours=2):
+    global np
+    import numpy as np
+    import random
+    def rss(): # resident memory in bytes
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+
+    def simulate():
+        lat0, lon0 = 45, -60
+        speed, rate = 5/1.944, 2 # m/s, degrees/s
+        lag = .7 # gps reading lag
+        t = 0
+        while t < hours*3600:
+            t += .05
+            heading = math.radians(rate*t)
+            radius = speed / math.radians(rate)
+            x, y = radius*(1 - math.cos(heading)), radius*math.sin(heading)
+            # centripetal acceleration in g rotated to heading
+            a = speed*speed/radius/9.81
+            accel = [a*math.cos(heading) + random.gauss(0, .01), -a*math.sin(heading) + random.gauss(0, .01), 1]
+            yield t, 'imu', accel + [1, 0, 0, 0], (x, y)
+            if round(t*20) % 20 == 0:
+                ts = t - lag
+                h = math.radians(rate*ts)
+                gx, gy = radius*(1 - math.cos(h)), radius*math.sin(h)
+                lat, lon = xy_to_ll(gx + random.gauss(0, 3), gy + random.gauss(0, 3), lat0, lon0)
+                track = resolv(math.degrees(h), 180)
+                yield t, 'gps', [lat, lon, speed*1.944, track, ts], (x, y)
+
+    def read_log():
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 2:
+                    yield float(fields[0]), fields[1], list(map(float, fields[2:])), False
+
+    f = GPSFilter(pypilotClient(False))
+    f.enabled.set(True)
+    f.declination.set(0)
+    f.compass_offset.set(0)
+    f.gps_time_offset.set(.7)
+
+    steps, updates, error, errors = 0, 0, 0, 0
+    t0 = time.monotonic()
+    for t, kind, data, truth in simulate() if not path else read_log():
+        if kind == 'imu':
+            f.predict(data[:3], data[3:7], t)
+            steps += 1
+        elif kind == 'gps':
+            f.update({'lat': data[0], 'lon': data[1], 'speed': data[2], 'track': data[3], 'timestamp': data[4]}, t)
+            updates += 1
+            if truth and f.valid and f.lastll:
+                x, y = ll_to_xy(*xy_to_ll(f.X[0], f.X[1], *f.lastll), 45, -60)
+                error += math.hypot(x - truth[0], y - truth[1])**2
+                errors += 1
+
+        if steps and steps % 72000 == 0 and kind == 'imu': # each simulated hour
+            t1 = time.monotonic()
+            print('%7d steps %.1f us/step rss %d kB' % (steps, 1e6*(t1-t0)/72000, rss()/1024))
+            t0 = t1
+    if errors:
+        print('position rms error %.1f meters over %d gps updates' % (math.sqrt(error/errors), updates))
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else False)
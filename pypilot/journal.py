@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2024 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# append only journal of changed persistent values
+#
+# each record is a line with the crc32 of the record followed by a json
+# list of the profile and the value line as stored in pypilot.conf.
+# A record torn by power loss fails the crc, so reading stops there
+# and the damaged tail is removed.
+#
+# records are written from a background thread so the server never
+# waits on the sd card, or synchronously once the journal is closed.
+# Compacting writes the complete configuration to a temporary file
+# which is renamed over the config file, then empties the journal.  If
+# interrupted between the two, replaying the journal over the new
+# config file gives the same values.
+
+import os, sys, time, zlib, threading, queue
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import pyjson
+
+journal_compact_size = 64*1024 # compact when the journal is larger
+journal_compact_period = 600 # compact after seconds without changes
+
+def encode_record(profile, line):
+    payload = pyjson.dumps([profile, line.rstrip()]).encode()
+    return b'%08x ' % zlib.crc32(payload) + payload + b'\n'
+
+class ConfigJournal(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.path = filename + '.journal'
+        self.size = 0 # bytes in the journal including queued records
+        self.change_time = time.monotonic()
+        self.compacted = False # set when the config file was replaced
+        self.queue = queue.Queue()
+        self.thread = False
+        self.fd = False
+        self.closed = False
+
+    # return profile and line of each valid record
+    def read(self):
+        records, pos = [], 0
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return records
+        for line in f:
+            try:
+                crc, payload = line.rstrip(b'\n').split(b' ', 1)
+                if not line.endswith(b'\n') or int(crc, 16) != zlib.crc32(payload):
+                    break
+                profile, data = pyjson.loads(payload.decode())
+            except Exception:
+                break
+            records.append((profile, data + '\n'))
+            pos += len(line)
+        f.close()
+
+        if pos < os.path.getsize(self.path):
+            print(_('discarding damaged journal records'), self.path)
+            with open(self.path, 'r+b') as f:
+                f.truncate(pos)
+        self.size = pos
+        return records
+
+    # records is a list of profile and line
+    def append(self, records):
+        data = b''.join([encode_record(profile, line) for profile, line in records])
+        self.size += len(data)
+        self.change_time = time.monotonic()
+        self.put(self.write, data)
+
+    # text is the complete config file
+    def compact(self, text):
+        self.size = 0
+        self.put(self.replace, text)
+
+    def need_compact(self, t):
+        if self.size > journal_compact_size:
+            return True
+        return self.size and t - self.change_time > journal_compact_period
+
+    def put(self, op, data):
+        if self.closed: # no writer thread after close, write synchronously
+            self.execute(op, data)
+            self.close_fd()
+            return
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.queue.put((op, data))
+
+    def run(self):
+        while True:
+            op, data = self.queue.get()
+            if not op:
+                break
+            self.execute(op, data)
+
+    def execute(self, op, data):
+        try:
+            op(data)
+        except Exception as e:
+            print(_('failed to write'), self.path, e)
+
+    def write(self, data):
+        if not self.fd:
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self.fd, data)
+        os.fsync(self.fd)
+
+    def replace(self, text):
+        tmp = self.filename + '.tmp'
+        f = open(tmp, 'w')
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp, self.filename)
+        self.compacted = True
+
+        if not self.fd:
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.ftruncate(self.fd, 0)
+        os.fsync(self.fd)
+
+    # write queued records and stop the writer, later records are
+    # written synchronously
+    def close(self):
+        self.closed = True
+        if self.thread:
+            self.queue.put((False, False))
+            self.thread.join()
+            self.thread = False
+        self.close_fd()
+
+    def close_fd(self):
+        if self.fd:
+            os.close(self.fd)
+            self.fd = False
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2024 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# serve histogram values from pypilot as text metrics on the local host
+#
+# watches every value of type HistogramValue, eg ap.timing.pilot or
+# nmea.poll_time, and renders them in the prometheus text format at
+# http://localhost:23323/metrics so a collector can trend p50, p99 and
+# maximum times over a passage
+
+import sys, os, socket
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import gettext_loader
+from client import pypilotClient
+
+DEFAULT_PORT = 23323
+
+def metric_name(name):
+    return 'pypilot_' + name.replace('.', '_')
+
+# text for the histogram values by name
+def render(histograms):
+    lines = []
+    for name in sorted(histograms):
+        h = histograms[name]
+        metric = metric_name(name)
+        lines.append('# TYPE %s histogram' % metric)
+        count = 0
+        for bucket, c in zip(h['buckets'], h['counts']):
+            count += c
+            lines.append('%s_bucket{le="%g"} %d' % (metric, bucket, count))
+        count += h['counts'][-1]
+        lines.append('%s_bucket{le="+Inf"} %d' % (metric, count))
+        lines.append('%s_count %d' % (metric, count))
+        for stat in ['max', 'p50', 'p99']:
+            if stat in h:
+                lines.append('%s_%s %g' % (metric, stat, h[stat]))
+    return '\n'.join(lines) + '\n'
+
+class MetricsServer(object):
+    def __init__(self, host=False, port=DEFAULT_PORT):
+        self.client = pypilotClient(host)
+        self.histograms = {}
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', port))
+        self.server.listen(5)
+        self.server.settimeout(0)
+
+    # watch histograms when the list of values changes
+    def update_watches(self):
+        values = self.client.list_values()
+        if not values:
+            return
+        for name, info in values.items():
+            if info['type'] == 'HistogramValue':
+                self.client.watch(name)
+        for name in list(self.histograms):
+            if not name in values:
+                del self.histograms[name]
+
+    def poll(self, timeout=.1):
+        self.update_watches()
+        self.client.poll(timeout)
+        self.histograms.update(self.client.receive())
+        if not self.client.connection:
+            self.histograms = {}
+
+        while True:
+            try:
+                connection, address = self.server.accept()
+            except (BlockingIOError, socket.timeout):
+                break
+            self.respond(connection)
+
+    def respond(self, connection):
+        connection.settimeout(1)
+        try:
+            request = connection.recv(1024).decode()
+            path = request.split(' ')[1] if ' ' in request else ''
+            if path == '/metrics':
+                status, body = '200 OK', render(self.histograms)
+            else:
+                status, body = '404 Not Found', 'metrics are at /metrics\n'
+            body = body.encode()
+            header = 'HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n' % (status, len(body))
+            connection.sendall(header.encode() + body)
+        except Exception as e:
+            print(_('failed to send metrics'), e)
+        connection.close()
+
+def main():
+    host = False
+    if len(sys.argv) > 1:
+        host = sys.argv[1]
+    server = MetricsServer(host)
+    print(_('serving metrics at'), 'http://localhost:%d/metrics' % DEFAULT_PORT)
+    while True:
+        server.poll()
+
+if __name__ == '__main__':
+    main()
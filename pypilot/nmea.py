@@ -22,7 +22,7 @@
 
 DEFAULT_PORT = 20220
 
-import sys, select, time, socket
+import sys, select, time, socket, functools, operator
 
 import multiprocessing
 import serial
@@ -39,15 +39,19 @@ TIOCEXCL = 0x540C
 
 # nmea uses a simple xor checksum
 def nmea_cksum(msg):
-    value = 0
-    for c in msg: # skip over the $ at the begining of the sentence
-        value ^= ord(c)
-    return value & 255
+    if type(msg) == type(''):
+        msg = msg.encode()
+    return functools.reduce(operator.xor, msg, 0)
 
+# line may be str or bytes, the checksum covers between $ and *
 def check_nmea_cksum(line):
-    cksplit = line.split('*')
+    if type(line) == type(''):
+        line = line.encode()
+    i = line.find(b'*')
+    if i < 0:
+        return False
     try:
-        return nmea_cksum(cksplit[0][1:]) == int(cksplit[1], 16)
+        return nmea_cksum(line[1:i]) == int(line[i+1:i+3], 16)
     except:
         return False
 
@@ -69,8 +73,8 @@ def parse_nmea_gps(line):
         gps = {}
 
         try: # since we are given only time and not date, use current day
-            x = time.strptime(data[0], '%H%M%S.%f')
-            ts = (x.tm_hour*60+x.tm_min)*60+x.tm_sec
+            hms = data[0]
+            ts = (int(hms[0:2])*60+int(hms[2:4]))*60+int(hms[4:6])
             t0 = time.time()
             global gps_timeoffset
             ts += gps_timeoffset # seconds since 1970
@@ -132,7 +136,7 @@ def parse_nmea_wind(line):
     if line[3:6] != 'MWV':
         return False
 
-    data = line.split(',')
+    data = line.split(',', 5) # only need first 4 fields
     msg = {}
     try:
         msg['direction'] = float(data[1])
@@ -157,7 +161,7 @@ def parse_nmea_rudder(line):
     if line[3:6] != 'RSA':
         return False
 
-    data = line.split(',')
+    data = line.split(',', 2)
     try:
         angle = float(data[1])
     except:
@@ -248,7 +252,7 @@ def parse_nmea_water(line):
     if line[3:6] == 'VHW':
         try:
             # for now only use the knots field
-            data = line.split(',')
+            data = line.split(',', 6)
             speed = float(data[5])
             return 'water', {'speed': speed}
         except Exception as e:
@@ -257,7 +261,7 @@ def parse_nmea_water(line):
     elif line[3:6] == 'LWY':
         try:
             # for now only use the knots field
-            data = line.split(',')
+            data = line[:-3].split(',', 3) # exclude checksum
             if data[1] == 'A':
                 leeway = float(data[2])
                 return 'water', {'leeway': leeway}
@@ -268,6 +272,14 @@ def parse_nmea_water(line):
 
 nmea_parsers = {'gps': parse_nmea_gps, 'wind': parse_nmea_wind, 'rudder': parse_nmea_rudder, 'apb': parse_nmea_apb, 'water': parse_nmea_water}
 
+# sentence type to sensor name and parser, so only one parser runs per line
+nmea_sentences = {'RMC': 'gps', 'MWV': 'wind', 'RSA': 'rudder', 'APB': 'apb', 'VHW': 'water', 'LWY': 'water'}
+for sentence, name in nmea_sentences.items():
+    nmea_sentences[sentence] = name, nmea_parsers[name]
+
+# sentences from serial not relayed to tcp since they are output after calibration
+nmea_relay_blacklist = ['MWV', 'RSA', 'APB']
+
 from pypilot.linebuffer import linebuffer
 class NMEASerialDevice(object):
     def __init__(self, path):
@@ -283,6 +295,29 @@ class NMEASerialDevice(object):
     def close(self):
         self.device.close()
 
+# run in a probe worker, wait for a valid nmea sentence from the device
+def probe_nmea_device(path, timeout=5):
+    try:
+        device = NMEASerialDevice(path)
+    except Exception as e: # serial.serialutil.SerialException:
+        print(_('failed to open'), path, 'for nmea data', e)
+        return False
+
+    poller = select.poll()
+    poller.register(device.device.fileno(), select.POLLIN)
+    end = time.monotonic() + timeout
+    while True:
+        dt = end - time.monotonic()
+        if dt <= 0:
+            break
+        events = poller.poll(int(dt*1000) + 1)
+        if events and events[0][1] != select.POLLIN:
+            break # device removed
+        if device.readline():
+            return device
+    device.close()
+    return False
+
 nmeasocketuid = 0
 class NMEASocket(LineBufferedNonBlockingSocket):
     def __init__(self, connection, address):
@@ -328,8 +363,11 @@ class Nmea(object):
 
         self.devices = []
         self.devices_lastmsg = {}
-        self.probedevice = None
-        self.probeindex = 0
+        self.probe_pool = serialprobe.ProbePool()
+        self.probe_names = []
+
+        # only sampled while watched
+        self.poll_time = self.client.register(HistogramValue('nmea.poll_time', hdr_buckets(.0001, 1)))
 
         self.start_time = time.monotonic()
 
@@ -365,11 +403,9 @@ class Nmea(object):
             nmea_name = line[:6]
             # we output mwv and rsa messages after calibration
             # do not relay apb messages
-            blacklist = ['MWV', 'RSA', 'APB']
-            if self.sensors.gps.filtered.output.value:  # pass gps through, or use filtered gps depends on setting
-                blacklist.append('RMC')
-            
-            if not nmea_name[3:] in blacklist:
+            # pass gps through, or use filtered gps depends on setting
+            if not nmea_name[3:] in nmea_relay_blacklist and \
+               not (nmea_name[3:] == 'RMC' and self.sensors.gps.filtered.output.value):
                 # do not output nmea data over tcp faster than 4hz
                 # for each message type
                 # forward nmea lines from serial to tcp
@@ -379,34 +415,35 @@ class Nmea(object):
                     self.nmea_times[nmea_name] = t
 
         self.devices_lastmsg[device] = t
-        parsers = []
+        sentence = nmea_sentences.get(line[3:6])
+        if not sentence:
+            return
+        name, parser = sentence
 
         # only process if
         # 1) current source is lower priority
         # 2) we do not have a source yet
         # 3) this the correct device for this data
-        for name in nmea_parsers:
-            name_device = self.sensors.sensors[name].device
-            current_source = self.sensors.sensors[name].source.value
-            if source_priority[current_source] > source_priority['serial'] or \
-               not name_device or name_device[2:] == device.path[0]:
-                parsers.append(nmea_parsers[name])
+        sensor = self.sensors.sensors[name]
+        name_device = sensor.device
+        if source_priority[sensor.source.value] <= source_priority['serial'] and \
+           name_device and name_device[2:] != device.path[0]:
+            return
 
         # parse the nmea line, and update serial messages
-        for parser in parsers:
-            result = parser(line)
-            if result:
-                name, msg = result
-                if name:
-                    msg['device'] = line[1:3] + device.path[0]
-                    serial_msgs[name] = msg
-                break
+        result = parser(line)
+        if result:
+            name, msg = result
+            if name:
+                msg['device'] = line[1:3] + device.path[0]
+                serial_msgs[name] = msg
 
     def remove_serial_device(self, device):
         index = self.devices.index(device)
         print(_('lost serial') + ' nmea%d' % index)
         self.sensors.lostdevice(self.devices[index].path[0])
         self.devices[index] = False
+        serialprobe.relinquish('nmea%d' % index)
         self.poller.unregister(device.device.fileno())
         del self.devices_lastmsg[device]
         device.close()
@@ -497,50 +534,44 @@ class Nmea(object):
             self.nmea_bridge.poll()
         
         t6 = time.monotonic()
+        if self.poll_time.watch:
+            self.poll_time.add(t6-t0, t6)
         if t6 - t0 > .05 and t0-self.start_time > 10: # report times if processing takes more than 0.05 seconds
             times = map(lambda t : round_value(t, '%.3f'), [t6-self.start_time, t1-t0, t2-t1, t3-t2, t4-t3, t5-t4, t6-t5, t6-t0])
             print('nmea poll times', *times)
             
     def probe_serial(self):
-        # probe new nmea data devices
-        if not self.probedevice:
-            try:
-                index = self.devices.index(False)
-            except:
-                index = len(self.devices)
-            if self.probeindex != index and \
-               (self.probeindex >= len(self.devices) or not self.devices[self.probeindex]):
-                serialprobe.relinquish('nmea%d' % self.probeindex)
-            self.probeindex = index
-
-            self.probedevicepath = serialprobe.probe('nmea%d' % self.probeindex, [38400, 4800], 8)
-            if self.probedevicepath:
-                print('nmea probe', self.probedevicepath)
-                try:
-                    self.probedevice = NMEASerialDevice(self.probedevicepath)
-                    self.probetime = time.monotonic()
-                except Exception as e: # serial.serialutil.SerialException:
-                    print(_('failed to open'), self.probedevicepath, 'for nmea data', e)
-
-            return
-
-        # see if the probe device gets a valid nmea message
-        if self.probedevice.readline():
-            #print('nmea new device', self.probedevicepath)
-            serialprobe.success('nmea%d' % self.probeindex, self.probedevicepath)
-            if self.probeindex < len(self.devices):
-                self.devices[self.probeindex] = self.probedevice
-            else:
-                self.devices.append(self.probedevice)
-            fd = self.probedevice.device.fileno()
-            self.device_fd[fd] = self.probedevice
+        for name, path, device in self.probe_pool.results():
+            print('nmea probe', path)
+            index = int(name[4:])
+            while len(self.devices) <= index:
+                self.devices.append(False)
+            self.devices[index] = device
+            fd = device.device.fileno()
+            self.device_fd[fd] = device
             self.poller.register(fd, select.POLLIN)
-            self.devices_lastmsg[self.probedevice] = time.monotonic()
-            self.probedevice = None
-        elif time.monotonic() - self.probetime > 5:
-            #print('nmea serial probe timeout', self.probeindex, index, self.probedevicepath)
-            self.probedevice = None # timeout
+            self.devices_lastmsg[device] = time.monotonic()
+
+        # probe new nmea data devices for the first free indexes at once
+        names, used, index = [], [], 0
+        while len(names) < serialprobe.max_probes:
+            name = 'nmea%d' % index
+            if index >= len(self.devices) or not self.devices[index]:
+                names.append(name)
+            else:
+                used.append(name)
+            index += 1
+
+        for name in self.probe_names:
+            if not name in names:
+                if name in self.probe_pool.probes:
+                    names.append(name) # relinquish once finished
+                elif not name in used:
+                    serialprobe.relinquish(name)
+        self.probe_names = names
 
+        for name in names[:serialprobe.max_probes]:
+            self.probe_pool.probe(name, [38400, 4800], 8, probe_nmea_device)
 
     def send_nmea(self, msg):
         self.pipe.send(msg)
@@ -624,7 +655,6 @@ class nmeaBridge(object):
 
     def receive_nmea(self, line, sock):
         device = 'socket' + str(sock.uid)
-        parsers = []
 
         # if we receive a "special" pypilot nmea message from this
         # socket, then mark it to rebroadcast to other nmea sockets
@@ -641,18 +671,18 @@ class nmeaBridge(object):
         # optimization to only to parse sentences here that would be discarded
         # in the main process anyway because they are already handled by a source
         # with a higher priority than tcp
-        tcp_priority = source_priority['tcp']
-        for name in nmea_parsers:
-            if source_priority[self.last_values[name + '.source']] >= tcp_priority:
-                parsers.append(nmea_parsers[name])
-
-        for parser in  parsers:
-            result = parser(line)
-            if result:
-                name, msg = result
-                msg['device'] = line[1:3] + device
-                self.msgs[name] = msg
-                return
+        sentence = nmea_sentences.get(line[3:6])
+        if not sentence:
+            return
+        name, parser = sentence
+        if source_priority[self.last_values[name + '.source']] < source_priority['tcp']:
+            return
+
+        result = parser(line)
+        if result:
+            name, msg = result
+            msg['device'] = line[1:3] + device
+            self.msgs[name] = msg
 
     def new_socket_connection(self, connection, address):
         #print('nmea new socket connection', connection, address)
@@ -907,3 +937,53 @@ class nmeaBridge(object):
 
         if t6-t1 > .1:
             print(_('nmea process loop too slow:'), t1-t0, t2-t1, t3-t2, t4-t3, t5-t4, t6-t5)
+
+# measure sentences per second parsing a recorded nmea log given as argument
+# or a generated mix of ais, gps and wind sentences
+def benchmark(path=False):
+    if path:
+        with open(path, 'rb') as f:
+            lines = [l.rstrip().decode(errors='ignore') for l in f if l.strip()]
+    else:
+        def sentence(msg):
+            return '$' + msg + ('*%02X' % nmea_cksum(msg))
+        mix = [sentence('GPRMC,123519.00,A,4807.038,N,01131.000,E,022.4,084.4,230394,003.1,W'),
+               sentence('GPGGA,123519.00,4807.038,N,01131.000,E,1,08,0.9,545.4,M,46.9,M,,'),
+               sentence('GPGSV,3,1,11,03,03,111,00,04,15,270,00,06,01,010,00,13,06,292,00'),
+               sentence('WIMWV,214.8,R,10.1,N,A'), sentence('WIMWV,200.2,T,8.7,N,A'),
+               sentence('IIVHW,,T,,M,5.6,N,10.4,K'), sentence('IIDBT,36.4,f,11.1,M,6.0,F'),
+               sentence('ERRSA,-3.4,A,,')]
+        ais = '!' + sentence('AIVDM,1,1,,A,13aEOK?P00PD2wVMdLDRhgvL289?,0')[1:]
+        lines = (mix + [ais]*4)*2000
+
+    parsers = list(nmea_parsers.values())
+    def parse_each(line): # previous approach, try every parser in turn
+        if check_nmea_cksum(line):
+            for parser in parsers:
+                if parser(line):
+                    break
+
+    def parse_dispatch(line):
+        if check_nmea_cksum(line):
+            sentence = nmea_sentences.get(line[3:6])
+            if sentence:
+                sentence[1](line)
+
+    def old_cksum(line): # previous check_nmea_cksum
+        cksplit = line.split('*')
+        value = 0
+        for c in cksplit[0][1:]:
+            value ^= ord(c)
+        return value == int(cksplit[1], 16)
+
+    print('%d sentences' % len(lines))
+    for name, f in [('checksum per char', old_cksum), ('checksum', check_nmea_cksum),
+                    ('parse every parser', parse_each), ('parse dispatch', parse_dispatch)]:
+        t0 = time.monotonic()
+        for line in lines:
+            f(line)
+        t = time.monotonic() - t0
+        print('%-20s %9.0f sentences/s' % (name, len(lines) / t))
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else False)
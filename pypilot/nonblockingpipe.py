@@ -155,7 +155,9 @@ class PipeNonBlockingPipeEnd(object):
             if not self.sendfailok:
                 print(_('failed write'), self.name)
         t0 = time.time()
-        os.write(self.w, data.encode())
+        if type(data) == str:
+            data = data.encode()
+        os.write(self.w, data)
         t1 = time.time()
         if t1-t0 > .04:
             print('too long write pipe', t1-t0, self.name, len(data))
@@ -200,7 +202,10 @@ class NoMPLineBufferedPipeEnd(object):
         pass
 
     def write(self, data, udp=False):
-        self.send(data)
+        if type(data) == bytes:
+            data = data.decode()
+        for line in data.splitlines(True): # may be several lines like a stream
+            self.send(line)
     
     def recv(self, timeout=0):
         return self.readline()
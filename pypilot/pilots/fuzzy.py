@@ -8,6 +8,7 @@
 # version 3 of the License, or (at your option) any later version.  
 
 import math
+import numpy
 
 from pilot import AutopilotPilot
 #from pypilot.resolv import resolv
@@ -15,97 +16,222 @@ from pypilot.values import *
 from pypilot import vector
 disabled = True
 
-matrixfilepath = os.getenv('HOME') + '/.pypilot/' + 'fuzzy.json'
-
-def fuzzy_defaults(dimensions, c=0):
-    if dimensions:
-        ret = {'N/A': fuzzy_defaults(dimensions[1:])}
-        dimension = dimensions[0]
-        name, value, step = dimension
-        if name == 'heading error':
-            for i in range(-5, 5):
-                v = i*step
-                ret[i] = fuzzy_defaults(dimensions[1:], v*.003 + c)
-        elif name == 'heading rate':
-            for i in range(-5, 5):
-                v = i*step
-                ret[i] = fuzzy_defaults(dimensions[1:], v*.09 + c)
-        return ret
-    return c
-
-def fuzzy_matrix(index, matrix):
+matrixfilepath = os.getenv('HOME') + '/.pypilot/' + 'fuzzy.matrix'
+
+header_size = 4096 # block count and dimensions before the blocks
+not_available = -32768 # index when the sensor has no data
+
+def fuzzy_default(name, index, step):
+    v = min(max(index, -5), 4)*step
+    if name == 'heading error':
+        return v*.003
+    if name == 'heading rate':
+        return v*.09
+    return 0
+
+# correction for each state of the boat
+#
+# a dense array over all dimensions is far too large, so the states of
+# all but the last two dimensions (the context) select a block, which is
+# a dense array over heading error and heading rate with an extra slot
+# where the sensor is not available.  Blocks only exist for contexts that
+# were trained, otherwise each index works toward 0 and then to not
+# available like the nested dictionaries used previously.  The blocks
+# are kept in a memory mapped file.
+class FuzzyMatrix(object):
+    def __init__(self, dimensions, path):
+        self.dimensions = dimensions
+        self.context = dimensions[:-2]
+        self.inner = dimensions[-2:]
+        self.shape = [hi - lo + 2 for name, sensor, step, lo, hi in self.inner]
+        self.dtype = numpy.dtype([('key', '<i2', (len(self.context),)),
+                                  ('cells', '<f4', (self.shape[0]*self.shape[1],))])
+        self.signature = pyjson.dumps([[name, step, lo, hi] for name, sensor, step, lo, hi in dimensions])
+        self.path = path
+        self.map = False
+        self.corner_bits = {}
+        try:
+            self.load()
+        except Exception as e:
+            print('failed to load fuzzy data', e)
+            self.create()
+
+    def open(self, capacity):
+        with open(self.path, 'r+b') as f:
+            f.truncate(header_size + capacity*self.dtype.itemsize)
+        self.map = numpy.memmap(self.path, numpy.uint8, 'r+')
+        self.count = self.map[:8].view('<i8')
+        self.records = self.map[header_size:].view(numpy.ndarray).view(self.dtype)
+        self.cells = self.records['cells']
+
+    def create(self):
+        header = numpy.zeros(header_size, numpy.uint8)
+        signature = self.signature.encode()
+        header[8:8+len(signature)] = numpy.frombuffer(signature, numpy.uint8)
+        with open(self.path, 'wb') as f:
+            f.write(header.tobytes())
+        self.open(64)
+
+        defaults = numpy.zeros(self.shape)
+        for d, (name, sensor, step, lo, hi) in enumerate(self.inner):
+            axis = [fuzzy_default(name, i, step) for i in range(lo, hi+1)] + [0]
+            defaults += numpy.reshape(axis, [-1, 1] if d == 0 else [1, -1])
+        self.keys, self.prefixes = {}, [set() for d in self.context]
+        self.corners_cache = {}
+        self.count[0] = 0
+        self.add((not_available,)*len(self.context), defaults.ravel())
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            header = f.read(header_size)
+        signature = header[8:].rstrip(b'\0').decode()
+        if signature != self.signature:
+            raise Exception('dimensions changed')
+        self.open(max((os.path.getsize(self.path) - header_size) // self.dtype.itemsize, 1))
+        self.keys, self.prefixes = {}, [set() for d in self.context]
+        self.corners_cache = {}
+        for i in range(int(self.count[0])):
+            self.index(tuple(map(int, self.records['key'][i])), i)
+        if not self.keys:
+            raise Exception('no data')
+
+    def store(self):
+        self.map.flush()
+
+    def index(self, key, block):
+        self.keys[key] = block
+        self.corners_cache = {}
+        for d in range(len(key)):
+            self.prefixes[d].add(key[:d+1])
+
+    def add(self, key, cells):
+        count = int(self.count[0])
+        if count == len(self.records):
+            self.map.flush()
+            self.open(2*count)
+        self.records['key'][count] = key
+        self.cells[count] = cells
+        self.count[0] = count + 1
+        self.index(key, count)
+        return count
+
     # work index toward 0 when data deficient
-    while not index in matrix:
-        if index < 0:
-            index += 1
-        elif index > 0:
-            index -= 1
-        else:
-            index = 'N/A' # fallback to data not available
-    return matrix[index]
-
-def fuzzy_compute(di, dimensions, matrix):
-    if di == len(dimensions):
-        return matrix
-        
-    dimension = dimensions[di]
-    name, sensor, step = dimension
-    value = sensor.value
-    if value is False:
-        return fuzzy_compute(di+1, dimensions, matrix['N/A'])
-
-    index = value / step
-    indexl = math.floor(index)
-    indexh = indexl + 1
-
-    matrixl = fuzzy_matrix(indexl, matrix)
-    matrixh = fuzzy_matrix(indexh, matrix)
-
-    # recursively compute weighted average over all dimensions
-    l = fuzzy_compute(di+1, dimensions, matrixl)
-
-    if matrixl is matrixh: # optimization
-        return l
-    h = fuzzy_compute(di+1, dimensions, matrixh)
-
-    d = index - indexl
-    return (1-d)*l + d*h
-
-def fuzzy_get(matrix, indicies):
-    if not indicies:
-        return matrix
-    return fuzzy_get(fuzzy_matrix(indicies[0], matrix), indicies[1:])
-
-def fuzzy_set(matrix, indicies, update):
-    if len(indicies) == 1:
-        matrix[indicies[0]] = update
-    else:
-        if not indicies[0] in matrix:
-            matrix[indicies[0]] = matrix['N/A'].copy()
-        fuzzy_set(matrix[indicies[0]], indicies[1:], update)
-
-def fuzzy_train(dimensions, matrix, state, error):
-    # determine indicies in matrix for this state
-    indicies = []
-    for i in range(len(state)):
-        dimension = dimensions[i]
-        value = state[i]
-        name, sensor, step = dimension
-        if value is False:
-            index = 'N/A'
-        else:
-            index = round(value / step)
-        indicies.append(index)
-
-    current = fuzzy_get(matrix, indicies) # get current correction
-
-    d = .002 #learning rate
-    update = current + d*error # add error
-    update = min(max(update, -1), 1) # bound to range
-
-    #print('fuzzy train', state, error, current, update)
-
-    fuzzy_set(matrix, indicies, update)   # update correction in matrix
+    def resolve(self, prefix, index, d):
+        if index != not_available:
+            name, sensor, step, lo, hi = self.context[d]
+            index = min(max(index, lo), hi)
+            prefixes = self.prefixes[d]
+            while index and not prefix + (index,) in prefixes:
+                index += 1 if index < 0 else -1
+            if prefix + (index,) in prefixes:
+                return prefix + (index,)
+        return prefix + (not_available,) # fallback to data not available
+
+    def block(self, indicies):
+        key = ()
+        for d, index in enumerate(indicies):
+            key = self.resolve(key, index, d)
+        return self.keys[key]
+
+    def cell(self, indicies):
+        cell = 0
+        for (name, sensor, step, lo, hi), size, index in zip(self.inner, self.shape, indicies):
+            index = size-1 if index == not_available else min(max(index, lo), hi) - lo
+            cell = cell*size + index
+        return cell
+
+    # blocks used by each corner of the context cell at these indicies
+    def corners(self, indicies):
+        if indicies in self.corners_cache:
+            return self.corners_cache[indicies]
+        if len(self.corners_cache) > 1024:
+            self.corners_cache = {}
+
+        groups = {(): [0]} # corners using each key
+        for d, index in enumerate(indicies):
+            resolved = {}
+            for key, corners in groups.items():
+                if index == not_available:
+                    resolved.setdefault(self.resolve(key, index, d), []).extend(corners)
+                    continue
+                for bit in range(2):
+                    k = self.resolve(key, index + bit, d)
+                    resolved.setdefault(k, []).extend(2*c + bit for c in corners)
+            groups = resolved
+        blocks = numpy.array([self.keys[key] for key in groups])
+        bits = sum(index != not_available for index in indicies)
+        selector = numpy.zeros((len(groups), 1 << bits))
+        for i, corners in enumerate(groups.values()):
+            selector[i, corners] = 1
+        self.corners_cache[indicies] = corners = blocks, selector
+        return corners
+
+    # weighted average of the corners around the current sensor values
+    def compute(self):
+        indicies, fractions = [], []
+        for name, sensor, step, lo, hi in self.context:
+            value = sensor.value
+            if value is False:
+                indicies.append(not_available)
+            else:
+                index = value / step
+                indexl = math.floor(index)
+                indicies.append(indexl)
+                fractions.append(index - indexl)
+        blocks, selector = self.corners(tuple(indicies))
+
+        # weight of each corner from the bits of its number
+        bits = len(fractions)
+        if not bits in self.corner_bits:
+            corner = numpy.arange(1 << bits)[:, None]
+            self.corner_bits[bits] = (corner >> numpy.arange(bits-1, -1, -1)) & 1 == 1
+        fractions = numpy.array(fractions)
+        weights = numpy.prod(numpy.where(self.corner_bits[bits], fractions, 1-fractions), axis=1)
+
+        cells, cell_weights = [0], [1]
+        for (name, sensor, step, lo, hi), size in zip(self.inner, self.shape):
+            value = sensor.value
+            if value is False:
+                corners = [(size-1, 1)]
+            else:
+                index = value / step
+                indexl = math.floor(index)
+                d = index - indexl
+                corners = [(min(max(indexl, lo), hi) - lo, 1-d),
+                           (min(max(indexl+1, lo), hi) - lo, d)]
+            cells = [c*size + i for c in cells for i, w in corners]
+            cell_weights = [cw*w for cw in cell_weights for i, w in corners]
+
+        # gather the cells from every block at once
+        values = self.cells[blocks[:, None], numpy.array(cells)[None, :]]
+        return float(numpy.dot(numpy.dot(selector, weights), numpy.dot(values, cell_weights)))
+
+    def train(self, state, error):
+        # determine indicies in matrix for this state
+        indicies = []
+        for (name, sensor, step, lo, hi), value in zip(self.dimensions, state):
+            if value is False:
+                indicies.append(not_available)
+            else:
+                indicies.append(min(max(round(value / step), lo), hi))
+        context = tuple(indicies[:len(self.context)])
+        cell = self.cell(indicies[len(self.context):])
+
+        block = self.block(context)
+        current = float(self.cells[block, cell]) # get current correction
+
+        d = .002 #learning rate
+        update = current + d*error # add error
+        update = min(max(update, -1), 1) # bound to range
+
+        if not context in self.keys:
+            # new contexts start from the data not available below each index
+            for i in range(len(context)):
+                key = context[:i+1] + (not_available,)*(len(context)-i-1)
+                if not key in self.keys:
+                    self.add(key, self.cells[self.block(key)])
+            block = self.keys[context]
+        self.cells[block, cell] = update # update correction in matrix
 
 class FuzzyPilot(AutopilotPilot):
     def __init__(self, ap):
@@ -124,36 +250,26 @@ class FuzzyPilot(AutopilotPilot):
         self.history = []
         self.history_time = 0
 
-        self.dimensions = [('ground speed', ap.sensors.gps.speed, 2),
-                           ('wind speed', ap.sensors.wind.speed, 5),
-                           ('wind direction', ap.sensors.wind.direction, 10),
-                           ('rudder angle', ap.sensors.rudder.angle, 5),
-                           ('heel', ap.boatimu.SensorValues['heel'], 5),
-                           ('sea state', self.seastate, .1),
-                           ('heading error', ap.heading_error, 3),
-                           ('heading rate', ap.boatimu.SensorValues['headingrate_lowpass'], 2)]
+        # name, sensor, step, lowest and highest index
+        self.dimensions = [('ground speed', ap.sensors.gps.speed, 2, 0, 10),
+                           ('wind speed', ap.sensors.wind.speed, 5, 0, 12),
+                           ('wind direction', ap.sensors.wind.direction, 10, -18, 18),
+                           ('rudder angle', ap.sensors.rudder.angle, 5, -8, 8),
+                           ('heel', ap.boatimu.SensorValues['heel'], 5, -9, 9),
+                           ('sea state', self.seastate, .1, 0, 40),
+                           ('heading error', ap.heading_error, 3, -10, 10),
+                           ('heading rate', ap.boatimu.SensorValues['headingrate_lowpass'], 2, -10, 10)]
 
         # will eventually need matrix for each mode
-        self.matrix = fuzzy_defaults(self.dimensions)
-        self.load()
+        self.matrix = FuzzyMatrix(self.dimensions, matrixfilepath)
         self.matrix_time = 0
 
     def store(self):
         try:
-            f = open(matrixfilepath, 'w')
-            f.write(pyjson.dumps(self.matrix))
-            f.close()
+            self.matrix.store()
         except Exception as e:
             print('failed to store fuzzy data', e)
 
-    def load(self):
-        try:
-            f = open(matrixfilepath)
-            self.matrix = pyjson.loads(f.read())
-            f.close()
-        except Exception as e:
-            print('failed to load fuzzy data', e)
-            
     def process(self):
         t0 = time.monotonic()
         ap = self.ap
@@ -169,7 +285,7 @@ class FuzzyPilot(AutopilotPilot):
 
         t1 = time.monotonic()
         # compute fuzzy command from matrix and command servo
-        command = fuzzy_compute(0, self.dimensions, self.matrix)
+        command = self.matrix.compute()
         t2 = time.monotonic()
         ap.servo.command.command(command)
         t3 = time.monotonic()
@@ -190,7 +306,7 @@ class FuzzyPilot(AutopilotPilot):
         if len(self.history) == self.history_count:
             prev, self.history = self.history[0], self.history[1:]
             prev_state, prev_error = prev
-            fuzzy_train(self.dimensions, self.matrix, prev_state, error)
+            self.matrix.train(prev_state, error)
             t5 = time.monotonic()
 
             if t - self.matrix_time > 600:
@@ -200,3 +316,43 @@ class FuzzyPilot(AutopilotPilot):
 
 
 pilot = FuzzyPilot
+
+if __name__ == '__main__':
+    # train with random states and measure the time to compute and train
+    import random, tempfile
+    class sensor(object):
+        def __init__(self):
+            self.value = False
+    dimensions = [('ground speed', sensor(), 2, 0, 10),
+                  ('wind speed', sensor(), 5, 0, 12),
+                  ('wind direction', sensor(), 10, -18, 18),
+                  ('rudder angle', sensor(), 5, -8, 8),
+                  ('heel', sensor(), 5, -9, 9),
+                  ('sea state', sensor(), .1, 0, 40),
+                  ('heading error', sensor(), 3, -10, 10),
+                  ('heading rate', sensor(), 2, -10, 10)]
+    # the boat state wanders slowly, heading error and rate change quickly
+    ranges = [(0, 8), (0, 25), (-180, 180), (-30, 30), (-20, 20), (.9, 1.5), (-20, 20), (-10, 10)]
+    steps = [.05, .1, 1, 1, .5, .005, 4, 2]
+    state = [(l + h)/2 for l, h in ranges]
+    path = os.path.join(tempfile.mkdtemp(), 'fuzzy.matrix')
+    matrix = FuzzyMatrix(dimensions, path)
+    random.seed(1)
+    count = 20000
+    compute_time = train_time = 0
+    for i in range(count):
+        state = [min(max(v + random.uniform(-s, s), l), h) for v, s, (l, h) in zip(state, steps, ranges)]
+        for (name, s, step, lo, hi), value in zip(dimensions, state):
+            s.value = value
+        t0 = time.monotonic()
+        command = matrix.compute()
+        t1 = time.monotonic()
+        matrix.train(state, random.uniform(-1, 1))
+        t2 = time.monotonic()
+        compute_time += t1 - t0
+        train_time += t2 - t1
+    matrix.store()
+    print('blocks', int(matrix.count[0]), 'file size', os.path.getsize(path))
+    print('compute %.1f us, train %.1f us' % (1e6*compute_time/count, 1e6*train_time/count))
+    loaded = FuzzyMatrix(dimensions, path)
+    print('reloaded command', loaded.compute(), 'matches', loaded.compute() == matrix.compute())
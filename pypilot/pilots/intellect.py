@@ -7,8 +7,10 @@
 # License as published by the Free Software Foundation; either
 # version 3 of the License, or (at your option) any later version.  
 
-import os, sys, time, math, json
+import os, sys, time, math, json, glob
+import multiprocessing, concurrent.futures
 import lzma
+import numpy
 from pypilot.client import pypilotClient
 
 
@@ -159,83 +161,252 @@ class stopwatch(object):
       return self.total + time.monotonic() - self.starttime
 
 
+# normalize sensor inputs to -1 to 1 range with tanh(scale*value)
+sensor_scale = {'imu.accel' : 1,
+                'imu.gyro' : .1,
+                'imu.headingrate' : .1,
+                'servo.current': 1,
+                'servo.command': 1,
+                'ap.heading_error': .2,
+                'imu.headingrate_lowpass': .1}
+
+# rolling window of normalized samples, one row per sample
 class History(object):
     def __init__(self, conf, state, future=False):
-        future = self.conf['future'] if future else 0
-        dt = (self.conf['past']+future)*self.state['imu.rate']
+        future = conf['future'] if future else 0
+        dt = (conf['past']+future)*state['imu.rate']
         self.samples = int(math.ceil(dt))
-        self.data = []
+        self.names = [] # in column order
+        for name in conf['sensors'] + conf.get('actions', []) + conf.get('predictions', []):
+            if not name in self.names:
+                self.names.append(name)
+        self.buffer = False
+        self.selections = {}
+        self.clear()
+
+    # columns are sized from the first sample
+    def allocate(self, data):
+        self.columns, scale = {}, []
+        for name in self.names:
+            width = len(data[name]) if type(data[name]) == type([]) else 1
+            self.columns[name] = slice(len(scale), len(scale) + width)
+            scale += [sensor_scale[name]]*width
+        self.scale = numpy.array(scale, numpy.float32)
+        # each sample is written twice so the window is always contiguous
+        self.buffer = numpy.zeros((2*self.samples, len(scale)), numpy.float32)
 
     def put(self, data):
-        if self.full():
-            self.data = self.data[1:]
-        self.data.append(data)
+        if self.buffer is False:
+            self.allocate(data)
+        i = self.position
+        row = self.buffer[i]
+        for name, columns in self.columns.items():
+            row[columns] = data[name]
+        row *= self.scale
+        numpy.tanh(row, out=row)
+        self.buffer[i + self.samples] = row
+        self.position = (i + 1) % self.samples
+        self.count = min(self.count + 1, self.samples)
 
     def clear(self):
-        self.data = []
+        self.position = self.count = 0
 
     def full(self):
-        return len(self.data) == self.samples
-
-
-def inputs(history, names):
-    def select(values, names):
-        data = []
-        for name in values:
-            if not name in names:
+        return self.count == self.samples
+
+    # samples oldest first
+    def window(self):
+        return self.buffer[self.position:self.position + self.samples]
+
+    def width(self, names):
+        return len(self.selection(names))
+
+    def selection(self, names):
+        key = tuple(names)
+        if not key in self.selections:
+            self.selections[key] = numpy.concatenate([numpy.arange(self.columns[name].start, self.columns[name].stop)
+                                                      for name in self.names if name in names])
+        return self.selections[key]
+
+    # write the named columns of samples begin to end flattened into out
+    def select(self, names, begin, end, out):
+        columns = self.selection(names)
+        numpy.take(self.window()[begin:end], columns, axis=1,
+                   out=out.reshape(end - begin, len(columns)))
+
+# training samples written directly into memory mapped shards
+# of inputs followed by outputs, streamed back for fitting
+class Dataset(object):
+    def __init__(self, path, inputs, outputs, shard_size=6000, max_shards=8, shards=False):
+        self.path = path
+        self.inputs = inputs
+        self.shape = shard_size, inputs + outputs
+        self.max_shards = max_shards
+        self.training = set() # shards read by a running fit
+        self.expired = [] # shards removed once no fit reads them
+        if shards is not False: # given the shards to fit
+            self.shards = shards
+            return
+        self.shards = [] # filenames of complete shards
+        for filename in sorted(glob.glob(path + '*.npy')):
+            try:
+                if numpy.load(filename, mmap_mode='r').shape == self.shape:
+                    self.shards.append(filename)
+            except Exception as e:
+                print('failed to load training data', filename, e)
+        self.number = int(self.shards[-1][len(path):-4]) + 1 if self.shards else 0
+        self.shard = False
+
+    def filename(self, number):
+        return self.path + '%06d.npy' % number
+
+    # next row to fill
+    def row(self):
+        if self.shard is False:
+            self.shard = numpy.lib.format.open_memmap(self.filename(self.number) + '.tmp', 'w+', numpy.float32, self.shape)
+            self.count = 0
+        return self.shard[self.count]
+
+    # the row is filled, true when a shard was completed
+    def commit(self):
+        self.count += 1
+        if self.count < self.shape[0]:
+            return False
+        self.shard.flush()
+        self.shard = False
+        filename = self.filename(self.number)
+        os.rename(filename + '.tmp', filename)
+        self.shards.append(filename)
+        self.number += 1
+        while len(self.shards) > self.max_shards:
+            self.expired.append(self.shards.pop(0))
+        self.remove_expired()
+        return True
+
+    def remove_expired(self):
+        for filename in self.expired[:]:
+            if filename in self.training:
                 continue
-            value = values[name]
-            if type(value) == type([]):
-                data += value
-            else:
-                data.append(value)
-        return data
-
-    def flatten(values):
-        if type(values) != type([]):
-          return [float(values)]
-        data = []
-        for value in values:
-            data += flatten(value)
-        return data
-    return flatten(list(map(lambda input : select(input, names), history)))
-
-
-
-# normalize a sensor input to -1 to 1 range
-def norm_sensor(name, value):
-    conversions = {'imu.accel' : 1,
-                   'imu.gyro' : .1,
-                   'servo.current': 1,
-                   'servo.command': 1,
-                   'ap.heading_error': .2,
-                   'imu.headingrate_lowpass': .1}
-    c = conversions[name]
-    def norm_value(value):
-        return math.tanh(c*value)
-
-    if type(value) == type([]):
-        return list(map(norm_value, value))
-    return norm_value(value)
+            self.expired.remove(filename)
+            try:
+                os.remove(filename)
+            except Exception as e:
+                print('failed to remove training data', filename, e)
+
+    def batch_count(self, batch_size):
+        return len(self.shards) * math.ceil(self.shape[0] / batch_size)
+
+    # batches do not span shards, only the mapped shard is read
+    def batch(self, i, batch_size):
+        per_shard = math.ceil(self.shape[0] / batch_size)
+        data = numpy.load(self.shards[i // per_shard], mmap_mode='r')
+        start = (i % per_shard) * batch_size
+        data = data[start:start + batch_size]
+        return numpy.array(data[:, :self.inputs]), numpy.array(data[:, self.inputs:])
+
+def build_model(input_size, output_size):
+    import tensorflow as tf
+    input = tf.keras.layers.Input(shape=(input_size,), name='input_layer')
+    #hidden1 = tf.keras.layers.Dense(256, activation='relu')(input)
+    hidden2 = tf.keras.layers.Dense(16, activation='relu')(input)
+    output = tf.keras.layers.Dense(output_size, activation='tanh')(hidden2)
+    model = tf.keras.Model(inputs=input, outputs=output)
+    model.compile(optimizer='adam', loss='mean_squared_error', metrics=['mse'])
+    return model
+
+# run in a training process: fit the model to every shard of the
+# dataset, then save the weights and replace the tflite model used for
+# inference in one rename so it is never seen partly written
+def fit_model(filename, shards, inputs, shape, epochs):
+    import tensorflow as tf
+    dataset = Dataset(False, inputs, shape[1] - inputs, shape[0], shards=shards)
+    batch_size = 256
+    class Batches(tf.keras.utils.Sequence): # stream from the shards on disk
+        def __len__(self):
+            return dataset.batch_count(batch_size)
+        def __getitem__(self, i):
+            return dataset.batch(i, batch_size)
+
+    model = build_model(inputs, shape[1] - inputs)
+    try:
+        model.load_weights(filename + 'model')
+    except:
+        print('failed to load model, starting from new')
+    history = model.fit(Batches(), epochs=epochs, verbose=0)
+    model.save_weights(filename + 'model')
+
+    tflite_model = tf.lite.TFLiteConverter.from_keras_model(model).convert()
+    with open(filename + '.tflite_model.tmp', 'wb') as f:
+        f.write(tflite_model)
+    os.replace(filename + '.tflite_model.tmp', filename + '.tflite_model')
+    return history.history['mse']
+
+def idle_priority():
+    try:
+        os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    except Exception:
+        os.nice(19)
+
+# fit models in separate idle priority processes so the
+# process receiving data is never blocked by training
+class TrainingPool(object):
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.executor = False
+        self.jobs = {} # fits running and their dataset for each model filename
+
+    def fit(self, filename, dataset, epochs=8):
+        if filename in self.jobs:
+            return False # still fitting with older data
+        if not self.executor:
+            # spawn rather than fork, tensorflow does not survive a fork
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, multiprocessing.get_context('spawn'), initializer=idle_priority)
+        # the shards are kept until the fit finishes
+        shards = list(dataset.shards)
+        dataset.training = set(shards)
+        job = self.executor.submit(fit_model, filename, shards, dataset.inputs, dataset.shape, epochs)
+        self.jobs[filename] = job, dataset
+        return True
+
+    # filenames and mse of fits that finished
+    def finished(self):
+        ret = {}
+        for filename, (job, dataset) in list(self.jobs.items()):
+            if not job.done():
+                continue
+            del self.jobs[filename]
+            dataset.training = set()
+            dataset.remove_expired()
+            try:
+                ret[filename] = job.result()
+            except Exception as e:
+                print('training failed', filename, e)
+        return ret
 
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
 
 class Model(object):
     def __init__(self):
         self.history = False
 
     def present(self):
-        return self.conf['state']['imu.rate']*self.conf['past']
+        return int(math.ceil(self.state['imu.rate']*self.conf['past']))
 
     def receive(self, name, value):
         if name in self.conf['sensors'] and self.enabled:
-            self.inputs[name] = norm_sensor(name, value)
+            self.inputs[name] = value # normalized in the history
     
 
 class KerasModel(Model):
     def __init__(self, host):
         super(KerasModel, self).__init__()
         self.host = host
-        self.train_x, self.train_y = [], []
+        self.model = False
+        self.dataset = False
+        self.pool = TrainingPool()
         self.inputs = {}
         self.conf = {'past': 5, # seconds of sensor data
                      'future': 2, # seconds to consider in the future
@@ -256,92 +427,84 @@ class KerasModel(Model):
         self.total_time.start()
         
     def train(self):
-        if len(self.history.data) != self.history.samples():
+        if not self.history.full():
             return # not enough data in history yet
 
-        p = self.present()
+        history, conf = self.history, self.conf
+        p, samples = self.present(), self.history.samples
+        if not self.dataset:
+            sensors = history.width(conf['sensors'])*p
+            actions = history.width(conf['actions'])*(samples - p)
+            predictions = history.width(conf['predictions'])*(samples - p)
+            self.dataset = Dataset(model_filename(self.state) + 'data', sensors + actions, predictions)
+            self.sensors_size = sensors
+
+        row = self.dataset.row()
+        inputs, predictions_data = row[:self.dataset.inputs], row[self.dataset.inputs:]
         # inputs are the sensors over past time
-        sensors_data = inputs(self.history.data[:p], self.conf['sensors'])
+        history.select(conf['sensors'], 0, p, inputs[:self.sensors_size])
         # and the actions in the future
-        actions_data = inputs(self.history.data[p:], self.conf['actions'])
+        history.select(conf['actions'], p, samples, inputs[self.sensors_size:])
         # predictions in the future
-        predictions_data = inputs(self.history.data[p:], self.conf['predictions'])
-    
-        if not self.model:
-            self.train_x, self.train_y = [], []
-
-        inputs = sensors_data + actions_data
-        self.train_x.append(inputs)
-        self.train_y.append(predictions_data)
+        history.select(conf['predictions'], p, samples, predictions_data)
 
         if not self.model:
             self.load_time.start()
-            self.build(len(self.train_x[0]), len(self.train_y[0]))
+            self.build(len(inputs), len(predictions_data))
             try:
                 self.model.load_weights(model_filename(self.state)+'model')
             except:
                 print('failed to load model, starting from new')
             self.load_time.stop()
 
-        predict = self.model.predict(inputs)
-        pl = len(self.conf['predictions'])
+        predict = self.model.predict(inputs[None, :], verbose=0)[0]
+        pl = len(conf['predictions'])
         # compare predict to predictions_data to compute accuracy for each output
-        a = [1]*pl
-        accuracy = []
-        for i in range(0, len(predict), pl):
-            for j in range(pl):
-                computed = predict[i+j]
-                measured = predictions_data[i+j]
-                square_error = (computed-measured)**2
-                a[j] *= max(1-square_error, 0)
-                lp = .01
-                accuracy = self.conf['accuracy']
-                accuracy[i][j] = accuracy[i][j]*(1-lp) + a[j]*lp
-            
-        pool_size = 6000 # how much data to accumulate before training
-        l = len(self.train_x)
-        if l < pool_size:
+        square_error = (predict - predictions_data).reshape(-1, pl)**2
+        a = numpy.cumprod(numpy.maximum(1-square_error, 0), axis=0)
+        lp = .01
+        self.accuracy = self.accuracy*(1-lp) + a*lp
+
+        if not self.dataset.commit():
+            l = self.dataset.count
             if l%100 == 0:
                 sys.stdout.write('pooling... ' + str(l) + '\r')
                 sys.stdout.flush()
             return
 
-        print('fit', len(self.train_x), len(self.train_x[0]), len(self.train_y), len(self.train_y[0]))
-        #print('trainx', self.train_x[0])
-        #print('trainy', self.train_y[0])
-        self.fit_time.start()
-        history = self.model.fit(self.train_x, self.train_y, epochs=8)
-        self.fit_time.stop()
-        mse = history.history['mse']
-        print('mse', mse)
-        self.train_x, self.train_y = [], []
+        if self.pool.fit(model_filename(self.state), self.dataset):
+            self.fit_time.start()
+            print('fit', len(self.dataset.shards), 'shards of', self.dataset.shape)
+
+    # swap in weights from finished fits
+    def poll_training(self):
+        for filename, mse in self.pool.finished().items():
+            self.fit_time.stop()
+            print('mse', mse)
+            if self.model and filename == model_filename(self.state):
+                try:
+                    self.model.load_weights(filename + 'model')
+                except Exception as e:
+                    print('failed to load trained model', e)
 
     def build(self, input_size, output_size):
         conf = self.conf
-        print('load_time...')
-        import tensorflow as tf
         print('building...')
-        input = tf.keras.layers.Input(shape=(input_size,), name='input_layer')
-        #hidden1 = tf.keras.layers.Dense(256, activation='relu')(input)
-        hidden2 = tf.keras.layers.Dense(16, activation='relu')(input)
-        output = tf.keras.layers.Dense(output_size, activation='tanh')(hidden2)
-        self.model = tf.keras.Model(inputs=input, outputs=output)
-        self.model.compile(optimizer='adam', loss='mean_squared_error', metrics=['mse'])
-        #self.accuracy = 
+        self.model = build_model(input_size, output_size)
+        self.accuracy = numpy.ones((output_size // len(conf['predictions']), len(conf['predictions'])))
 
+    # the tflite model is written by the training process
     def save(self):
-        filename = learning.model_filename(self.state)
-        converter = tf.lite.TFLiteConverter.from_keras_model(self.model)
-        tflite_model = converter.convert()
+        if not self.model:
+            return
+        filename = model_filename(self.state)
         try:
-            f = open(filename + 'conf', 'w')
+            f = open(filename + '.conf', 'w')
+            self.conf['accuracy'] = self.accuracy.tolist()
             f.write(json.dumps(self.conf))
             f.close()
-            f = open(filename + '.tflite_model', 'w')
-            f.write(tflite_model)
-            f.close()
         except Exception as e:
-            print('failed to save', f)
+            print('failed to save', filename, e)
 
     def receive_single(self, name, value):
         if name == 'ap.enabled':
@@ -352,7 +515,7 @@ class KerasModel(Model):
             if self.state[name] != value:
                 print('state changed:', self.state)
                 self.state[name] = value
-                self.model = False
+                self.model = self.dataset = self.history = False
         elif name == 'timestamp':
             t0 = time.monotonic()
             if not self.firsttimestamp:
@@ -366,9 +529,10 @@ class KerasModel(Model):
               
             dt = value - self.lasttimestamp
             self.lasttimestamp = value
-            dte = abs(dt - 1.0/float(rate(self.conf)))
+            dte = abs(dt - 1.0/float(self.state['imu.rate']))
             if dte > .05:
-                self.history.clear()
+                if self.history:
+                    self.history.clear()
                 return
 
             for s in self.conf['sensors']:
@@ -427,6 +591,7 @@ class KerasModel(Model):
             print('time spent load time', self.load_time.time())
             print('time spent fit time', self.fit_time.time())
             print('time spent total', self.total_time.time())
+            self.pool.close()
             exit(0)
         signal(2, cleanup)
 
@@ -446,9 +611,11 @@ class KerasModel(Model):
 
         while True:
             self.receive()
+            self.poll_training()
               
             if time.monotonic() - t0 > 600:
                 self.save()
+                t0 = time.monotonic()
               
           # find cpu usage of training process
           #cpu = ps.cpu_percent()
@@ -27,76 +27,127 @@ def build_actions(current, period_count, count):
     ret += actions(0)
     return ret
 
+# every action sequence for a rate, command period and horizon, built
+# once with the rows allowed for each direction the servo is moving
+action_cache = {}
+def cached_actions(rate, period, count):
+    key = rate, period, count
+    if not key in action_cache:
+        period_count = max(int(round(period*rate)), 1)
+        actions = numpy.array(build_actions(0, period_count, count), numpy.float32)
+        allowed = {-1: actions[:, 0] <= 0, 0: actions[:, 0] == actions[:, 0], 1: actions[:, 0] >= 0}
+        action_cache[key] = actions, allowed
+    return action_cache[key]
+
 # use tensor flow lite for prediction to achieve realtime performance
 class TFliteModel(Model):
     def __init__(self):
         super(TFliteModel, self).__init__()
+        self.sensors_data = False
+        self.interpreter = False
+        self.inputs = {} # input tensors with the actions filled in
+        self.model_mtime = False
+        self.poll_time = 0
+        self.shape = False # batch of candidate actions and input width
 
     def load(self, state):
         filename = model_filename(state)
         try:
-            import tflite_runtime.interpreter as tflite
             f = open(filename + '.conf')
             self.conf = json.loads(f.read())
             f.close()
-            t0 = time.monotonic()
-            interpreter = tf.lite.Interpreter(model_path=filename + '.tflite_model')
-            t1 = time.monotonic()
-            interpreter.allocate_tensors()
-            t2 = time.monotonic()
-            input_details = interpreter.get_input_details()
-            output_details = interpreter.get_output_details()
-            t3 = time.monotonic()
-            input_shape = input_details[0]['shape']
-            print ('input details', input_details)
-            t4 = time.monotonic()
-            t5 = time.monotonic()
-            t6 = time.monotonic()
-            print('interpreter timings', t1-t0, t2-t1, t3-t2, t4-t3, t5-t4, t6-t5)
-            self.interpreter = interpreter
+            self.state = state
+            self.filename = filename + '.tflite_model'
+            self.model_mtime = False
             self.history = History(self.conf, state)
+            self.sensors_data = False
+            self.inputs = {}
+            self.poll_time = 0
+            self.shape = False
+            self.poll()
         except Exception as e:
             self.start_time = time.monotonic()          
-            print('failed to load model', filename)
+            print('failed to load model', filename, e)
             self.interpreter = False
 
-    def predict(self, loss):
-        # feed input sensors
-        p = self.present()
+    def load_interpreter(self, batch, width):
+        import tflite_runtime.interpreter as tflite
+        t0 = time.monotonic()
+        interpreter = tflite.Interpreter(model_path=self.filename)
+        input_index = interpreter.get_input_details()[0]['index']
+        interpreter.resize_tensor_input(input_index, [batch, width])
+        interpreter.allocate_tensors()
+        output_index = interpreter.get_output_details()[0]['index']
+        print('interpreter load time', time.monotonic() - t0)
+        return interpreter, input_index, output_index
+
+    # hot swap the model when the training process replaces it, shape
+    # is given when the inputs are first known or change
+    def poll(self, shape=False):
+        t = time.monotonic()
+        if shape:
+            self.shape = shape
+            self.model_mtime = False # load for the new shape
+        elif t - self.poll_time < 1:
+            return
+        self.poll_time = t
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except Exception as e:
+            return # not trained yet
+        if mtime == self.model_mtime or not self.shape:
+            return # unchanged, or loaded once the inputs are known
+        # fully load before replacing so predict always sees a usable model
+        interpreter = self.load_interpreter(*self.shape)
+        self.model_mtime = mtime
+        self.interpreter = interpreter
+
+    def predict(self, loss, current):
         # inputs are the sensors over past time
-        sensors_data = intellect.inputs(self.history.data, self.conf['sensors'])
+        if self.sensors_data is False:
+            self.sensors_data = numpy.zeros(self.history.width(self.conf['sensors'])*self.history.samples, numpy.float32)
+        sensors_data = self.sensors_data
+        self.history.select(self.conf['sensors'], 0, self.history.samples, sensors_data)
 
         # this many future actions
-        count = self.history.samples - self.present()
-        rate = state['imu.rate']
-        current = self.servo.command.value
-        period = .4;
-
-        # actions can be stored to optimize this
-        actions = self.build_actions(current, period/rate, count)
-
-        # inputs are past sensors and future actions
-        inputs = list(map(lambda action : sensors_data + action, actions))
-
-        self.interpreter.set_tensor(input_details[0]['index'], np.array(inputs))
-        self.interpreter.invoke()
-        outputs = interpreter.get_tensor(output_details[0]['index'])
+        rate = self.state['imu.rate']
+        count = int(math.ceil(self.conf['future']*rate))
+        period = .4
+
+        actions, allowed = cached_actions(rate, period, count)
+        key = rate, period, count
+        if not key in self.inputs:
+            # inputs are past sensors and future actions
+            inputs = numpy.zeros((len(actions), len(sensors_data) + count), numpy.float32)
+            inputs[:, len(sensors_data):] = actions
+            self.inputs[key] = inputs
+            self.poll(inputs.shape)
+        inputs = self.inputs[key]
+        inputs[:, :len(sensors_data)] = sensors_data
+
+        self.poll()
+        if not self.interpreter:
+            return False
+        interpreter, input_index, output_index = self.interpreter
+        interpreter.set_tensor(input_index, inputs)
+        interpreter.invoke()
+        outputs = interpreter.get_tensor(output_index)
             
         pnames = self.conf['predictions']
   
         # find best prediction based on loss
         besti = False
-        for i in len(inputs):
+        direction = (current > 0) - (current < 0)
+        for i in numpy.flatnonzero(allowed[direction]):
             output = outputs[i].reshape(-1, len(pnames))
             weight = 0
-            for j in len(output):
+            for j in range(len(output)):
                 prediction = {}
-                for k in len(pnames):
-                    prediction[pnames[j]] = output[j][k], self.conf['accuracy'][j][k]
-                action = actions[i][j]
-                weight += loss(prediction, action)
+                for k in range(len(pnames)):
+                    prediction[pnames[k]] = output[j][k], self.conf['accuracy'][j][k]
+                weight += loss(prediction, actions[i][j])
                 
-            if not besti or weight < best:
+            if besti is False or weight < best:
                 besti = i
                 best = weight
             
@@ -139,8 +190,9 @@ class LearningPilot(AutopilotPilot):
             return
 
         if ap.enabled.value:
-            actions = self.model.predict(self.loss)
-            ap.servo.command.command(actions[0])
+            actions = self.model.predict(self.loss, ap.servo.command.value)
+            if actions is not False:
+                ap.servo.command.command(actions[0])
 
         
 pilot = LearningPilot
@@ -38,13 +38,17 @@ def multiply(q1, q2):
             q1[0]*q2[2] - q1[1]*q2[3] + q1[2]*q2[0] + q1[3]*q2[1], \
             q1[0]*q2[3] + q1[1]*q2[2] - q1[2]*q2[1] + q1[3]*q2[0]]
 
-
-
 # take a vector and quaternion, and rotate the vector by the quaternion
+# q*v*conjugate(q) expanded: (w^2 - u.u)v + 2(u.v)u + 2w(u x v)
 def rotvecquat(v, q):
-    w = [0, v[0], v[1], v[2]]
-    r = [q[0], -q[1], -q[2], -q[3]]
-    return multiply(multiply(q, w), r)[1:]
+    w, x, y, z = q
+    v0, v1, v2 = v
+    a = w*w - x*x - y*y - z*z
+    d = 2*(x*v0 + y*v1 + z*v2)
+    w2 = 2*w
+    return [a*v0 + d*x + w2*(y*v2 - z*v1),
+            a*v1 + d*y + w2*(z*v0 - x*v2),
+            a*v2 + d*z + w2*(x*v1 - y*v0)]
 
 def toeuler(q):
     roll = math.atan2(2.0 * (q[2] * q[3] + q[0] * q[1]), \
@@ -58,8 +62,141 @@ def conjugate(q):
     return [q[0], -q[1], -q[2], -q[3]]
 
 def normalize(q):
-    total = 0
-    for v in q:
-        total += v*v
-    d = math.sqrt(total)
-    return [q[0] / d, q[1] / d, q[2] / d, q[3] / d]
+    q0, q1, q2, q3 = q
+    d = math.sqrt(q0*q0 + q1*q1 + q2*q2 + q3*q3)
+    return [q0 / d, q1 / d, q2 / d, q3 / d]
+
+# batch versions of the above operating on numpy arrays of shape (N, 4)
+# for quaternions and (N, 3) for vectors, a single quaternion or vector
+# may be given for either argument and is applied to every row
+def angvec2quat_array(angle, v):
+    import numpy as np
+    v = np.asarray(v, dtype=float)
+    angle = np.asarray(angle, dtype=float)
+    n = vector.norm_array(v)
+    shape = np.broadcast(angle, n).shape
+    fac = np.divide(np.sin(angle/2), n, out=np.zeros(shape), where=n != 0)
+    w = np.broadcast_to(np.cos(angle/2), shape)
+    return np.concatenate((w[..., None], v * fac[..., None]), axis=-1)
+
+def angle_array(q):
+    import numpy as np
+    return 2*np.arccos(np.asarray(q, dtype=float)[..., 0])
+
+def vec2vec2quat_array(a, b):
+    import numpy as np
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    fac = vector.dot_array(a, b) / vector.norm_array(a) / vector.norm_array(b)
+    ang = np.arccos(np.clip(fac, -1, 1))
+    return angvec2quat_array(ang, vector.cross_array(a, b))
+
+def multiply_array(q1, q2):
+    import numpy as np
+    q1, q2 = np.asarray(q1, dtype=float), np.asarray(q2, dtype=float)
+    a0, a1, a2, a3 = q1[..., 0], q1[..., 1], q1[..., 2], q1[..., 3]
+    b0, b1, b2, b3 = q2[..., 0], q2[..., 1], q2[..., 2], q2[..., 3]
+    return np.stack((a0*b0 - a1*b1 - a2*b2 - a3*b3,
+                     a0*b1 + a1*b0 + a2*b3 - a3*b2,
+                     a0*b2 - a1*b3 + a2*b0 + a3*b1,
+                     a0*b3 + a1*b2 - a2*b1 + a3*b0), axis=-1)
+
+def rotvecquat_array(v, q):
+    import numpy as np
+    v, q = np.asarray(v, dtype=float), np.asarray(q, dtype=float)
+    w, u = q[..., :1], q[..., 1:]
+    a = w*w - np.sum(u*u, axis=-1, keepdims=True)
+    d = 2*np.sum(u*v, axis=-1, keepdims=True)
+    return a*v + d*u + 2*w*np.cross(u, v)
+
+def toeuler_array(q):
+    import numpy as np
+    q = np.asarray(q, dtype=float)
+    q0, q1, q2, q3 = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    roll = np.arctan2(2.0 * (q2 * q3 + q0 * q1), 1 - 2.0 * (q1 * q1 + q2 * q2))
+    pitch = np.arcsin(np.clip(2.0 * (q0 * q2 - q1 * q3), -1, 1))
+    heading = np.arctan2(2.0 * (q1 * q2 + q0 * q3), 1 - 2.0 * (q2 * q2 + q3 * q3))
+    return np.stack((roll, pitch, heading), axis=-1)
+
+def conjugate_array(q):
+    import numpy as np
+    return np.asarray(q, dtype=float) * [1, -1, -1, -1]
+
+def normalize_array(q):
+    import numpy as np
+    q = np.asarray(q, dtype=float)
+    return q / np.sqrt(np.sum(q*q, axis=-1, keepdims=True))
+
+# compare against the previous list implementations and per sample loops
+def benchmark(n=2000):
+    import time, random
+    import numpy as np
+
+    def ref_multiply(q1, q2):
+        return [q1[0]*q2[0] - q1[1]*q2[1] - q1[2]*q2[2] - q1[3]*q2[3], \
+                q1[0]*q2[1] + q1[1]*q2[0] + q1[2]*q2[3] - q1[3]*q2[2], \
+                q1[0]*q2[2] - q1[1]*q2[3] + q1[2]*q2[0] + q1[3]*q2[1], \
+                q1[0]*q2[3] + q1[1]*q2[2] - q1[2]*q2[1] + q1[3]*q2[0]]
+
+    def ref_rotvecquat(v, q):
+        w = [0, v[0], v[1], v[2]]
+        r = [q[0], -q[1], -q[2], -q[3]]
+        return ref_multiply(ref_multiply(q, w), r)[1:]
+
+    def ref_normalize(q):
+        total = 0
+        for v in q:
+            total += v*v
+        d = math.sqrt(total)
+        return [q[0] / d, q[1] / d, q[2] / d, q[3] / d]
+
+    def ref_toeuler(q):
+        roll = math.atan2(2.0 * (q[2] * q[3] + q[0] * q[1]), \
+                          1 - 2.0 * (q[1] * q[1] + q[2] * q[2]))
+        pitch = math.asin(min(max(2.0 * (q[0] * q[2] - q[1] * q[3]), -1), 1))
+        heading = math.atan2(2.0 * (q[1] * q[2] + q[0] * q[3]), \
+                             1 - 2.0 * (q[2] * q[2] + q[3] * q[3]))
+        return roll, pitch, heading
+
+    r = lambda : random.uniform(-1, 1)
+    qs = [normalize([r(), r(), r(), r()]) for i in range(n)]
+    q2s = [normalize([r(), r(), r(), r()]) for i in range(n)]
+    vs = [[r(), r(), r()] for i in range(n)]
+    aq, aq2, av = np.array(qs), np.array(q2s), np.array(vs)
+
+    def timeit(f, repeat=5): # best of several runs
+        best = False
+        for i in range(repeat):
+            t0 = time.perf_counter()
+            result = f()
+            t = time.perf_counter() - t0
+            best = min(best, t) if best else t
+        return best, result
+
+    tests = [('multiply', lambda : [ref_multiply(a, b) for a, b in zip(qs, q2s)],
+              lambda : [multiply(a, b) for a, b in zip(qs, q2s)],
+              lambda : multiply_array(aq, aq2)),
+             ('rotvecquat', lambda : [ref_rotvecquat(v, q) for v, q in zip(vs, qs)],
+              lambda : [rotvecquat(v, q) for v, q in zip(vs, qs)],
+              lambda : rotvecquat_array(av, aq)),
+             ('normalize', lambda : [ref_normalize(q) for q in q2s],
+              lambda : [normalize(q) for q in q2s],
+              lambda : normalize_array(aq2)),
+             ('toeuler', lambda : [ref_toeuler(q) for q in qs],
+              lambda : [toeuler(q) for q in qs],
+              lambda : toeuler_array(aq)),
+             ('vector.norm', lambda : [math.sqrt(v[0]**2 + v[1]**2 + v[2]**2) for v in vs],
+              lambda : [vector.norm(v) for v in vs],
+              lambda : vector.norm_array(av))]
+
+    print('%d samples' % n)
+    print('function       ref us/call  us/call  speedup  batch us/sample  speedup  max error')
+    for name, ref, scalar, batch in tests:
+        tr, rr = timeit(ref)
+        ts, rs = timeit(scalar)
+        tb, rb = timeit(batch)
+        error = max(np.max(np.abs(np.array(rs) - np.array(rr))), np.max(np.abs(rb - np.array(rr))))
+        print('%-12s  %11.2f  %7.2f  %7.1f  %15.3f  %7.1f  %.1e' % (name, 1e6*tr/n, 1e6*ts/n, tr/ts,
+                                                               1e6*tb/n, tr/tb, error))
+
+if __name__ == '__main__':
+    benchmark()
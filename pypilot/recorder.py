@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2024 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# record every value update to memory mapped segment files
+#
+# each record is a monotonic timestamp followed by the same binary value
+# frame sent to binary clients, so values are stored packed.  Name frames
+# are written the first time a value appears in each segment, so segments
+# are read independently.  A time index followed by the name frames is
+# appended when a segment is closed; segments not closed cleanly are
+# indexed by scanning them.
+#
+# records are copied into the map and left to the kernel to write back,
+# so pages are normally written once after they fill up
+
+import os, sys, time, mmap, struct, bisect
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from bufferedsocket import encode_frame, decode_frame, decode_value, FRAME_NAME
+
+segment_size = 4*1024*1024 # bytes per file before rotating
+max_segments = 64 # oldest segments are removed beyond this
+index_period = 1 # seconds between time index entries
+
+# values kept updated while recording so the recording can be replayed
+replay_values = ['imu.fusionQPose', 'imu.accel', 'imu.gyro', 'imu.compass', 'imu.accel.residuals',
+                 'gps.fix', 'wind.direction', 'wind.speed', 'truewind.direction', 'truewind.speed',
+                 'water.speed', 'apb.track', 'apb.xte', 'ap.enabled', 'ap.mode',
+                 'ap.heading_command', 'ap.heading', 'ap.heading_error', 'servo.command']
+
+magic = b'PYPREC01'
+# magic, wall time and monotonic time at start, index offset and count
+header = struct.Struct('<8sddQQ')
+timestamp = struct.Struct('<d')
+index_entry = struct.Struct('<dQ') # monotonic time, offset
+
+# segment files of a recording directory in the order they were written,
+# by sequence number, since the clock may be set back or not set yet
+def segment_files(path):
+    segments = []
+    for f in os.listdir(path):
+        if f.endswith('Z.rec'):
+            try:
+                segments.append((int(f.split('-', 1)[0]), f))
+            except ValueError:
+                pass
+    return [f for number, f in sorted(segments)]
+
+class Recorder(object):
+    # snapshot returns values written at the start of each segment
+    def __init__(self, path, snapshot=False):
+        self.path = path
+        self.snapshot = snapshot
+        os.makedirs(path, exist_ok=True)
+        self.map = False
+        self.names_size = 0 # bytes of name frames in the footer
+        # wall time follows monotonic time for the recording
+        self.wall_offset = time.time() - time.monotonic()
+
+    def open_segment(self, t):
+        wall = t + self.wall_offset
+        segments = segment_files(self.path)
+        number = int(segments[-1].split('-', 1)[0]) + 1 if segments else 0
+        name = '%08d-' % number + time.strftime('%Y%m%dT%H%M%SZ.rec', time.gmtime(wall))
+        # remove oldest segments first so their space can be reused
+        for f in segments[:1-max_segments]:
+            try:
+                os.remove(os.path.join(self.path, f))
+            except Exception as e:
+                print(_('recorder failed to remove'), f, e)
+
+        path = os.path.join(self.path, name)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # allocate the blocks now, a sparse file raises SIGBUS on a
+            # store into the map when the disk fills, this raises OSError
+            os.posix_fallocate(self.fd, 0, segment_size)
+            self.map = mmap.mmap(self.fd, segment_size)
+        except OSError:
+            os.close(self.fd)
+            os.remove(path)
+            raise
+        self.map[:header.size] = header.pack(magic, wall, t, 0, 0)
+        self.pos = header.size
+        self.names = {} # values with name written in this segment
+        self.index = []
+        self.index_time = 0
+        self.names_size = 0
+
+        if self.snapshot: # segments can be replayed without earlier segments
+            for value in self.snapshot():
+                self.write(value, t)
+
+    def close_segment(self):
+        # append time index and names, and truncate unused space
+        m = self.map
+        offset = self.pos
+        for t, pos in self.index:
+            m[self.pos:self.pos+index_entry.size] = index_entry.pack(t, pos)
+            self.pos += index_entry.size
+        for name in self.names.values():
+            m[self.pos:self.pos+len(name)] = name
+            self.pos += len(name)
+        m[16+8:header.size] = struct.pack('<QQ', offset, len(self.index))
+        m.flush()
+        m.close()
+        os.ftruncate(self.fd, self.pos)
+        os.close(self.fd)
+        self.map = False
+
+    def close(self):
+        if self.map:
+            self.close_segment()
+
+    def append(self, t, data):
+        end = self.pos + timestamp.size + len(data)
+        self.map[self.pos:self.pos+timestamp.size] = timestamp.pack(t)
+        self.map[self.pos+timestamp.size:end] = data
+        self.pos = end
+
+    # value is a server value with id, name and a cached frame
+    def write(self, value, t):
+        frame = value.get_frame()
+        name = False
+        size = timestamp.size + len(frame)
+        if not self.map or not value.id in self.names:
+            name = encode_frame(FRAME_NAME, value.id, value.name.encode())
+            size += timestamp.size + 2*len(name)
+
+        if self.map: # leave room for the footer and a terminating timestamp
+            size += (len(self.index) + 1)*index_entry.size + timestamp.size + self.names_size
+        if not self.map or self.pos + size > segment_size:
+            if self.map:
+                self.close_segment()
+            self.open_segment(t)
+            if value.id in self.names: # written by the snapshot
+                name = False
+            else:
+                name = encode_frame(FRAME_NAME, value.id, value.name.encode())
+
+        if t - self.index_time >= index_period:
+            self.index.append((t, self.pos))
+            self.index_time = t
+        if name:
+            self.append(t, name)
+            self.names[value.id] = name
+            self.names_size += len(name)
+        self.append(t, frame)
+
+class Segment(object):
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            data = f.read(header.size)
+        m, self.wall, self.monotonic, self.index_offset, self.index_count = header.unpack(data)
+        if m != magic:
+            raise Exception('invalid recording segment ' + filename)
+        self.map = False
+
+    def open(self):
+        if self.map:
+            return
+        with open(self.filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.end = self.index_offset if self.index_offset else len(self.map)
+        self.index = []
+        self.names = {}
+        if self.index_offset:
+            for i in range(self.index_count):
+                p = self.index_offset + i*index_entry.size
+                self.index.append(index_entry.unpack_from(self.map, p))
+            pos = p + index_entry.size if self.index_count else self.index_offset
+            while True:
+                frame = decode_frame(self.map, pos)
+                if not frame:
+                    break
+                kind, id, payload, pos = frame
+                self.names[id] = payload.decode()
+        else: # not closed, build index by scanning
+            index_time = 0
+            for t, pos, (kind, id, payload, end) in self.records(header.size):
+                if t - index_time >= index_period:
+                    self.index.append((t, pos))
+                    index_time = t
+                if kind == FRAME_NAME:
+                    self.names[id] = payload.decode()
+        self.index_times = [t for t, pos in self.index]
+
+    # iterate monotonic time, position and frame from position
+    def records(self, pos):
+        m, end = self.map, self.end
+        while pos + timestamp.size < end:
+            t = timestamp.unpack_from(m, pos)[0]
+            if t == 0:
+                break # unwritten space
+            frame = decode_frame(m, pos + timestamp.size)
+            if not frame:
+                break
+            yield t, pos, frame
+            pos = frame[3]
+
+    # position of the first record at or after monotonic time t
+    def find(self, t):
+        i = bisect.bisect_right(self.index_times, t) - 1
+        pos = self.index[i][1] if i >= 0 else header.size
+        for rt, pos, frame in self.records(pos):
+            if rt >= t:
+                return pos
+        return self.end
+
+# read recordings from a directory in time order
+class RecordingReader(object):
+    def __init__(self, path):
+        self.segments = []
+        for f in segment_files(path):
+            try:
+                self.segments.append(Segment(os.path.join(path, f)))
+            except Exception as e:
+                print(_('recorder failed to read'), f, e)
+        # segments recorded before the clock was set start earlier
+        # than those before them, keep the starts ordered to bisect
+        self.starts = []
+        for s in self.segments:
+            self.starts.append(max(s.wall, self.starts[-1]) if self.starts else s.wall)
+        self.seek(0)
+
+    # position at the first record at or after wall time t,
+    # bisecting segments and then the index of the segment
+    def seek(self, t):
+        i = max(bisect.bisect_right(self.starts, t) - 1, 0)
+        self.segment = i
+        self.pos = False
+        if i < len(self.segments):
+            s = self.segments[i]
+            s.open()
+            self.pos = s.find(s.monotonic + t - s.wall)
+
+    # yield wall time, name and value of each record from the current position
+    def __iter__(self):
+        while self.segment < len(self.segments):
+            s = self.segments[self.segment]
+            s.open()
+            names = s.names
+            for t, pos, (kind, id, payload, end) in s.records(self.pos or header.size):
+                if kind != FRAME_NAME:
+                    yield s.wall + t - s.monotonic, names.get(id), decode_value(kind, payload)
+            self.segment += 1
+            self.pos = False
+
+# write a simulated hour of imu and servo values, then time reading and seeking
+def benchmark(path='/tmp/pypilot_recorder_benchmark'):
+    import shutil, random
+    from bufferedsocket import encode_value_frame
+    shutil.rmtree(path, ignore_errors=True)
+
+    class value(object): # stands in for a server value
+        def __init__(self, id, name):
+            self.id, self.name = id, name
+        def get_frame(self):
+            return encode_value_frame(self.id, self.msg)
+
+    names = ['imu.accel', 'imu.gyro', 'imu.compass', 'imu.fusionQPose', 'imu.heading', 'imu.pitch',
+             'imu.roll', 'imu.heel', 'imu.headingrate', 'imu.headingrate_lowpass', 'imu.heading_lowpass',
+             'servo.current', 'servo.voltage', 'servo.position', 'servo.command', 'ap.heading']
+    values = [value(i+1, name) for i, name in enumerate(names)]
+    recorder = Recorder(path)
+    records, t, duration = 0, time.monotonic(), 3600
+    end, elapsed = t + duration, 0
+    while t < end:
+        t += .05
+        for v in values:
+            if v.name.endswith(('accel', 'gyro', 'compass')):
+                v.msg = '[%.5f, %.5f, %.5f]' % (random.random(), random.random(), random.random())
+            elif v.name.endswith('QPose'):
+                v.msg = '[%.8f, %.8f, %.8f, %.8f]' % tuple(random.random() for i in range(4))
+            else:
+                v.msg = '%.3f' % (random.random()*100)
+            t0 = time.monotonic()
+            recorder.write(v, t)
+            elapsed += time.monotonic() - t0
+            records += 1
+    recorder.close()
+    size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    print('%d records %.2f us/record %.1f bytes/record %d segments' %
+          (records, 1e6*elapsed/records, size/records, len(os.listdir(path))))
+
+    reader = RecordingReader(path)
+    start = reader.starts[0]
+    t0 = time.monotonic()
+    count = sum(1 for r in reader)
+    print('read %d records %.2f us/record' % (count, 1e6*(time.monotonic()-t0)/count))
+
+    seeks = 100
+    t0 = time.monotonic()
+    for i in range(seeks):
+        reader.seek(start + random.uniform(0, duration))
+        next(iter(reader))
+    print('seek and read first record %.1f us' % (1e6*(time.monotonic()-t0)/seeks))
+    shutil.rmtree(path)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        benchmark()
+        exit(0)
+    # print recorded values, optionally from a wall time
+    reader = RecordingReader(sys.argv[1])
+    if len(sys.argv) > 2:
+        reader.seek(float(sys.argv[2]))
+    for t, name, value in reader:
+        print('%.3f' % t, name, value)
@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2024 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# replay recordings (see recorder.py) through Autopilot.iteration
+# as fast as possible to compare and profile pilots without the boat
+#
+# a virtual clock replaces time.monotonic and time.sleep while replaying,
+# and the imu, sensor services, gps filter process and servo driver are
+# replaced by recorded data, so sensor fusion, pilots and tacking run
+# exactly as they do on the boat.  The boat does not respond to the
+# replayed servo: the recorded heading error is the same for every pilot
+# while the servo commands show how each would have steered.
+
+import os, sys, time, math
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from autopilot import *
+from server import ServerValues, ServerPoller, server_persistent_period
+from servo import ServoFlags, ServoTelemetry
+from recorder import RecordingReader
+
+# recorded values applied as they were commanded on the boat,
+# besides these, recorded persistent settings are also applied
+command_values = ['ap.enabled', 'ap.mode', 'ap.heading_command']
+
+class VirtualClock(object):
+    def __init__(self, t):
+        self.time = t
+
+    def monotonic(self):
+        return self.time
+
+    def sleep(self, dt):
+        if dt > 0:
+            self.time += dt
+
+    def install(self):
+        self.real = time.monotonic, time.sleep
+        time.monotonic, time.sleep = self.monotonic, self.sleep
+
+    def remove(self):
+        time.monotonic, time.sleep = self.real
+
+# settings are taken from the recording, and never stored
+class ReplayServerValues(ServerValues):
+    def load(self):
+        self.inotify = None
+        self.persistent_data = {None : {}, 'default' : {}}
+
+    def store(self):
+        self.persistent_timeout = time.monotonic() + server_persistent_period
+
+# server without sockets, running in the replay process
+class ReplayServer(pypilotServer):
+    def __init__(self):
+        super(ReplayServer, self).__init__()
+        self.multiprocessing = False
+
+    def init(self):
+        self.process = 'server process'
+        self.sockets = []
+        self.pending = set()
+        self.fd_to_pipe = {}
+        self.fd_to_connection = {}
+        self.values = ReplayServerValues(self)
+        self.poller = ServerPoller()
+        self.init_pipes()
+
+    def __del__(self):
+        pass
+
+# stands in for the imu process and the sensor bus it writes
+class ReplayIMU(object):
+    multiprocessing = False
+    process = False
+
+    def __init__(self, replay):
+        self.replay = replay
+        self.bus = self
+
+    def poll(self):
+        pass
+
+    def read(self):
+        replay = self.replay
+        replay.advance()
+        sample, replay.sample = replay.sample, False
+        return sample
+
+    # move the clock to the next sample, or timeout
+    def wait(self, timeout):
+        replay = self.replay
+        clock = replay.clock
+        end = clock.time + timeout
+        while not replay.sample and replay.record and replay.record[0] <= end:
+            clock.time = max(clock.time, replay.record[0])
+            replay.advance()
+        if not replay.sample:
+            clock.time = end
+        return not not replay.sample
+
+# the recorded imu data is already calibrated
+class ReplayCalibration(object):
+    process = False
+
+    def calibration_ready(self):
+        return False
+
+    def get_warnings(self):
+        return ''
+
+# stands in for nmea, signalk and gpsd writing recorded sensor data
+class ReplayService(object):
+    process = False
+
+    def __init__(self, replay):
+        self.replay = replay
+
+    def poll(self):
+        replay = self.replay
+        replay.advance()
+        sensors = replay.ap.sensors
+        for sensor, data in replay.sensor_data:
+            sensors.write(sensor, data, 'replay')
+        replay.sensor_data = []
+
+# gps filter run in the replay process
+class ReplayGPSFilter(object):
+    process = False
+
+    def __init__(self, client):
+        import gps_filter, numpy
+        gps_filter.np = numpy # imported by the filter process when live
+        self.output = client.register(BooleanProperty('gps.filtered.output', False, persistent=True))
+        self.filter = gps_filter.GPSFilter(client)
+
+    def predict(self, accel, fusionQPose, t):
+        self.filter.predict(accel, fusionQPose, t)
+
+    def update(self, gps, t):
+        self.filter.update(gps, t)
+
+# stands in for the servo controller, moving a simulated rudder
+# with the commands it receives so feedback follows the replayed pilot
+class ReplayDriver(object):
+    path = 'replay' # device
+    def __init__(self):
+        self.voltage, self.current = 12, 0
+        self.controller_temp = self.motor_temp = 0
+        self.flags = 0
+        self.value = 0 # last command
+        self.angle = .01 # simulated rudder, raw value of 0 reads as no rudder
+        self.rudder_range, self.rudder_offset, self.rudder_scale = 45, 0, 100
+        self.time = time.monotonic()
+
+    def command(self, command):
+        self.value = command
+        self.flags |= ServoFlags.ENGAGED
+
+    def disengage(self):
+        self.value = 0
+        self.flags &= ~ServoFlags.ENGAGED
+
+    def params(self, *args):
+        self.rudder_range, self.rudder_offset, self.rudder_scale = args[6:9]
+
+    def poll(self):
+        # same rate as servo position estimate without rudder feedback
+        t = time.monotonic()
+        dt, self.time = min(t - self.time, 1), t
+        r = self.rudder_range
+        self.angle = min(max(self.angle + self.value*dt*r, -r), r)
+        self.rudder = (self.angle - self.rudder_offset)/self.rudder_scale
+        return ServoTelemetry.FLAGS | ServoTelemetry.RUDDER
+
+    def fault(self):
+        return False
+
+    def reset(self):
+        pass
+
+class Replay(object):
+    def __init__(self, path, pilot=False, start=False, duration=False, shadow=False):
+        reader = RecordingReader(path)
+        if start:
+            reader.seek(start)
+        self.records = iter(reader)
+        self.record = next(self.records, False) # next (time, name, value)
+        if not self.record:
+            raise Exception('no records to replay in ' + path)
+
+        self.clock = VirtualClock(self.record[0])
+        self.end = self.record[0] + duration if duration else float('inf')
+        self.pilot = pilot
+        self.shadow = shadow # evaluate the other pilots in shadow mode
+
+        self.server = ReplayServer()
+        self.imu = ReplayIMU(self)
+        self.auto_cal = ReplayCalibration()
+        self.service = ReplayService(self)
+        self.gps_filter = ReplayGPSFilter
+        self.driver = ReplayDriver()
+
+        self.recorded = {} # latest recorded values
+        self.sample = False # imu sample ready to read
+        self.sensor_data = [] # sensor data ready to write
+        self.ap = False
+        self.values = {} # autopilot client values
+
+    # consume records up to the clock
+    def advance(self):
+        t = self.clock.time
+        recorded = self.recorded
+        while self.record and self.record[0] <= t:
+            rt, name, value = self.record
+            self.record = next(self.records, False)
+            recorded[name] = value
+            if name == 'imu.fusionQPose': # last value written for each imu sample
+                self.sample = {'timestamp': rt, 'fusionQPose': value,
+                               'accel': recorded.get('imu.accel'),
+                               'gyro': list(map(math.radians, recorded.get('imu.gyro', [0, 0, 0]))),
+                               'compass': recorded.get('imu.compass'),
+                               'accel.residuals': recorded.get('imu.accel.residuals', [0, 0, 0])}
+                if not self.sample['accel'] or not self.sample['compass']:
+                    self.sample = False
+            elif name == 'gps.fix':
+                data = dict(value)
+                data['device'] = 'replay'
+                self.sensor_data.append(('gps', data))
+            elif name == 'wind.speed' and 'wind.direction' in recorded:
+                # recorded direction includes the offset applied when written
+                direction = recorded['wind.direction'] - self.values['wind.offset'].value
+                self.sensor_data.append(('wind', {'direction': direction, 'speed': value, 'device': 'replay'}))
+            elif name == 'water.speed':
+                self.sensor_data.append(('water', {'speed': value, 'device': 'replay'}))
+            elif name.startswith('apb.') and 'apb.track' in recorded:
+                self.sensor_data.append(('apb', {'track': recorded['apb.track'], 'xte': recorded.get('apb.xte', 0), 'device': 'replay'}))
+            elif name in self.values:
+                self.apply(name, value)
+
+    # apply commands and settings from the recording
+    def apply(self, name, value):
+        v = self.values[name]
+        if not name in command_values and not v.info.get('persistent'):
+            return
+        if self.pilot and name == 'ap.pilot':
+            return # pilot being evaluated
+        try:
+            if v.value != value:
+                v.set(value)
+        except Exception as e:
+            print(_('replay failed to set'), name, value, e)
+
+    def run(self):
+        self.clock.install()
+        try:
+            return self.replay()
+        finally:
+            self.clock.remove()
+
+    def replay(self):
+        t0 = time.perf_counter()
+        self.ap = ap = Autopilot(self)
+        self.values = ap.client.values.values
+        servo = ap.servo
+        servo.driver = servo.device = self.driver
+        servo.controller.update('replay')
+        for i in range(2): # connect servo and rudder feedback before replaying
+            servo.poll()
+        if self.pilot:
+            ap.pilot.set(self.pilot)
+        ap.shadow.enabled.set(self.shadow)
+        tinit = time.perf_counter() - t0
+
+        iterations = engaged = 0
+        error2 = command_effort = command_diff2 = heading_diff2 = travel = 0
+        reversals = lastdir = 0
+        lastt = self.clock.time
+        lastposition = servo.position.value
+        start = self.clock.time
+        t0 = time.perf_counter()
+        while self.record and self.clock.time < self.end:
+            # start iterations when imu samples arrive as on the boat
+            if not self.imu.wait(1.4/ap.boatimu.rate.value) and \
+               self.record and self.record[0] - self.clock.time > 2:
+                self.clock.time = self.record[0] # skip gap in the recording
+            ap.iteration()
+            iterations += 1
+
+            t = self.clock.time
+            dt, lastt = t - lastt, t
+            position = servo.position.value
+            if ap.enabled.value and dt < 1:
+                engaged += dt
+                error2 += ap.heading_error.value**2*dt
+                command = self.driver.value
+                command_effort += abs(command)*dt
+                dir = (command > 0) - (command < 0)
+                if dir:
+                    if lastdir and dir != lastdir:
+                        reversals += 1
+                    lastdir = dir
+                travel += abs(position - lastposition)
+                recorded = self.recorded.get('servo.command')
+                if recorded is not None:
+                    command_diff2 += (servo.command.value - recorded)**2*dt
+                recorded = self.recorded.get('ap.heading')
+                if recorded is not None and ap.heading.value is not False:
+                    heading_diff2 += resolv(ap.heading.value - recorded)**2*dt
+            lastposition = position
+
+        elapsed = time.perf_counter() - t0
+        replayed = self.clock.time - start
+        def rms(s):
+            return math.sqrt(s/engaged) if engaged else 0
+        minutes = engaged/60
+        return {'pilot': ap.pilot.value, 'iterations': iterations, 'replayed': replayed, 'engaged': engaged,
+                'heading_error_rms': rms(error2), 'servo_effort': command_effort/engaged if engaged else 0,
+                'reversals_per_minute': reversals/minutes if minutes else 0,
+                'travel_per_minute': travel/minutes if minutes else 0,
+                'recorded_command_rms': rms(command_diff2), 'recorded_heading_rms': rms(heading_diff2),
+                'init_time': tinit, 'us_per_iteration': 1e6*elapsed/iterations if iterations else 0,
+                'speedup': replayed/elapsed if elapsed else 0,
+                'shadow': {name: {'error': p.error.value, 'rms_error': p.rms_error.value,
+                                  'cost_p50': p.cost.percentile(.5), 'cost_p99': p.cost.percentile(.99),
+                                  'skipped': p.skipped.value, 'compared': p.compared}
+                           for name, p in ap.shadow.pilots.items() if p.cost.max}}
+
+# replay the recording once for each pilot
+def evaluate(path, pilots=[False], start=False, duration=False, shadow=False):
+    results = []
+    for pilot in pilots:
+        results.append(Replay(path, pilot, start, duration, shadow).run())
+
+    print('pilot         engaged  err rms  effort  rev/min  travel/min  cmd rms  hdg rms  us/iter  speedup')
+    for r in results:
+        print('%-12s %7.0fs %7.2f  %6.3f  %7.1f  %10.1f  %7.3f  %7.3f  %7.0f  %6.0fx' %
+              (r['pilot'], r['engaged'], r['heading_error_rms'], r['servo_effort'], r['reversals_per_minute'],
+               r['travel_per_minute'], r['recorded_command_rms'], r['recorded_heading_rms'],
+               r['us_per_iteration'], r['speedup']))
+    for r in results:
+        for name, s in r['shadow'].items():
+            if s['compared']:
+                error = 'mean %7.3f  rms %7.3f' % (s['error'], s['rms_error'])
+            else:
+                error = '%-22s' % 'other command type'
+            print('shadow %-10s vs %-10s %s  cost us p50 %5.0f p99 %5.0f  skipped %d' %
+                  (name, r['pilot'], error, 1e6*s['cost_p50'], 1e6*s['cost_p99'], s['skipped']))
+    return results
+
+# write a recording of a simulated boat yawing in waves,
+# steered by a simple proportional-derivative pilot
+def simulate(path, duration=600, rate=20):
+    import random, quaternion, pyjson
+    from bufferedsocket import encode_value_frame
+    from recorder import Recorder
+
+    class value(object): # stands in for a server value
+        def __init__(self, id, name):
+            self.id, self.name = id, name
+        def get_frame(self):
+            return encode_value_frame(self.id, pyjson.dumps(self.value))
+
+    values = {}
+    def write(name, v, t):
+        if not name in values:
+            values[name] = value(len(values)+1, name)
+        values[name].value = v
+        recorder.write(values[name], t)
+
+    recorder = Recorder(path)
+    t = time.monotonic()
+    start, end = t, t + duration
+    write('ap.enabled', True, t)
+    write('ap.mode', 'compass', t)
+    write('ap.heading_command', 90, t)
+    drift = 0
+    while t < end:
+        t += 1/rate
+        s = t - start
+        drift += random.gauss(0, .05)
+        heading = 90 + 6*math.sin(2*math.pi*s/8) + 2*math.sin(2*math.pi*s/3.1) + drift
+        headingrate = 6*2*math.pi/8*math.cos(2*math.pi*s/8) + 2*2*math.pi/3.1*math.cos(2*math.pi*s/3.1)
+        roll = 10*math.sin(2*math.pi*s/5)
+        pitch = 3*math.sin(2*math.pi*s/4)
+        q = quaternion.multiply(quaternion.angvec2quat(math.radians(heading), [0, 0, 1]),
+                                quaternion.multiply(quaternion.angvec2quat(math.radians(pitch), [0, 1, 0]),
+                                                    quaternion.angvec2quat(math.radians(roll), [1, 0, 0])))
+        cq = quaternion.conjugate(q)
+        accel = quaternion.rotvecquat([0, 0, 1], cq)
+        gyro = quaternion.rotvecquat([0, 0, math.radians(headingrate)], cq)
+        write('imu.accel', [round(x, 4) for x in accel], t)
+        write('imu.gyro', [round(math.degrees(x), 4) for x in gyro], t)
+        write('imu.compass', [round(x*30, 4) for x in quaternion.rotvecquat([1, 0, .5], cq)], t)
+        write('imu.fusionQPose', [round(x, 10) for x in q], t)
+        error = resolv(heading - 90)
+        write('ap.heading', round(heading, 4), t)
+        write('ap.heading_error', round(error, 4), t)
+        write('servo.command', round(min(max(-.01*error - .003*headingrate, -1), 1), 4), t)
+        if int(s*rate) % rate == 0:
+            write('gps.fix', {'speed': 6 + random.random(), 'track': round(heading + 5, 2), 'timestamp': s}, t)
+        if int(s*rate) % (rate//4) == 0:
+            write('wind.direction', round(40 + random.gauss(0, 3), 2), t)
+            write('wind.speed', round(15 + random.gauss(0, 1), 2), t)
+    recorder.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] == '-b':
+        # benchmark with a simulated recording
+        import shutil
+        path = '/tmp/pypilot_replay_benchmark'
+        shutil.rmtree(path, ignore_errors=True)
+        duration = float(sys.argv[2]) if len(sys.argv) > 2 else 600
+        simulate(path, duration)
+        evaluate(path, ['basic', 'absolute'], shadow=True)
+        shutil.rmtree(path)
+        exit(0)
+
+    if sys.argv[1] == '-h':
+        print('usage: replay.py [recording path] [pilot]...')
+        print('replays the recording with each pilot and compares them')
+        print('without arguments, replays a simulated recording')
+        exit(0)
+    evaluate(sys.argv[1], sys.argv[2:] or [False])
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2024 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# schedule autopilot iterations on imu sample arrival
+#
+# each iteration has an absolute deadline, the expected arrival of the
+# next imu sample.  Deadlines advance by whole periods so waking late
+# does not delay later iterations, and are pulled toward the measured
+# arrival times so the loop stays in phase with the imu.  Between
+# iterations the process sleeps until just before the deadline, then
+# waits on the sensor bus so it wakes as the sample is written.
+
+import os, sys, time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from values import *
+
+phase_gain = .1 # fraction of the phase error corrected each sample
+wake_margin = .002 # seconds before the deadline to stop sleeping
+
+class Scheduler(object):
+    def __init__(self, ap):
+        self.missed = ap.register(ResettableValue, 'scheduler.missed', 0, fmt='%.0f')
+        self.phase_error = ap.register(SensorValue, 'scheduler.phase_error', 0)
+        # pin the autopilot process to this core, -1 for any core
+        self.cpu = ap.register(RangeProperty, 'scheduler.cpu', -1, -1, 15, persistent=True)
+        self.last_cpu = -1
+        self.deadline = False
+        self.wake_time = 0 # when the sample read began after waiting
+
+    # run with SCHED_FIFO priority
+    def realtime(self, priority=1):
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+            return True
+        except Exception:
+            pass # not permitted, try with sudo
+        return not os.system('sudo chrt -pf %d %d 2>&1 > /dev/null' % (priority, os.getpid()))
+
+    def set_cpu(self):
+        cpu = int(self.cpu.value)
+        if cpu == self.last_cpu:
+            return
+        self.last_cpu = cpu
+        try:
+            if cpu < 0:
+                os.sched_setaffinity(0, range(os.cpu_count()))
+            else:
+                os.sched_setaffinity(0, [cpu])
+        except Exception as e:
+            print(_('failed to set autopilot cpu'), cpu, e)
+
+    # read the next imu sample, waiting up to 1.4 periods for it to arrive
+    def read(self, boatimu, period):
+        self.set_cpu()
+        t = self.wake_time = time.monotonic()
+        data = boatimu.read()
+        end = t + period*1.4
+        while not data:
+            dt = end - time.monotonic()
+            if dt <= 0:
+                break
+            boatimu.wait(dt) # wakes when the sample arrives
+            self.wake_time = time.monotonic()
+            data = boatimu.read()
+
+        if data:
+            self.arrived(data.get('timestamp', time.monotonic()), period)
+        elif self.deadline:
+            self.deadline += period
+        return data
+
+    # track the phase of sample arrival at time t
+    def arrived(self, t, period):
+        if not self.deadline or abs(t - self.deadline) >= period:
+            self.deadline = t + period # lost lock, restart at this sample
+            return
+        error = t - self.deadline
+        self.phase_error.set(error)
+        self.deadline += period + phase_gain*error
+
+    # sleep until shortly before the next sample is due
+    def sleep(self):
+        if not self.deadline:
+            return
+        dt = self.deadline - wake_margin - time.monotonic()
+        if dt < -wake_margin: # the next sample already arrived
+            self.missed.set(self.missed.value + 1)
+        elif dt > 0:
+            time.sleep(dt) # uses clock_nanosleep on the monotonic clock
+
+if __name__ == '__main__':
+    # compare sample to read latency with the previous fixed period sleep
+    # while an imu process writes samples at 20hz
+    import multiprocessing, random
+    from sensorbus import SensorBus
+
+    rate, count = 20, 400
+    period = 1/rate
+    bus = SensorBus()
+    def writer():
+        t = time.monotonic()
+        for i in range(2*count + 40):
+            t += period
+            time.sleep(max(t - time.monotonic(), 0))
+            bus.write({'timestamp': time.monotonic(), 'fusionQPose': [1, 0, 0, 0],
+                       'accel': [0, 0, 1], 'gyro': [0, 0, 0], 'compass': [20, 0, 40],
+                       'accel.residuals': [0, 0, 0]})
+    process = multiprocessing.Process(target=writer, daemon=True)
+    process.start()
+
+    class imu(object):
+        def read(self):
+            return bus.read()
+        def wait(self, timeout):
+            return bus.wait(timeout)
+
+    class ap(object):
+        def register(self, _type, name, *args, **kwargs):
+            return _type(*(['ap.' + name] + list(args)), **kwargs)
+
+    def report(name, latencies):
+        latencies = sorted(latencies[20:])
+        print('%-9s latency ms p50 %.2f p99 %.2f max %.2f' % (name, 1e3*latencies[len(latencies)//2],
+              1e3*latencies[int(len(latencies)*.99)], 1e3*latencies[-1]))
+
+    # previous loop, sleep the remainder of the period from the iteration start
+    latencies = []
+    for i in range(count):
+        t0 = time.monotonic()
+        data = bus.read()
+        sp = 0
+        if not data:
+            timu = t2 = t0
+            while not data:
+                dt = timu + period*1.4 - time.monotonic()
+                if dt <= 0:
+                    break
+                bus.wait(dt)
+                t2 = time.monotonic()
+                data = bus.read()
+            sp = t2 - timu
+        if data:
+            latencies.append(time.monotonic() - data['timestamp'])
+        time.sleep(random.uniform(.002, .01)) # work
+        dt = period - (time.monotonic() - t0) + sp
+        if 0 < dt < period:
+            time.sleep(dt)
+    report('sleep', latencies)
+
+    scheduler = Scheduler(ap())
+    latencies = []
+    for i in range(count):
+        data = scheduler.read(imu(), period)
+        if data:
+            latencies.append(time.monotonic() - data['timestamp'])
+        time.sleep(random.uniform(.002, .01))
+        scheduler.sleep()
+    report('deadline', latencies)
+    print('missed deadlines', scheduler.missed.value, 'phase error ms %.3f' % (1e3*scheduler.phase_error.value))
+    bus.close()
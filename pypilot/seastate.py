@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2024 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# estimate the sea state from imu motion
+#
+# samples of heading rate, roll, pitch and acceleration are averaged
+# down to about 4hz.  Overlapping windows of them are transformed
+# together, and the power spectra are averaged over several windows
+# (welch's method).  The dominant period, spectral peak and energy in
+# the wave band are published for each.
+
+import os, sys, math
+import numpy
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from values import *
+
+sample_rate = 4 # hz after averaging imu samples
+window_size = 512 # samples in each transform, 128 seconds
+window_hop = 64 # samples between transforms, 16 seconds
+averages = 8 # windows averaged in the spectra
+wave_band = 1/30, 1/2 # frequencies of waves in hz
+
+channels = ['headingrate', 'roll', 'pitch', 'accel']
+
+class SeaState(object):
+    def __init__(self, client):
+        self.client = client
+        self.values = {}
+        for name in channels:
+            def register(_type, stat, *args, **kwargs):
+                return client.register(_type(*(['seastate.' + name + '.' + stat] + list(args)), **kwargs))
+            self.values[name] = {'period': register(SensorValue, 'period', fmt='%.2f'),
+                                 'peak': register(SensorValue, 'peak'),
+                                 'energy': register(SensorValue, 'energy')}
+
+        self.window = numpy.hanning(window_size)
+        self.rate = False
+        self.reset(20)
+
+    def reset(self, rate):
+        self.rate = rate
+        self.decimate = max(int(round(rate / sample_rate)), 1)
+        fs = rate / self.decimate
+        # scale the periodogram to power spectral density
+        self.scale = 2 / (fs * numpy.sum(self.window**2))
+        frequencies = numpy.fft.rfftfreq(window_size, 1/fs)
+        self.band = numpy.flatnonzero((frequencies >= wave_band[0]) & (frequencies <= wave_band[1]))
+        self.frequencies = frequencies[self.band]
+        self.df = fs / window_size
+
+        self.samples = numpy.zeros((len(channels), window_size))
+        self.count = 0 # samples in the window
+        self.accumulated = [0]*len(channels)
+        self.accumulated_count = 0
+        self.psd = False
+        self.spectra = 0 # windows averaged
+
+    def update(self, data, rate):
+        if rate != self.rate:
+            self.reset(rate)
+
+        a = self.accumulated
+        accel = data['accel']
+        a[0] += data['headingrate']
+        a[1] += data['roll']
+        a[2] += data['pitch']
+        a[3] += math.sqrt(accel[0]**2 + accel[1]**2 + accel[2]**2) - 1
+        self.accumulated_count += 1
+        if self.accumulated_count < self.decimate:
+            return
+
+        self.samples[:, self.count] = a
+        self.samples[:, self.count] /= self.accumulated_count
+        self.accumulated = [0]*len(channels)
+        self.accumulated_count = 0
+        self.count += 1
+        if self.count == window_size:
+            self.transform()
+            self.samples[:, :-window_hop] = self.samples[:, window_hop:]
+            self.count -= window_hop
+
+    def transform(self):
+        x = self.samples - numpy.mean(self.samples, axis=1, keepdims=True)
+        spectrum = numpy.fft.rfft(x * self.window, axis=1)[:, self.band]
+        psd = (spectrum.real**2 + spectrum.imag**2) * self.scale
+
+        # running average once enough windows are in
+        self.spectra = min(self.spectra + 1, averages)
+        if self.psd is False:
+            self.psd = psd
+        else:
+            self.psd += (psd - self.psd) / self.spectra
+
+        if len(self.band) < 3:
+            return
+        for i, name in enumerate(channels):
+            p = self.psd[i]
+            k = min(max(int(numpy.argmax(p)), 1), len(p) - 2)
+            # interpolate the peak frequency between bins
+            d = p[k-1] - 2*p[k] + p[k+1]
+            shift = .5*(p[k-1] - p[k+1])/d if d < 0 else 0
+            frequency = float(self.frequencies[k] + shift*self.df)
+            values = self.values[name]
+            values['period'].set(1/frequency if frequency > 0 else 0)
+            values['peak'].set(float(p[k]))
+            values['energy'].set(float(numpy.sum(p)*self.df))
+
+if __name__ == '__main__':
+    # estimate known wave periods and measure the time per imu sample
+    import time
+    class client(object):
+        def register(self, value):
+            return value
+    seastate = SeaState(client())
+    rate = 20
+    n = rate*600
+    t = numpy.arange(n) / rate
+    motion = {'headingrate': 4*numpy.cos(2*math.pi*t/8) + numpy.random.normal(0, 1, n),
+              'roll': 10*numpy.sin(2*math.pi*t/5) + numpy.random.normal(0, 2, n),
+              'pitch': 3*numpy.sin(2*math.pi*t/11) + numpy.random.normal(0, 1, n),
+              'accel': .05*numpy.sin(2*math.pi*t/7) + numpy.random.normal(0, .01, n)}
+    samples = [{'headingrate': motion['headingrate'][i], 'roll': motion['roll'][i], 'pitch': motion['pitch'][i],
+                'accel': [0, 0, 1 + motion['accel'][i]]} for i in range(n)]
+    t0 = time.perf_counter()
+    for data in samples:
+        seastate.update(data, rate)
+    dt = time.perf_counter() - t0
+    for name, period in zip(channels, [8, 5, 11, 7]):
+        values = seastate.values[name]
+        print('%-12s period %5.2f (%d)  peak %9.4f  energy %9.4f' % (name, values['period'].value, period,
+                                                                    values['peak'].value, values['energy'].value))
+    print('%.2f us per sample' % (dt / n * 1e6))
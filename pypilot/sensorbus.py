@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2024 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# shared memory ring buffer to pass imu samples from the imu process
+# to the autopilot process without encoding or copying through a pipe
+#
+# there is a single writer.  Each slot holds a sequence number which is
+# cleared while the slot is written, readers check it is unchanged after
+# reading so a torn sample is never returned (seqlock)
+
+import os, select, time
+
+# fixed numeric slots of a sample, name and number of values
+imu_fields = [('timestamp', 1), ('fusionQPose', 4), ('accel', 3), ('gyro', 3),
+              ('compass', 3), ('accel.residuals', 3), ('compass_calibration_updated', 1)]
+
+class SensorBus(object):
+    def __init__(self, fields=imu_fields, slots=8):
+        from multiprocessing import shared_memory
+        self.fields = fields
+        self.slots = slots
+        self.sample_size = sum(map(lambda field : field[1], fields))
+        self.slot_size = self.sample_size + 1 # sequence number before sample
+        # first value is the sequence of the newest sample
+        size = 8*(1 + slots*self.slot_size)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.view = self.shm.buf.cast('d')
+        self.view[0] = 0
+        self.seq = 0 # last sequence written or read
+
+        # wake the reader when a sample is written
+        if hasattr(os, 'eventfd'):
+            self.r = self.w = os.eventfd(0, os.EFD_NONBLOCK)
+        else:
+            self.r, self.w = os.pipe()
+            os.set_blocking(self.r, False)
+            os.set_blocking(self.w, False)
+        self.poller = select.poll()
+        self.poller.register(self.r, select.POLLIN)
+
+    def close(self):
+        self.view.release()
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except Exception as e:
+            pass # already removed by other process
+
+    # called only from the writing process
+    def write(self, data):
+        self.seq += 1
+        seq = self.seq
+        v = self.view
+        base = 1 + (seq % self.slots)*self.slot_size
+        v[base] = 0 # invalidate slot while writing
+        i = base + 1
+        for name, count in self.fields:
+            value = data.get(name, 0)
+            if count == 1:
+                v[i] = value
+            else:
+                for j in range(count):
+                    v[i+j] = value[j]
+            i += count
+        v[base] = seq
+        v[0] = seq # publish
+
+        try:
+            if self.w == self.r:
+                os.eventfd_write(self.w, 1)
+            else:
+                os.write(self.w, b'\0')
+        except BlockingIOError:
+            pass # reader has not consumed previous wakeups
+
+    # return the newest sample if it was not already read, otherwise False
+    def read(self):
+        v = self.view
+        for tries in range(3):
+            seq = int(v[0])
+            if seq == self.seq:
+                return False
+            base = 1 + (seq % self.slots)*self.slot_size
+            if v[base] != seq:
+                continue # overwritten by newer sample
+            sample = v[base+1:base+1+self.sample_size].tolist()
+            if v[base] != seq:
+                continue # written while reading
+            self.seq = seq
+
+            data = {}
+            i = 0
+            for name, count in self.fields:
+                if count == 1:
+                    data[name] = sample[i]
+                else:
+                    data[name] = sample[i:i+count]
+                i += count
+            if not data['compass_calibration_updated']:
+                del data['compass_calibration_updated']
+            return data
+        return False
+
+    # block until a sample is written or timeout in seconds
+    def wait(self, timeout):
+        if not self.poller.poll(max(int(timeout*1000), 0)):
+            return False
+        try:
+            if self.w == self.r:
+                os.eventfd_read(self.r)
+            else:
+                os.read(self.r, 4096)
+        except BlockingIOError:
+            pass
+        return True
+
+if __name__ == '__main__':
+    # measure wakeup latency from writing process to reader
+    import multiprocessing
+    bus = SensorBus()
+    def writer():
+        for i in range(200):
+            time.sleep(.02)
+            bus.write({'timestamp': time.monotonic(), 'fusionQPose': [1, 0, 0, 0],
+                       'accel': [0, 0, 1], 'gyro': [0, 0, 0], 'compass': [20, 0, 40],
+                       'accel.residuals': [0, 0, 0]})
+    process = multiprocessing.Process(target=writer, daemon=True)
+    process.start()
+    latencies = []
+    while process.is_alive() or len(latencies) < 200:
+        if not bus.wait(1):
+            break
+        data = bus.read()
+        if data:
+            latencies.append(time.monotonic() - data['timestamp'])
+    latencies.sort()
+    print('samples', len(latencies), 'latency us p50 %.1f p99 %.1f max %.1f' %
+          (1e6*latencies[len(latencies)//2], 1e6*latencies[int(len(latencies)*.99)], 1e6*latencies[-1]))
+    bus.close()
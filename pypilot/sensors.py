@@ -19,7 +19,7 @@ from gps_filter import *
 import quaternion
 
 # favor lower priority sources
-source_priority = {'gpsd' : 1, 'servo': 1, 'serial' : 2, 'tcp' : 3,
+source_priority = {'gpsd' : 1, 'servo': 1, 'replay': 1, 'serial' : 2, 'tcp' : 3,
                    'signalk' : 4, 'water+wind' : 5, 'gps+wind' : 6, 'none' : 7}
 
 class Sensor(object):
@@ -194,7 +194,7 @@ class APB(Sensor):
         return True
 
 class gps(Sensor):
-    def __init__(self, client):
+    def __init__(self, client, replay=False):
         super(gps, self).__init__(client, 'gps')
         self.track = self.register(SensorValue, 'track', directional=True)
         self.speed = self.register(SensorValue, 'speed')
@@ -207,7 +207,7 @@ class gps(Sensor):
         self.alignmentCounter = self.register(Property, 'alignmentCounter', 0)
         self.last_alignmentCounter = False
         
-        self.filtered = GPSFilterProcess(client)
+        self.filtered = replay.gps_filter(client) if replay else GPSFilterProcess(client)
         self.lastpredictt = time.monotonic()
 
         self.rate.set(1.0)
@@ -363,7 +363,7 @@ class Water(Sensor):
         
 
 class Sensors(object):
-    def __init__(self, client, boatimu):
+    def __init__(self, client, boatimu, replay=False):
         from rudder import Rudder
         from nmea import Nmea
         from signalk import signalk
@@ -371,12 +371,15 @@ class Sensors(object):
         self.client = client
 
         # services that can receive sensor data
-        self.nmea = Nmea(self)
-        self.signalk = signalk(self)
-        self.gpsd = gpsd(self)
+        if replay: # sensor data is written from the recording
+            self.nmea = self.signalk = self.gpsd = replay.service
+        else:
+            self.nmea = Nmea(self)
+            self.signalk = signalk(self)
+            self.gpsd = gpsd(self)
 
         # actual sensors supported
-        self.gps = gps(client)
+        self.gps = gps(client, replay)
         self.wind = Wind(client, boatimu)
         self.truewind = TrueWind(client, boatimu)
         self.rudder = Rudder(client)
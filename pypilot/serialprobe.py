@@ -9,6 +9,7 @@ import sys, os, time
 import pyjson
 
 pypilot_dir = os.getenv('HOME') + '/.pypilot/'
+max_probes = 4 # devices probed at once by a probe pool
 
 def debug(*args):
     #print(*args)
@@ -148,6 +149,43 @@ def scan_devices():
     
     return allowed_devices
 
+# watch /dev with inotify so the device table is only scanned when
+# serial devices are added or removed
+class DeviceMonitor(object):
+    def __init__(self):
+        import inotify.adapters, inotify.constants
+        self.inotify = inotify.adapters.Inotify(block_duration_s=0)
+        self.mask = inotify.constants.IN_CREATE | inotify.constants.IN_DELETE
+        self.watched = set()
+        self.watch('/dev')
+        self.watch_serial()
+        self.pending = True # scan once at startup
+
+    def watch(self, path):
+        if path in self.watched or not os.path.isdir(path):
+            return
+        self.inotify.add_watch(path, self.mask)
+        self.watched.add(path)
+
+    # by-id and by-path are created with the first usb serial device
+    def watch_serial(self):
+        for path in ['/dev/serial', '/dev/serial/by-id', '/dev/serial/by-path']:
+            self.watch(path)
+
+    # true if serial devices may have changed since last called
+    def changed(self):
+        changed, self.pending = self.pending, False
+        for event in self.inotify.event_gen(timeout_s=0, yield_nones=False):
+            header, types, path, filename = event
+            if 'IN_IGNORED' in types: # directory was removed
+                self.inotify.remove_watch(path, superficial=True)
+                self.watched.discard(path)
+            elif path != '/dev' or filename.startswith(('tty', 'gps', 'serial')):
+                changed = True
+        if changed:
+            self.watch_serial()
+        return changed
+
 devices = {}
 gpsdevices = []
 enumstate = 'init'
@@ -158,14 +196,22 @@ def enumerate_devices():
 
     t0 = time.monotonic()
     if enumstate == 'init':
-        enumstate = {'monitor': False, 'starttime': t0, 'scantime': 0, 'retries': 0, 'pyudevwarning': False}
+        enumstate = {'inotify': False, 'monitor': False, 'starttime': t0, 'scantime': 0, 'retries': 0, 'pyudevwarning': False}
         devices = {}
         try:
             read_last_working_devices()
         except Exception as e:
             print('read_last_working_devices failed', e)
+        try:
+            enumstate['inotify'] = DeviceMonitor()
+        except Exception as e:
+            print('serialprobe ' + _('failed to monitor'), '/dev', e)
 
-    if enumstate['monitor']:
+    if enumstate['inotify']:
+        # only scan devices if they change
+        if not enumstate['inotify'].changed():
+            return False
+    elif enumstate['monitor']:
         # only scan devices if they change
         ret = enumstate['monitor'].poll(0)
         if ret:
@@ -248,6 +294,7 @@ def probe(name, bauds, timeout=5):
             device = probe['device']
             if device and not device in devices:
                 probe['device'] = False
+            probe['time'] = 0 # probe added devices now
     
     if not name in probes:
         new_probe(name)
@@ -268,22 +315,17 @@ def probe(name, bauds, timeout=5):
 
     # try the last working device every other probe
     device_list = list(devices)
-    if probe['probelast']:
+    lastworking = probe['lastworking']
+    if probe['probelast'] and lastworking and lastworking[0] in devices:
         probe['time'] = t0
         probe['probelast'] = False # next time probe new devices
-        if not probe['lastworking']:
-            debug('serialprobe no last working, abort', name)
-            return False
-        last_device, last_baud = probe['lastworking']
+        last_device, last_baud = lastworking
         bauds = [last_baud]
-        for index in range(len(device_list)):
-            device = device_list[index]
-            if device == last_device:
-                break
-        else: # last device not found
-            debug('serialprobe last not found', device_list)
-            return False
+        index = device_list.index(last_device)
     else:
+        if probe['probelast']: # last device not found, probe new devices now
+            debug('serialprobe last not found', name, device_list)
+            probe['time'] = t0
         probe['probelast'] = True # next time try last working device if this fails
 
         # find next device index to probe
@@ -352,6 +394,46 @@ def gpsddevices(devices):
         realpath = os.path.realpath(device)
         gpsdevices.append(realpath)
 
+# probe candidate devices concurrently, each probe runs in a worker
+# thread with its own timeout while devices are assigned by probe
+class ProbePool(object):
+    def __init__(self, workers=max_probes):
+        self.workers = workers
+        self.executor = False # start threads on first probe
+        self.probes = {} # device and future by probe name
+
+    # start probing for name unless it is already probing, check is
+    # called in a worker with the device and returns the opened device
+    # when it is valid, otherwise False
+    def probe(self, name, bauds, timeout, check):
+        if name in self.probes:
+            return
+        device = probe(name, bauds, timeout)
+        if not device:
+            return
+        if not self.executor:
+            from concurrent.futures import ThreadPoolExecutor
+            self.executor = ThreadPoolExecutor(self.workers)
+        self.probes[name] = device, self.executor.submit(check, device)
+
+    # return name, device and opened device for each successful probe
+    def results(self):
+        results = []
+        for name in list(self.probes):
+            device, future = self.probes[name]
+            if not future.done():
+                continue
+            del self.probes[name]
+            try:
+                opened = future.result()
+            except Exception as e:
+                print('serialprobe ' + _('failed'), name, device, e)
+                continue
+            if opened:
+                success(name, device)
+                results.append((name, device, opened))
+        return results
+
 # called to record the working serial device
 def success(name, device):
     global probes
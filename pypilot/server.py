@@ -10,12 +10,13 @@
 import select, socket, time
 import sys, os, heapq
 
-import numbers
+import numbers, itertools
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import gettext_loader
 import pyjson
-from bufferedsocket import LineBufferedNonBlockingSocket
+from bufferedsocket import LineBufferedNonBlockingSocket, encode_frame, encode_value_frame, FRAME_NAME
 from nonblockingpipe import NonBlockingPipe
+from journal import ConfigJournal
 
 DEFAULT_PORT = 23322
 from zeroconf_service import zeroconf
@@ -23,8 +24,39 @@ max_connections = 30
 configfilepath = os.getenv('HOME') + '/.pypilot/'
 configfilename = 'pypilot.conf'
 server_persistent_period = 60 # store data every 60 seconds
+server_max_sleep = 1 # maximum time to block waiting for events
 use_multiprocessing = True # run server in a separate process
 
+# epoll scales with the number of connections as only ready file
+# descriptors are returned, fall back to poll on other systems
+class ServerPoller(object):
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.scale = 1 # epoll timeout is in seconds
+        else:
+            self.poller = select.poll()
+            self.scale = 1000 # poll timeout is in milliseconds
+
+    def register(self, fd, flags):
+        self.poller.register(fd, flags)
+
+    def modify(self, fd, flags):
+        self.poller.modify(fd, flags)
+
+    def unregister(self, fd):
+        try:
+            self.poller.unregister(fd)
+        except Exception as e: # closed file descriptors are already removed from epoll
+            pass
+
+    def poll(self, timeout):
+        if self.scale == 1:
+            return self.poller.poll(timeout)
+        return self.poller.poll(int(timeout*self.scale))
+
+value_ids = itertools.count(1) # identify values in binary frames
+
 class Watch(object):
     def __init__(self, value, connection, period):
         self.value = value
@@ -44,24 +76,66 @@ class pypilotValue(object):
         self.awatches = [] # all watches
         self.pwatches = [] # periodic watches limited in period
         self.msg = msg
+        self.bmsg_src = self.bmsg = False
+        self.id = next(value_ids)
+        self.frame_src = self.frame = False
+        self.profiled = False
 
     def get_msg(self):
         return self.msg
+
+    # the message encoded once and shared by all watching connections
+    def get_bmsg(self):
+        msg = self.get_msg()
+        if msg is not self.bmsg_src:
+            self.bmsg_src = msg
+            self.bmsg = msg.encode() if msg else msg
+        return self.bmsg
+
+    # binary frame for the message, also encoded once for all connections
+    def get_frame(self):
+        msg = self.get_msg()
+        if msg is not self.frame_src:
+            self.frame_src = msg
+            self.frame = encode_value_frame(self.id, msg.rstrip().split('=', 1)[1]) if msg else msg
+        return self.frame
+
+    def write_frame(self, connection):
+        frame = self.get_frame()
+        if not frame:
+            return
+        if not self.id in connection.binary_ids: # inform connection of the name first
+            connection.binary_ids.add(self.id)
+            connection.write(encode_frame(FRAME_NAME, self.id, self.name.encode()))
+        connection.write(frame)
         
     def set(self, msg, connection):
         t0 = time.monotonic()
         if self.connection == connection:
             # received new value from owner, inform watchers
             self.msg = msg
+            recorder = self.server_values.recorder
+            if recorder:
+                try:
+                    recorder.write(self, t0)
+                except OSError as e: # disk full or removed
+                    print(_('recorder failed, recording disabled'), e)
+                    self.server_values.persistent_values['recorder'].set('recorder=false\n', False)
+            if self.profiled: # saved to the profile when switching
+                self.server_values.profile.changed.add(self.name)
 
             if self.awatches:
                 watch = self.awatches[0]
                 if watch.period == 0:
+                    bmsg = self.get_bmsg()
                     for connection in watch.connections:
                         if not connection:
                             print('connection FALSE', self.name)
                             continue
-                        connection.write(msg, True)
+                        if connection.binary:
+                            self.write_frame(connection)
+                        else:
+                            connection.write(bmsg, True)
 
                 for watch in self.pwatches:
                     if t0 >= watch.time:
@@ -108,6 +182,7 @@ class pypilotValue(object):
                 watching = True
             if self.connection:
                 self.connection.cwatches[self.name] = watching
+                self.server_values.cwatch_connections.add(self.connection)
                 if watching is False:
                     self.msg = None # server no longer tracking value
 
@@ -139,7 +214,10 @@ class pypilotValue(object):
         # unwatch by removing
         watching = self.unwatch(connection, False) # or for server values (self.connection is False)
         if not watching and self.msg and (period >= self.watching or self.connection is False):
-            connection.write(self.get_msg()) # initial retrieval
+            if connection.binary:
+                self.write_frame(connection)
+            else:
+                connection.write(self.get_bmsg()) # initial retrieval
 
         for watch in self.awatches:
             if watch.period == period: # already watching at this rate, add connection
@@ -194,7 +272,7 @@ class ServerUDP(pypilotValue):
             if socket.udp_port and (socket.udp_port == self.msg or not self.msg) and socket.address[0] == connection.address[0]:
                 #print('remove old udp')
                 socket.udp_port = False
-                socket.udp_out_buffer = ''
+                socket.udp_out_buffer = bytearray()
 
         connection.udp_port = self.msg # output streams on this port
         for c in self.server.sockets:
@@ -205,6 +283,68 @@ class ServerUDP(pypilotValue):
                 c.udp_socket.close()
                 c.udp_port = False
 
+# special server value a client can set to receive binary frames rather than text lines
+class ServerBinary(pypilotValue):
+    def __init__(self, values):
+        super(ServerBinary, self).__init__(values, 'binary')
+
+    def set(self, msg, connection):
+        if not isinstance(connection, LineBufferedNonBlockingSocket):
+            connection.write('error=binary only supported for sockets\n')
+            return
+        if connection.binary:
+            return
+        connection.write('binary=true\n') # last text line, frames follow
+        connection.binary = True
+        connection.binary_ids = set()
+
+# connection the recorder watches values with so owners keep them updated
+class RecorderConnection(object):
+    binary = False
+    def write(self, data, udp=False):
+        pass
+
+# special server value to record all value updates to disk
+class ServerRecorder(pypilotValue):
+    def __init__(self, values):
+        super(ServerRecorder, self).__init__(values, 'recorder', info = {'type': 'BooleanProperty', 'persistent': True, 'writable': True}, msg='recorder=false\n')
+        self.watch_connection = RecorderConnection()
+
+    # current values written at the start of each recording segment
+    def snapshot(self):
+        values = self.server_values
+        return [value for value in values.values.values() if value is not values and isinstance(value.get_msg(), str)]
+
+    def set(self, msg, connection):
+        try:
+            name, data = msg.rstrip().split('=', 1)
+            enabled = bool(pyjson.loads(data))
+        except Exception as e:
+            print('pypilot server invalid recorder', msg, e)
+            return
+
+        values = self.server_values
+        if enabled and not values.recorder:
+            try:
+                import recorder
+                values.recorder = recorder.Recorder(configfilepath + 'recordings/', self.snapshot)
+                for name in recorder.replay_values:
+                    if not name in values.values:
+                        # not yet registered, add it so we can watch it
+                        values.values[name] = pypilotValue(values, name)
+                    values.values[name].watch(self.watch_connection, True)
+            except Exception as e:
+                print(_('failed to start recorder'), e)
+                enabled = False
+        elif not enabled and values.recorder:
+            values.remove(self.watch_connection)
+            try:
+                values.recorder.close()
+            except Exception as e:
+                print(_('failed to close recorder'), e)
+            values.recorder = False
+        super(ServerRecorder, self).set('recorder=' + pyjson.dumps(enabled) + '\n', False) # inform any clients watching this value
+
 class ServerProfiles(pypilotValue):
     def __init__(self, values):
         super(ServerProfiles, self).__init__(values, 'profiles', info = {'type': 'Value', 'persistent': True, 'writable': True})
@@ -252,12 +392,30 @@ class ServerProfile(pypilotValue):
         super(ServerProfile, self).__init__(values, 'profile', info = {'type': 'Value', 'persistent': True, 'writable': True})
         self.profile = 'default'
         self.msg = 'new'
+        # profiles are kept as the lines differing from a base line for
+        # each value, so switching only visits values that may differ
+        self.base = {}
+        self.diffs = {}
+        self.changed = set() # profiled values updated since the last switch
+        self.complete = set() # profiles with every registered profiled value
 
     def get_msg(self):
         if not self.msg or self.msg == 'new':
             self.msg = 'profile=' + pyjson.dumps(str(self.profile)) + '\n'
         return self.msg
 
+    def update_diff(self, profile, name, line):
+        if not profile in self.diffs:
+            self.diffs[profile] = {}
+        diff = self.diffs[profile]
+        if not name in self.base:
+            self.base[name] = line
+        if line == self.base[name]:
+            if name in diff:
+                del diff[name]
+        else:
+            diff[name] = line
+
     def set(self, msg, connection):
         n, profile = msg.rstrip().split('=', 1)
         if profile == self.profile: # no change, do nothing
@@ -270,37 +428,66 @@ class ServerProfile(pypilotValue):
             print('server bad profile', e, msg)
             return
 
+        if strprofile == self.profile:
+            return
         if strprofile != profile:
             msg = n + '="' + strprofile + '"\n'
 
         self.server_values.values['profiles'].add(strprofile)
 
-        persistent_values = self.server_values.persistent_values
-        persistent_data = self.server_values.persistent_data
-
+        server_values = self.server_values
+        values = server_values.values
+        persistent_data = server_values.persistent_data
         if not self.profile in persistent_data:
             persistent_data[self.profile] = {}
         prev = persistent_data[self.profile]
+
+        # store values changed in the previous profile
+        for name in self.changed:
+            value = values[name]
+            if value.msg and prev.get(name) != value.msg: # the msg may still be invalidated from a previous set
+                server_values.store_line(self.profile, name, value.msg)
+        self.changed = set()
+
         if not strprofile in persistent_data:
             persistent_data[strprofile] = {}
         data = persistent_data[strprofile]
-        for name, value in persistent_values.items():
-            if not value.info.get('profiled'):
-                continue
-            #print("set profile", name, value, value.msg, prev[name])
-            if value.msg:  # the msg may still be invalidated from a previous set
-                if not name in prev or prev[name] != value.msg:
-                    prev[name] = value.msg
-                self.server_values.need_store = True # ensure we store c
-
-            if not name in data:
-                vmsg = value.get_msg()  # add this value to profile copying it from previous profile
-                if vmsg:
-                    data[name] = vmsg
-                else:
+
+        # values registered since the profiles were complete are
+        # missing from them, add them copying the current value
+        if not self.profile in self.complete or not strprofile in self.complete:
+            complete = True
+            for name, value in server_values.persistent_values.items():
+                if not value.profiled or (name in prev and name in data):
+                    continue
+                vmsg = value.get_msg()
+                if not vmsg:
                     print("PROFILED DATA WITHOUT MSG?  is not tracked?", name)
-            elif data[name] != value.msg:
-                value.set(data[name], False)  # only inform clients of the updated value from profile change if it really did change
+                    complete = False
+                    continue
+                if not name in prev:
+                    server_values.store_line(self.profile, name, vmsg)
+                if not name in data:
+                    server_values.store_line(strprofile, name, vmsg)
+            if complete:
+                self.complete.update([self.profile, strprofile])
+
+        # only inform owners of values that really did change, with
+        # the stored lines for each owner sent in a single write
+        names = set(self.diffs.get(self.profile, ())) | set(self.diffs.get(strprofile, ()))
+        writes = {}
+        for name in names:
+            value = values.get(name)
+            if not value or not name in data or data[name] == value.msg:
+                continue
+            if value.connection:
+                writes[value.connection] = writes.get(value.connection, '') + data[name]
+                value.msg = None # until the owner sets it
+            else:
+                value.set(data[name], False)
+        for c, lines in writes.items():
+            c.write(lines)
+
         self.msg = 'new' # invalidate
         self.profile = strprofile
         super(ServerProfile, self).set(msg, False) # inform any clients watching this value
@@ -310,14 +497,18 @@ class ServerValues(pypilotValue):
         super(ServerValues, self).__init__(self, 'values')
         profile = ServerProfile(self)
         profiles = ServerProfiles(self)
-        
-        self.persistent_values = {'profile': profile, 'profiles': profiles}
-        self.values = {'values': self, 'watch': ServerWatch(self), 'udp_port': ServerUDP(self, server)}
+        self.recorder = False
+        self.profile = profile
+        self.journal_lines = [] # stored lines not yet journaled
+
+        self.persistent_values = {'profile': profile, 'profiles': profiles, 'recorder': ServerRecorder(self)}
+        self.values = {'values': self, 'watch': ServerWatch(self), 'udp_port': ServerUDP(self, server), 'binary': ServerBinary(self)}
         self.values.update(self.persistent_values)
         self.pipevalues = {}
         self.msg = 'new'
         self.persistent_timeout = time.monotonic() + server_persistent_period
         self.need_store = False
+        self.cwatch_connections = set() # connections with changed watches
         self.load()
         self.pqwatches = [] # priority queue of watches
         self.last_send_watches = 0
@@ -352,10 +543,13 @@ class ServerValues(pypilotValue):
             t, i, watch = heapq.heappop(self.pqwatches) # pop first element
             if not watch.connections:
                 continue # forget this watch
-            msg = watch.value.get_msg()
+            msg = watch.value.get_bmsg()
             if msg:
                 for connection in watch.connections:
-                    connection.write(msg, True)
+                    if connection.binary:
+                        watch.value.write_frame(connection)
+                    else:
+                        connection.write(msg, True)
 
             watch.time += watch.period
             if watch.time < t0:
@@ -404,6 +598,8 @@ class ServerValues(pypilotValue):
                     self.persistent_values[name] = value
 
             if info.get('profiled'):
+                value.profiled = True
+                self.profile.complete = set()
                 if name in self.persistent_data[None]:
                     del self.persistent_data[None][name]
 
@@ -431,6 +627,7 @@ class ServerValues(pypilotValue):
     def load_file(self, filename):
         profile = None
         self.persistent_data = {None : {}, 'default' : {}}
+        self.profile.base, self.profile.diffs, self.profile.complete = {}, {}, set()
         print("load file",filename)
         f = open(filename)
         linei=0
@@ -458,22 +655,45 @@ class ServerValues(pypilotValue):
                     self.persistent_data[profile] = {}
                 continue
 
-            self.persistent_data[profile][name] = line
-            if name in self.values:
-                # loading file while running
-                value = self.values[name]
-                if name != value.name:
-                    print("ERROR with values!", name, value.name)
-                if value.msg != line:
-                    if profile is None or self.values['profile'].profile == profile:
-                        self.values[name].set(line, False)
-            else:   
-                self.values[name] = pypilotValue(self, name, msg=line)
-                self.persistent_values[name] = self.values[name]
+            self.load_line(profile, name, line)
 
         f.close()
         
+    # keep line of persistent value in profile, None if not profiled
+    def store_line(self, profile, name, line, journal=True):
+        if not profile in self.persistent_data:
+            self.persistent_data[profile] = {}
+        self.persistent_data[profile][name] = line
+        if profile is not None:
+            self.profile.update_diff(profile, name, line)
+        if journal:
+            self.journal_lines.append((profile, line))
+
+    def load_line(self, profile, name, line):
+        self.store_line(profile, name, line, False)
+        if name in self.values:
+            # loading file while running
+            value = self.values[name]
+            if name != value.name:
+                print("ERROR with values!", name, value.name)
+            if value.msg != line:
+                if profile is None or self.values['profile'].profile == profile:
+                    self.values[name].set(line, False)
+        else:
+            self.values[name] = pypilotValue(self, name, msg=line)
+            self.persistent_values[name] = self.values[name]
+
+    # apply values changed since the config file was written
+    def load_journal(self):
+        for profile, line in self.journal.read():
+            try:
+                name, data = line.split('=', 1)
+            except Exception as e:
+                continue
+            self.load_line(profile, name, line)
+
     def load(self):
+        self.journal = ConfigJournal(configfilepath + configfilename)
         try:
             import inotify.adapters
             self.inotify = inotify.adapters.Inotify(block_duration_s=0)
@@ -490,6 +710,7 @@ class ServerValues(pypilotValue):
                 raise Exception(configfilepath + 'should be a directory')
 
             self.load_file(configfilepath + configfilename)
+            self.load_journal()
         except Exception as e:
             print(_('failed to load'), configfilename, e)
             # log failing to load persistent data
@@ -500,19 +721,34 @@ class ServerValues(pypilotValue):
 
             try:
                 self.load_file(configfilepath + configfilename + '.bak')
+                # the journal follows the config file, not the backup
+                self.journal.compact(self.config_text())
                 return
             except Exception as e:
                 print(_('backup data failed as well'), e)
+            # values may only be in the journal, the config file is written on the next store
+            self.load_journal()
+            self.need_store = True
             return
 
         # backup persistent_data if it loaded with success
         self.store_file(configfilepath + configfilename + '.bak')
+        if self.journal.size: # fold the journal into the config file
+            self.journal.compact(self.config_text())
 
     def poll_config(self, t0):
         if not self.inotify or t0 - self.inotify_time < 5:
             return
         
         self.inotify_time = t0
+        if self.journal.compacted: # watch the replaced config file
+            self.journal.compacted = False
+            try:
+                self.inotify.remove_watch(configfilepath + configfilename)
+            except Exception as e:
+                pass # already removed with the old file
+            self.inotify.add_watch(configfilepath + configfilename)
+
         loaded = False
         for event in self.inotify.event_gen(timeout_s=0):
             try:
@@ -520,12 +756,27 @@ class ServerValues(pypilotValue):
                     if not loaded:
                         print('detected configuration file updated: reloading', configfilename)
                         self.load_file(configfilepath + configfilename)
+                        self.need_store = True # the journal is replaced by the edited file
                         loaded = True
             except Exception as e:
                 print('pypilot server failed to detect or load config change', e)
                 #print('pypilot server will now overwrite config file')
                 #self.store_file(configfilepath + configfilename)
 
+    def config_text(self):
+        text = ''
+        for name, value in self.persistent_data[None].items():
+            text += value
+        for profile, data in self.persistent_data.items():
+            if profile is None:
+                continue
+            profile.replace('"', '')
+            text += '[profile="' + profile + '"]\n'
+            for name, value in data.items():
+                if value:
+                    text += value
+        return text
+
     def store_file(self, filename):
         if self.inotify:
             try:
@@ -535,23 +786,18 @@ class ServerValues(pypilotValue):
                 
         print('store_file', filename, '%.3f'%time.monotonic(), self.need_store)
         file = open(filename, 'w')
-        for name, value in self.persistent_data[None].items():
-            file.write(value)
-        for profile, data in self.persistent_data.items():
-            if profile is None:
-                continue
-            profile.replace('"', '')
-            file.write('[profile="' + profile + '"]\n')
-            for name, value in data.items():
-                if value:
-                    file.write(value)
+        file.write(self.config_text())
         file.close()
 
         if self.inotify:
             self.inotify.add_watch(configfilepath + configfilename)
 
+    # changed values are appended to the journal, which is compacted into
+    # the config file when it grows, after a while without changes, or
+    # after the config file was edited
     def store(self):
-        self.persistent_timeout = time.monotonic() + server_persistent_period
+        t0 = time.monotonic()
+        self.persistent_timeout = t0 + server_persistent_period
         for name in self.persistent_values:
             value = self.persistent_values[name]
             if not value.info.get('persistent'):
@@ -567,15 +813,14 @@ class ServerValues(pypilotValue):
             msg = value.get_msg()
             if msg and (not name in data or msg != data[name]):
                 #print("need store, changed", name, data[name].rstrip(), msg.rstrip())
-                data[name] = msg
-                self.need_store = name
+                self.store_line(profile, name, msg)
 
-        if self.need_store:
-            try:
-                self.store_file(configfilepath + configfilename)
-                self.need_store = False
-            except Exception as e:
-                print(_('failed to write'), configfilename, e)
+        if self.journal_lines:
+            self.journal.append(self.journal_lines)
+            self.journal_lines = []
+        if self.need_store or self.journal.need_compact(t0):
+            self.journal.compact(self.config_text())
+            self.need_store = False
 
 class pypilotServer(object):
     def __init__(self):
@@ -598,15 +843,7 @@ class pypilotServer(object):
         # if server is in a separate process
         self.init()
         while True:
-            dt = self.values.sleep_time()
-            t0 = time.monotonic()
-            self.poll(dt)
-            pt = time.monotonic() - t0
-            #print('server times', pt, dt)
-            st = .04 - pt
-            if st > 0:
-                #time.sleep(st)
-                pass
+            self.poll() # blocks until events or the next watch is due
 
     def init_process(self):
         if self.multiprocessing:
@@ -623,6 +860,7 @@ class pypilotServer(object):
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.port = DEFAULT_PORT
         self.sockets = []
+        self.pending = set() # sockets with output to flush
         self.fd_to_pipe = {}
         self.values = ServerValues(self)
 
@@ -638,10 +876,16 @@ class pypilotServer(object):
         self.server_socket.listen(5)
         fd = self.server_socket.fileno()
         self.fd_to_connection = {fd: self.server_socket}
-        self.poller = select.poll()
+        self.poller = ServerPoller()
         self.poller.register(fd, select.POLLIN)
 
-        # setup direct pipe clients
+        self.init_pipes()
+        self.zeroconf = zeroconf()
+        self.zeroconf.daemon = True # do not hold up exit of an in process server
+        self.zeroconf.start()
+
+    # setup direct pipe clients
+    def init_pipes(self):
         print('server setup has', len(self.pipes), 'pipes')
         for pipe in self.pipes:
             if self.multiprocessing:
@@ -650,14 +894,17 @@ class pypilotServer(object):
                 self.fd_to_connection[fd] = pipe
                 self.fd_to_pipe[fd] = pipe
             pipe.cwatches = {'values': True} # server always watches client values
+            pipe.binary = False
+            self.values.cwatch_connections.add(pipe)
         self.initialized = True
-        self.zeroconf = zeroconf()
-        self.zeroconf.start()
             
     def __del__(self):
         if not self.initialized:
             return
         self.values.store()
+        self.values.journal.close()
+        if self.values.recorder:
+            self.values.recorder.close()
         self.server_socket.close()
         for socket in self.sockets:
             socket.close()
@@ -665,8 +912,12 @@ class pypilotServer(object):
             pipe.close()
 
     def RemoveSocket(self, socket):
+        if not socket in self.sockets:
+            return # already removed
         print('server remove socket', socket.address)
         self.sockets.remove(socket)
+        self.pending.discard(socket)
+        self.values.cwatch_connections.discard(socket)
 
         found = False
         for fd in self.fd_to_connection:
@@ -682,7 +933,30 @@ class pypilotServer(object):
         socket.close()
         self.values.remove(socket)
 
-    def poll(self, timeout=0):
+    def flush_socket(self, socket):
+        if socket.socket and socket.flush():
+            if socket.wait_pollout: # all sent, no longer need to know if writable
+                socket.wait_pollout = False
+                self.poller.modify(socket.fileno(), select.POLLIN)
+        elif not socket.socket:
+            print(_('server socket closed from flush!!'))
+            self.RemoveSocket(socket)
+        elif not socket.wait_pollout: # flush again once the socket is writable
+            socket.wait_pollout = True
+            self.poller.modify(socket.fileno(), select.POLLIN | select.POLLOUT)
+
+    def timeout(self, t0):
+        if not self.multiprocessing:
+            return 0 # never block the autopilot process
+
+        # wake exactly when the next periodic watch is due
+        timeout = self.values.sleep_time()
+        max_timeout = min(self.values.persistent_timeout - t0, server_max_sleep)
+        if timeout is None or timeout > max_timeout:
+            timeout = max_timeout
+        return max(timeout, 0)
+
+    def poll(self):
         # server is in subprocess
         if self.process != 'server process':
             if not self.process:
@@ -699,22 +973,16 @@ class pypilotServer(object):
 
         # if config file is edited externally
         self.values.poll_config(t0)
-        if not timeout:
-            timeout = 400
-        else:
-            timeout *= 1000 # milliseconds
-
-        # sleep between 50 and 400 milliseconds
-        timeout = max(min(int(timeout), 400), 50)
 
-        #timeout = 10
-        events = self.poller.poll(timeout)
+        events = self.poller.poll(self.timeout(t0))
 
         while events:
             event = events.pop()
             fd, flag = event
-                                    
-            connection = self.fd_to_connection[fd]
+
+            connection = self.fd_to_connection.get(fd)
+            if not connection:
+                continue # removed while handling earlier events
             if connection == self.server_socket:
                 connection, address = connection.accept()
                 if len(self.sockets) == max_connections:
@@ -726,6 +994,7 @@ class pypilotServer(object):
                 self.sockets.append(socket)
                 fd = socket.fileno()
                 socket.cwatches = {} # {'values': True} # server always watches client values
+                socket.pending = self.pending
 
                 self.fd_to_connection[fd] = socket
                 self.poller.register(fd, select.POLLIN)
@@ -735,6 +1004,10 @@ class pypilotServer(object):
                     exit(0)
                 self.RemoveSocket(connection)
             elif flag & select.POLLIN:
+                if flag & select.POLLOUT:
+                    self.flush_socket(connection)
+                    if not connection.socket:
+                        continue
                 if fd in self.fd_to_pipe:
                     if not connection.recvdata():
                         continue
@@ -760,6 +1033,8 @@ class pypilotServer(object):
                             print('invalid request from connection', e, line)
                         except Exception as e2:
                             print('invalid request has malformed string', e, e2)
+            elif flag & select.POLLOUT:
+                self.flush_socket(connection)
 
         if not self.multiprocessing:
             # these pipes are not pollable as they are implemented as a simple buffer
@@ -774,27 +1049,181 @@ class pypilotServer(object):
         self.values.send_watches()
 
         # send watches
-        for connection in self.sockets + self.pipes:
+        cwatch_connections = self.values.cwatch_connections
+        while cwatch_connections:
+            connection = cwatch_connections.pop()
             if connection.cwatches:
                 connection.write('watch=' + pyjson.dumps(connection.cwatches) + '\n')
                 connection.cwatches = {}
 
-        # flush all sockets
-        for socket in self.sockets:
-            socket.flush()
-        while True:
-            for socket in self.sockets:
-                if not socket.socket:
-                    print(_('server socket closed from flush!!'))
-                    self.RemoveSocket(socket)
-                    break
-            else:
-                break
-                
+        # flush only sockets with new output, sockets which could not send
+        # everything are flushed when the poller reports they are writable
+        while self.pending:
+            socket = self.pending.pop()
+            if not socket.wait_pollout or not socket.socket:
+                self.flush_socket(socket)
+
         for pipe in self.pipes:
             pipe.flush()
 
+def context_switches(pid):
+    # voluntary context switches count how many times a process slept and woke
+    try:
+        f = open('/proc/%d/status' % pid)
+        for line in f:
+            if line.startswith('voluntary_ctxt_switches'):
+                return int(line.split()[1])
+    except Exception as e:
+        print('failed to read context switches', e)
+    return 0
+
+# measure server wakeups per second and latency from a value update
+# until it is received by each watching tcp client
+def benchmark(counts=[1, 5, 10, 20, 29], rate=20, duration=5):
+    server = pypilotServer()
+    from client import pypilotClient
+    from values import Value
+    producer = pypilotClient(server)
+    clock = producer.register(Value('benchmark.clock', 0))
+    server.poll() # start server process
+    producer.poll(1)
+
+    clients = []
+    poller = select.poll()
+    buffers = {}
+    print('clients  wakeups/s  p50 ms  p99 ms  max ms')
+    for count in counts:
+        while len(clients) < count:
+            c = socket.create_connection(('localhost', DEFAULT_PORT))
+            c.setblocking(0)
+            c.send(b'watch={"benchmark.clock": true}\n')
+            clients.append(c)
+            buffers[c.fileno()] = b''
+            poller.register(c, select.POLLIN)
+
+        latencies = []
+        t0 = time.monotonic()
+        next_set = t0
+        ctx0 = context_switches(server.process.pid)
+        while time.monotonic() - t0 < duration:
+            t = time.monotonic()
+            if t >= next_set:
+                clock.set(t)
+                producer.poll()
+                next_set += 1/rate
+            for fd, flag in poller.poll(max(int(1000*(next_set - t)), 0)):
+                tr = time.monotonic()
+                data = buffers[fd] + os.read(fd, 65536)
+                lines = data.split(b'\n')
+                buffers[fd] = lines[-1]
+                for line in lines[:-1]:
+                    if line.startswith(b'benchmark.clock='):
+                        tv = float(line[16:])
+                        if tv > t0:
+                            latencies.append(tr - tv)
+        wakeups = (context_switches(server.process.pid) - ctx0) / duration
+        latencies.sort()
+        if not latencies:
+            print('%7d  no data received' % count)
+            continue
+        def percentile(p):
+            return 1000*latencies[min(int(p*len(latencies)), len(latencies)-1)]
+        print('%7d  %9.1f  %6.2f  %6.2f  %6.2f' % (count, wakeups, percentile(.5), percentile(.99), 1000*latencies[-1]))
+
+    for c in clients:
+        c.close()
+    server.process.terminate()
+
+# switch between two profiles differing in a few values with watchers
+# of every profiled value, for increasing numbers of profiled values
+def benchmark_profiles(counts=[100, 1000, 4000], watchers=30, differ=5, switches=100):
+    global configfilepath
+    import shutil
+    from client import pypilotClient
+    from values import Property
+    configfilepath = '/tmp/pypilot_profile_benchmark/'
+
+    def run(count):
+        shutil.rmtree(configfilepath, ignore_errors=True)
+        server = pypilotServer()
+        server.multiprocessing = False
+        owner = pypilotClient(server)
+        gains = [owner.register(Property('benchmark.gain%d' % i, 1, persistent=True, profiled=True)) for i in range(count)]
+        server.poll()
+        sockets = []
+        for i in range(watchers):
+            c = socket.create_connection(('localhost', DEFAULT_PORT))
+            c.setblocking(0)
+            sockets.append(c)
+            server.poll() # accept
+
+        def poll(received=False):
+            owner.poll()
+            server.poll()
+            for c in sockets:
+                try:
+                    data = c.recv(1<<20)
+                    if received:
+                        received[c] += data
+                except BlockingIOError:
+                    pass
+
+        def pump(duration):
+            t0 = time.monotonic()
+            while time.monotonic() - t0 < duration:
+                poll()
+
+        def set_profile(profile):
+            server.values.values['profile'].set('profile="' + profile + '"\n', False)
+
+        for i in range(0, count, 100): # lines are limited in length
+            watches = 'watch=' + pyjson.dumps(dict((gain.name, True) for gain in gains[i:i+100])) + '\n'
+            for c in sockets:
+                c.send(watches.encode())
+        pump(.5)
+
+        # profiles a and b differ in the first values
+        for profile, value in [('a', 2), ('b', 3)]:
+            set_profile(profile)
+            for gain in gains[:differ]:
+                gain.set(value)
+            pump(.2)
+
+        times, latencies = [], []
+        for i in range(switches):
+            t0 = time.monotonic()
+            set_profile('a' if i%2 == 0 else 'b')
+            times.append(time.monotonic() - t0)
+            # wait until every watcher has the changed values from the owner
+            received = dict((c, b'') for c in sockets)
+            while time.monotonic() - t0 < 5:
+                poll(received)
+                if all(data.count(b'benchmark.gain') >= differ for data in received.values()):
+                    break
+            latencies.append(time.monotonic() - t0)
+        if [gain.value for gain in gains[:differ]] != [3]*differ:
+            print('profile values not restored', [gain.value for gain in gains[:differ]])
+        print('%6d  %6d  %9.1f  %23.2f' % (count, differ, 1e6*sum(times)/switches, 1000*sum(latencies)/switches))
+
+        for c in sockets:
+            c.close()
+        server.server_socket.close()
+        server.values.journal.close()
+        server.initialized = False # closed, the next run removes its files
+
+    print('values  differ  switch us  all watchers updated ms')
+    for count in counts:
+        run(count)
+    shutil.rmtree(configfilepath, ignore_errors=True)
+
 if __name__  == '__main__':
+    if '-b' in sys.argv:
+        benchmark()
+        exit(0)
+    if '-p' in sys.argv:
+        benchmark_profiles()
+        exit(0)
+
     server = pypilotServer()
     from client import pypilotClient
     from values import *
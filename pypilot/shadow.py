@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2024 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# evaluate the pilots that are not steering
+#
+# after the servo is commanded, the other pilots process the same
+# heading error and sensor values as the active pilot did, but through
+# a stand in autopilot which records their servo commands instead of
+# moving the servo.  Each would be command is compared to what the
+# active pilot commanded, and the processor time of each pilot is kept
+# in a histogram.  Pilots are skipped when they would not finish before
+# the next imu sample is due.
+
+import os, sys, time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from values import *
+
+error_lowpass = .01 # weight of each sample in the running statistics
+budget_margin = .005 # seconds to leave before the next sample is due
+
+class ShadowCommand(object):
+    def __init__(self):
+        self.value = False
+
+    def command(self, value):
+        self.value = value
+
+    def set(self, value):
+        self.value = value
+
+class ShadowServo(object):
+    def __init__(self):
+        self.command = ShadowCommand()
+        self.position_command = ShadowCommand()
+
+class ShadowPilotSelection(object):
+    def __init__(self, name):
+        self.value = name
+
+    def set(self, value):
+        pass # shadow pilots cannot change the active pilot
+
+class ShadowEnabled(object):
+    value = True
+
+# autopilot as seen by a shadow pilot
+class ShadowAutopilot(object):
+    def __init__(self, ap, name):
+        self.ap = ap
+        self.servo = ShadowServo()
+        self.enabled = ShadowEnabled()
+        self.pilot = ShadowPilotSelection(name)
+
+    def __getattr__(self, name):
+        return getattr(self.ap, name)
+
+class ShadowPilot(object):
+    def __init__(self, ap, pilot):
+        self.pilot = pilot
+        self.shadow_ap = ShadowAutopilot(ap, pilot.name)
+        def register(_type, name, *args, **kwargs):
+            return ap.register(_type, 'shadow.' + pilot.name + '.' + name, *args, **kwargs)
+        self.command = register(SensorValue, 'command')
+        self.error = register(SensorValue, 'error') # mean command difference
+        self.rms_error = register(SensorValue, 'rms_error')
+        self.cost = register(HistogramValue, 'cost', hdr_buckets(.00001, .1))
+        self.skipped = register(ResettableValue, 'skipped', 0, fmt='%.0f')
+        self.expected_cost = 0
+        self.mean_square = 0
+        self.failed = False
+        self.compared = 0 # commands compared to the active pilot
+
+    def process(self, active):
+        servo = self.shadow_ap.servo
+        servo.command.value = servo.position_command.value = False
+        self.pilot.ap = self.shadow_ap
+        t0 = time.thread_time()
+        try:
+            self.pilot.process()
+        finally:
+            self.pilot.ap = self.shadow_ap.ap
+        cost = time.thread_time() - t0
+        self.cost.add(cost)
+        self.expected_cost = max(cost, .9*self.expected_cost)
+
+        # only commands of the same kind as the active pilot are compared
+        kind, active_command = active
+        for k in ['command', 'position_command']:
+            command = getattr(servo, k).value
+            if command is not False:
+                self.command.set(command)
+                break
+        if k != kind or command is False:
+            return
+        error = command - active_command
+        lp = error_lowpass
+        self.error.set((1-lp)*self.error.value + lp*error)
+        self.mean_square = (1-lp)*self.mean_square + lp*error**2
+        self.rms_error.set(self.mean_square**.5)
+        self.compared += 1
+
+class Shadow(object):
+    def __init__(self, ap):
+        self.ap = ap
+        self.enabled = ap.register(BooleanProperty, 'shadow.enabled', False, persistent=True)
+        self.pilots = {}
+        for name, pilot in ap.pilots.items():
+            self.pilots[name] = ShadowPilot(ap, pilot)
+        self.next = 0 # rotate which pilot goes first
+
+    def process(self, deadline):
+        ap = self.ap
+        if not self.enabled.value or not ap.enabled.value:
+            return
+
+        # the active pilot's command this iteration
+        servo = ap.servo
+        if servo.position_command.time > servo.command.time:
+            active = 'position_command', servo.position_command.value
+        else:
+            active = 'command', servo.command.value
+
+        names = [name for name in ap.pilots if name != ap.pilot.value]
+        if not names:
+            return
+        self.next = (self.next + 1) % len(names)
+        for name in names[self.next:] + names[:self.next]:
+            shadow = self.pilots[name]
+            if time.monotonic() + shadow.expected_cost > deadline - budget_margin:
+                shadow.skipped.set(shadow.skipped.value + 1)
+                continue
+            try:
+                shadow.process(active)
+            except Exception as e:
+                if not shadow.failed:
+                    print(_('shadow pilot failed'), name, e)
+                shadow.failed = True
+                shadow.skipped.set(shadow.skipped.value + 1)
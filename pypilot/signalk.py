@@ -11,7 +11,7 @@ import time, socket, multiprocessing, os
 from nonblockingpipe import NonBlockingPipe
 import pyjson
 from client import pypilotClient
-from values import Property, RangeProperty
+from values import Property, RangeProperty, HistogramValue, hdr_buckets
 from sensors import source_priority
 
 signalk_priority = source_priority['signalk']
@@ -35,6 +35,26 @@ signalk_table = {'wind': {('environment.wind.speedApparent', meters_s): 'speed',
                  'water': {('navigation.speedThroughWater', meters_s): 'speed',
                            ('navigation.leewayAngle', radians): 'leeway'}}
 
+# route each signalk path directly to its sensor, pypilot path and conversion
+signalk_routes = {}
+signalk_required = {} # paths needed before a sensor input is complete
+for sensor, sensor_table in signalk_table.items():
+    signalk_required[sensor] = []
+    for (signalk_path, signalk_conversion), pypilot_path in sensor_table.items():
+        signalk_routes[signalk_path] = sensor, pypilot_path, signalk_conversion
+        if signalk_conversion != 1: # don't require fields with conversion of 1
+            signalk_required[sensor].append(signalk_path)
+
+# parse timestamps like 2020-10-18T12:34:56.789Z as local time,
+# consecutive timestamps share the hour so it is cached
+iso8601_hour = [False, 0]
+def parse_iso8601(ts):
+    hour = ts[:13]
+    if hour != iso8601_hour[0]:
+        t = int(ts[0:4]), int(ts[5:7]), int(ts[8:10]), int(ts[11:13]), 0, 0, 0, 0, -1
+        iso8601_hour[:] = hour, time.mktime(t)
+    return iso8601_hour[1] + int(ts[14:16])*60 + float(ts[17:].rstrip('Z'))
+
 token_path = os.getenv('HOME') + '/.pypilot/signalk-token'
 
 def debug(*args):
@@ -168,6 +188,8 @@ class signalk(object):
         self.period = self.client.register(RangeProperty('signalk.period', .5, .1, 2, persistent=True))
         self.last_period = False
         self.uid = self.client.register(Property('signalk.uid', 'pypilot', persistent=True))
+        # processing time of each poll, only sampled while watched
+        self.poll_time = self.client.register(HistogramValue('signalk.poll_time', hdr_buckets(.0001, 1)))
 
         self.signalk_host_port = False
         self.signalk_ws_url = False
@@ -281,7 +303,8 @@ class signalk(object):
         for sensor in list(signalk_table):
             self.subscribed[sensor] = False
         self.subscriptions = [] # track signalk subscriptions
-        self.signalk_values = {}
+        self.signalk_values = {} # sensor -> source -> path -> value
+        self.signalk_ready = {} # sensor -> sources with all required paths
         self.keep_token = False
         try:
             self.ws = create_connection(self.signalk_ws_url, header={'Authorization': 'JWT ' + self.token})
@@ -421,45 +444,46 @@ class signalk(object):
             self.keep_token = True # do not throw away token if we got valid data
 
         t5 = time.monotonic()
-        # convert received signalk values into sensor inputs if possible
-        for sensor, sensor_table in signalk_table.items():
-            for source, values in self.signalk_values.items():
-                data = {}
-                for signalk_path_conversion, pypilot_path in sensor_table.items():
-                    signalk_path, signalk_conversion = signalk_path_conversion
-                    if signalk_path in values:
-                        try:
-                            if not 'timestamp'in data and signalk_path in self.signalk_last_msg_time:
-                                ts = time.strptime(self.signalk_last_msg_time[signalk_path], '%Y-%m-%dT%H:%M:%S.%fZ')
-                                data['timestamp'] = time.mktime(ts)
-
-                            value = values[signalk_path]
-                            if type(pypilot_path) == dict: # single path translates to multiple pypilot
-                                for signalk_key, pypilot_key in pypilot_path.items():
-                                    if not value[signalk_key] is None:
-                                        data[pypilot_key] = value[signalk_key] / signalk_conversion
-                            elif not value is None:
-                                data[pypilot_path] = value
-                                if signalk_conversion != 1:
-                                    data[pypilot_path] /= signalk_conversion
-                        except Exception as e:
-                            print(_('Exception converting signalk->pypilot'), e, self.signalk_values)
-                            break
-                    elif signalk_conversion != 1: # don't require fields with conversion of 1
-                        break  # missing fields?  skip input this iteration
-                else:
-                    for signalk_path_conversion in sensor_table:
-                        signalk_path, signalk_conversion = signalk_path_conversion
-                        if signalk_path in values:
-                            del values[signalk_path]
-                    # all needed sensor data is found 
-                    data['device'] = source + 'signalk'
-                    if self.sensors_pipe:
-                        self.sensors_pipe.send([sensor, data])
-                    else:
-                        debug('signalk ' + _('received'), sensor, data)
-                    break
+        # convert complete signalk inputs into sensor inputs,
+        # one source per sensor each poll
+        for sensor in list(self.signalk_ready):
+            ready = self.signalk_ready[sensor]
+            source = ready.pop(0)
+            if not ready:
+                del self.signalk_ready[sensor]
+            values = self.signalk_values[sensor].pop(source)
+            try:
+                data = self.convert_signalk(values)
+            except Exception as e:
+                print(_('Exception converting signalk->pypilot'), e, values)
+                continue
+            data['device'] = source + 'signalk'
+            if self.sensors_pipe:
+                self.sensors_pipe.send([sensor, data])
+            else:
+                debug('signalk ' + _('received'), sensor, data)
         #print('sigktimes', t1-t0, t2-t1, t3-t2, t4-t3, t5-t4)
+        if self.poll_time.watch:
+            t6 = time.monotonic()
+            self.poll_time.add(t6-t1, t6) # without waiting in client poll
+
+    def convert_signalk(self, values):
+        data = {}
+        for signalk_path, value in values.items():
+            sensor, pypilot_path, signalk_conversion = signalk_routes[signalk_path]
+            timestamp = self.signalk_last_msg_time.get(signalk_path)
+            if not 'timestamp' in data and timestamp: # not sent in all updates
+                data['timestamp'] = parse_iso8601(timestamp)
+
+            if type(pypilot_path) == dict: # single path translates to multiple pypilot
+                for signalk_key, pypilot_key in pypilot_path.items():
+                    if not value[signalk_key] is None:
+                        data[pypilot_key] = value[signalk_key] / signalk_conversion
+            elif not value is None:
+                data[pypilot_path] = value
+                if signalk_conversion != 1:
+                    data[pypilot_path] /= signalk_conversion
+        return data
 
     def send_signalk(self):
         # see if we can produce any signalk output from the data we have read
@@ -549,10 +573,7 @@ class signalk(object):
                     elif 'label' in update['source']:
                         source = update['source']['label']                            
 
-                if 'timestamp' in update:
-                    timestamp = update['timestamp']
-                if not source in self.signalk_values:
-                    self.signalk_values[source] = {}
+                timestamp = update.get('timestamp')
                 if 'values' in update:
                     values = update['values']
                 elif 'meta' in update:
@@ -563,15 +584,31 @@ class signalk(object):
 
                 for value in values:
                     path = value['path']
-                    if path in self.signalk_last_msg_time:
+                    if timestamp is None: # cannot detect duplicates without a timestamp
+                        self.store_signalk(source, path, value['value'])
+                    elif path in self.signalk_last_msg_time:
                         if self.signalk_last_msg_time[path] == timestamp:
                             debug('signalk skip duplicate timestamp', source, path, timestamp)
                             continue
-                        self.signalk_values[source][path] = value['value']
+                        self.store_signalk(source, path, value['value'])
                     else:
                         debug('signalk skip initial message', source, path, timestamp)
                     self.signalk_last_msg_time[path] = timestamp
                     
+    def store_signalk(self, source, path, value):
+        route = signalk_routes.get(path)
+        if not route:
+            return # not a path we translate
+        sensor = route[0]
+        values = self.signalk_values.setdefault(sensor, {}).setdefault(source, {})
+        values[path] = value
+        for required in signalk_required[sensor]:
+            if not required in values:
+                return
+        ready = self.signalk_ready.setdefault(sensor, [])
+        if not source in ready:
+            ready.append(source)
+
     def update_sensor_source(self, sensor, source):
         priority = source_priority[source]
         watch = priority < signalk_priority # translate from pypilot -> signalk
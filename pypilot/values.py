@@ -7,7 +7,7 @@
 # License as published by the Free Software Foundation; either
 # version 3 of the License, or (at your option) any later version.  
 
-import os, time, math
+import os, time, math, bisect, array
 import pyjson
 from resolv import resolv
 
@@ -109,6 +109,62 @@ class SensorValue(Value):
             value = list(value)
         return round_value(value, self.fmt)
 
+# bucket upper bounds increasing by powers of two from lowest to highest,
+# each split into linear subbuckets like hdr histograms, so the relative
+# error is the same at any magnitude
+def hdr_buckets(lowest, highest, subbuckets=4):
+    buckets, bound = [], lowest
+    while bound < highest:
+        step = bound / subbuckets
+        for i in range(subbuckets):
+            buckets.append(float('%.4g' % (bound + step*(i+1))))
+        bound *= 2
+    return buckets
+
+# counts samples in fixed buckets, given by their upper bounds, without
+# allocating per sample, the counts are published at most once per period
+class HistogramValue(JSONValue):
+    def __init__(self, name, buckets, period=5, **kwargs):
+        self.buckets = buckets
+        self.counts = array.array('L', [0]*(len(buckets) + 1)) # last bucket counts larger samples
+        self.max = 0
+        self.period = period
+        self.time = time.monotonic()
+        super(HistogramValue, self).__init__(name, self.histogram(), **kwargs)
+        self.info['type'] = 'HistogramValue'
+
+    # upper bound of the bucket holding fraction p of the samples
+    def percentile(self, p):
+        total = sum(self.counts)
+        if not total:
+            return 0
+        count = 0
+        for i, c in enumerate(self.counts):
+            count += c
+            if count >= p*total:
+                break
+        return self.buckets[i] if i < len(self.buckets) else self.max
+
+    def histogram(self):
+        return {'buckets': self.buckets, 'counts': list(self.counts), 'max': self.max,
+                'p50': self.percentile(.5), 'p99': self.percentile(.99)}
+
+    # t is the current monotonic time if already known
+    def add(self, sample, t=None):
+        self.counts[bisect.bisect_left(self.buckets, sample)] += 1
+        if sample > self.max:
+            self.max = sample
+        if t is None:
+            t = time.monotonic()
+        if t - self.time > self.period:
+            self.time = t
+            self.set(self.histogram())
+
+    def reset(self):
+        self.counts = array.array('L', [0]*(len(self.buckets) + 1))
+        self.max = 0
+        self.set(self.histogram())
+
 class HeadingOffset(object):
     def __init__(self):
         self.value = 0
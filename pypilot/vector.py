@@ -12,13 +12,13 @@ def lmap(*cargs):
     return list(map(*cargs))
 
 def norm(v):
-    return math.sqrt(v[0]**2 + v[1]**2 + v[2]**2)
+    return math.sqrt(v[0]*v[0] + v[1]*v[1] + v[2]*v[2])
 
 def normalize(v):
     n = norm(v)
     if n == 0:
         return v
-    return lmap(lambda x : x / n, v)
+    return [x / n for x in v]
 
 def cross(a, b):
     return [a[1]*b[2] - a[2]*b[1],
@@ -29,13 +29,13 @@ def dot(a, b):
     return a[0]*b[0] + a[1]*b[1] + a[2]*b[2]
 
 def sub(a, b):
-    return lmap(lambda x, y : x - y, a, b)
+    return [x - y for x, y in zip(a, b)]
 
 def add(a, b):
-    return lmap(lambda x, y : x + y, a, b)
+    return [x + y for x, y in zip(a, b)]
 
 def scale(a, m):
-    return lmap(lambda x : x*m, a)
+    return [x*m for x in a]
 
 def project(a, b):
     return scale(b, dot(a, b)/dot(b, b))
@@ -44,4 +44,30 @@ def dist(a, b):
     return norm(sub(a, b))
 
 def dist2(a, b):
-    return (a[0] - b[0])**2 + (a[1] - b[1])**2 + (a[2] - b[2])**2
+    d0, d1, d2 = a[0] - b[0], a[1] - b[1], a[2] - b[2]
+    return d0*d0 + d1*d1 + d2*d2
+
+# batch versions for numpy arrays of vectors with shape (N, 3)
+def norm_array(v):
+    import numpy as np
+    v = np.asarray(v, dtype=float)
+    return np.sqrt(np.sum(v*v, axis=-1))
+
+def normalize_array(v):
+    import numpy as np
+    v = np.asarray(v, dtype=float)
+    n = norm_array(v)[..., None]
+    return np.divide(v, n, out=v.copy(), where=n != 0)
+
+def cross_array(a, b):
+    import numpy as np
+    return np.cross(np.asarray(a, dtype=float), np.asarray(b, dtype=float))
+
+def dot_array(a, b):
+    import numpy as np
+    return np.sum(np.asarray(a, dtype=float)*np.asarray(b, dtype=float), axis=-1)
+
+def dist2_array(a, b):
+    import numpy as np
+    d = np.asarray(a, dtype=float) - np.asarray(b, dtype=float)
+    return np.sum(d*d, axis=-1)
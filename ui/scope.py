@@ -17,6 +17,8 @@ import sys
 
 from pypilot.client import pypilotClientFromArgs
 
+trace_history = 1 << 16 # points kept by each trace
+
 class trace(object):
     colors = [[1, 0, 0], [0, 1, 0], [1, 1, 0],
               [1, 0, 1], [0, 1, 1], [0, 0, 1],
@@ -24,7 +26,21 @@ class trace(object):
               [.5, .5, .5], [0, .5, .5], [.5, 0, 1]]
 
     def __init__(self, name, group, colorindex, directional):
-        self.points = []
+        # ring of points, each is written twice so the newest points
+        # are always contiguous in the arrays
+        self.size = trace_history
+        self.times = numpy.zeros(2*self.size)
+        self.values = numpy.zeros(2*self.size)
+        self.count = 0 # points added
+        self.last = False # newest time and value
+
+        # running sums of the points on screen relative to ref
+        self.window = 0 # index of the oldest point on screen
+        self.disptime = False
+        self.ref = 0
+        self.n = self.sum = self.sum2 = 0
+        self.updates = 0
+
         self.offset = 0
         self.visible = True
         self.timeoff = False
@@ -33,67 +49,136 @@ class trace(object):
         self.color = self.colors[colorindex%len(self.colors)]
         self.directional = directional
 
+    # points from index first to the newest
+    def history(self, first):
+        first = max(first, self.count - self.size, 0)
+        end = (self.count - 1) % self.size + self.size + 1
+        n = self.count - first
+        return self.times[end-n:end], self.values[end-n:end]
+
+    def newest(self):
+        return self.last
+
+    def append(self, t, value):
+        if self.count - self.window >= self.size:
+            self.remove(self.window + 1) # oldest point on screen is overwritten
+        p = self.count % self.size
+        self.times[p] = self.times[p + self.size] = t
+        self.values[p] = self.values[p + self.size] = value
+        self.count += 1
+        self.last = t, value
+
+        if not math.isnan(value):
+            if not self.n:
+                self.ref = value
+            d = value - self.ref
+            self.n += 1
+            self.sum += d
+            self.sum2 += d*d
+
+    # remove points before index window from the running sums
+    def remove(self, window):
+        times, values = self.history(self.window)
+        values = values[:window - self.window]
+        values = values[~numpy.isnan(values)] - self.ref
+        self.n -= len(values)
+        self.sum -= numpy.sum(values)
+        self.sum2 -= numpy.dot(values, values)
+        self.window = window
+        self.updates += len(values)
+
+    # advance the window to the points on screen at time t
+    def update_window(self, t, disptime):
+        times, values = self.history(self.window)
+        if disptime != self.disptime or self.updates > self.size:
+            # compute sums again to avoid accumulating rounding error
+            self.disptime = disptime
+            times, values = self.history(self.count - self.size)
+            self.window = self.count - len(times) + numpy.searchsorted(times, t - disptime)
+            times, values = self.history(self.window)
+            values = values[~numpy.isnan(values)]
+            self.ref = values[-1] if len(values) else 0
+            values = values - self.ref
+            self.n = len(values)
+            self.sum = numpy.sum(values)
+            self.sum2 = numpy.dot(values, values)
+            self.updates = 0
+        elif len(times) and times[0] < t - disptime:
+            self.remove(self.window + numpy.searchsorted(times, t - disptime))
+
     def add(self, t, data, mindt):
         # update previous timestamps based on downtime
-        if self.points and math.isnan(self.points[0][1]):
+        if self.count and math.isnan(self.newest()[1]):
             dt = time.monotonic() - t - self.timeoff
             self.timeoff = False
-            for i in range(len(self.points)):
-                point = self.points[i]
-                self.points[i] = point[0]-dt, point[1]
+            self.times -= dt
+            self.last = self.last[0] - dt, self.last[1]
 
-                
         if not self.timeoff or self.timeoff < time.monotonic() - t or self.timeoff > time.monotonic() - t + 1:
             self.timeoff = time.monotonic() - t
             
-        elif self.points and t-self.points[0][0]<mindt:
+        elif self.count and t-self.newest()[0]<mindt:
             return False
 
-        self.points.insert(0, (t, data))
+        self.append(t, data)
         return True
         
     def add_blank(self):
-        if self.points:
-            self.points.insert(0, (self.points[0][0], float('nan')))
+        if self.count:
+            self.append(self.newest()[0], float('nan'))
 
     def center(self):
-        if len(self.points) > 0:
-            self.offset = self.points[0][1]
+        if self.count:
+            self.offset = self.newest()[1]
 
     def noise(self):
-        try:
-            avg = sum(map(lambda x : x[1], self.points)) / len(self.points)
-            return math.sqrt(sum(map(lambda x : (avg-x[1])**2, self.points))) / len(self.points)
-        except:
+        if not self.n:
             return 0
+        avg = self.sum / self.n
+        variance = max(self.sum2 / self.n - avg*avg, 0)
+        return math.sqrt(variance * self.n) / self.n
+
+    # vertexes of the points on screen at time, with the minimum and
+    # maximum in each pixel if there are more points than pixels
+    def vertexes(self, time, plot):
+        # include the newest point off the screen
+        times, values = self.history(self.window - 1)
+        x = times - time
+        y = values - self.offset
+        if self.directional:
+            y = (y + 180) % 360 - 180
+
+        width = plot.width
+        if len(x) > 2*width:
+            columns = ((x + plot.disptime) * (width / plot.disptime)).astype(int)
+            starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(columns)) + 1))
+            lo = numpy.minimum.reduceat(y, starts) # nan if the pixel has a blank
+            hi = numpy.maximum.reduceat(y, starts)
+            x = numpy.repeat(x[starts], 2)
+            y = numpy.column_stack((lo, hi)).ravel()
+        return numpy.column_stack((x, y))
 
     def tracevertexes(self, time, plot, gldrawtype):
-        # remove datapoints after the first one that is off the screen
-        for i in range(len(self.points)):
-            if self.points[i][0] < time - plot.disptime:
-                self.points = self.points[:i+1]
-                break
-
-        glBegin(gldrawtype)
-        for point in self.points:
-            if math.isnan(point[1]):
-                glEnd()
-                glBegin(gldrawtype)
-            else:
-                y = point[1] - self.offset
-                if self.directional:
-                    if y >= 180:
-                        y -= 360
-                    elif y < - 180:
-                        y += 360
-                glVertex2d(point[0]-time, y)
-        glEnd()
+        vertexes = self.vertexes(time, plot)
+        if not len(vertexes):
+            return
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glVertexPointer(2, GL_DOUBLE, 0, vertexes)
+        start = 0 # separate strips at blanks
+        for end in list(numpy.flatnonzero(numpy.isnan(vertexes[:,1]))) + [len(vertexes)]:
+            if end > start:
+                glDrawArrays(gldrawtype, start, end - start)
+            start = end + 1
+        glDisableClientState(GL_VERTEX_ARRAY)
 
     def draw(self, plot):
-        if not self.visible or not self.timeoff:
+        if not self.timeoff:
             return
 
         t = time.monotonic() - self.timeoff
+        self.update_window(t, plot.disptime)
+        if not self.visible:
+            return
         
         glPushMatrix()
 
@@ -106,33 +191,34 @@ class trace(object):
 
         glPopMatrix()
 
-    def draw_fft(self):
-        if len(self.points) < 1:
+    # spectrum of the points on screen up to the nyquist frequency,
+    # labeled with the period in seconds
+    def draw_fft(self, plot):
+        times, values = self.history(self.window)
+        if len(values) < 4 or times[-1] <= times[0]:
+            return
+        dt = (times[-1] - times[0]) / (len(times) - 1)
+        values = values[~numpy.isnan(values)]
+        if len(values) < 4:
             return
-        pts = map(lambda p: p[1] - self.offset, self.points)
-
-        out = numpy.fft.rfft(pts)
-        c = len(out)
-
-        norm = 0
-        for i in range(c/2):
-            norm += numpy.real(out[i])**2 + numpy.imag(out[i])**2
 
-        norm = math.sqrt(norm)
+        out = numpy.abs(numpy.fft.rfft((values - numpy.mean(values)) * numpy.hanning(len(values))))
+        norm = math.sqrt(numpy.dot(out, out))
         if norm <= 0:
             return
 
+        nyquist = .5/dt
         for i in range(1, pypilotPlot.NUM_X_DIV):
             x = float(i) / pypilotPlot.NUM_X_DIV
-            self.rasterpos([x, .95])
-            period = 3/math.exp(x) # incorrect!!
-            pypilotPlot.drawputs(str(period))
+            plot.rasterpos([x, .95])
+            pypilotPlot.drawputs('%.3gs' % (1/(x*nyquist)))
 
+        vertexes = numpy.column_stack((numpy.linspace(0, 1, len(out)), out / norm))
         glPushMatrix()
-        glBegin(GL_LINE_STRIP)
-        for i in range(c/2):
-            glVertex2d(float(i) * 2 / (c-2), abs(out[i]) / norm)
-        glEnd()
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glVertexPointer(2, GL_DOUBLE, 0, vertexes)
+        glDrawArrays(GL_LINE_STRIP, 0, len(vertexes))
+        glDisableClientState(GL_VERTEX_ARRAY)
         glPopMatrix()
 
 
@@ -270,8 +356,8 @@ class pypilotPlot():
         self.synccolor()
 
         val = float('nan')
-        if len(self.curtrace.points):
-            val = self.curtrace.points[0][1]
+        if self.curtrace.count:
+            val = self.curtrace.newest()[1]
 
         pypilotPlot.drawputs("name: %s offset: %g  value: %g  visible: %s  " % \
                  (self.curtrace.name, self.curtrace.offset, val, 'T' if self.curtrace.visible else 'F'))
@@ -300,7 +386,7 @@ class pypilotPlot():
 
         self.drawticks()
         if self.fft_on:
-            self.curtrace.draw_fft()
+            self.curtrace.draw_fft(self)
 
         glPushMatrix()
 
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+#
+#   Copyright (C) 2024 Sean D'Epagnier
+#
+# This Program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# share a single pypilot connection between all browser sessions
+#
+# watches from each session are reference counted and merged, so each
+# value is watched once at the fastest period any session asked for,
+# and is unwatched when no session needs it.  Sessions with the same
+# watches share a socket.io room so each update is emitted once per room.
+
+import time
+from collections import deque
+
+from pypilot.client import pypilotClient
+from pypilot import pyjson
+
+poll_period = .02 # seconds between processing upstream data
+reconnect_period = 1 # seconds between connection attempts
+
+# sessions with identical watches
+class WatchRoom(object):
+    def __init__(self, name, watches):
+        self.name = name
+        self.watches = watches
+        self.sids = set()
+        self.pending = {} # values waiting for their period
+        self.sent = {} # time each value was last emitted
+
+    # values due to be emitted at time t
+    def take(self, msgs, t):
+        for name in msgs:
+            if name in self.watches:
+                self.pending[name] = msgs[name]
+        msgs = {}
+        for name in list(self.pending):
+            period = self.watches[name]
+            if period is True or t - self.sent.get(name, 0) >= period:
+                msgs[name] = self.pending.pop(name)
+                self.sent[name] = t
+        return msgs
+
+class UpstreamClient(object):
+    # emit(event, data, room), enter_room(sid, room) and leave_room(sid, room)
+    # are provided by the socket.io namespace
+    def __init__(self, emit, enter_room, leave_room, host=False):
+        self.client = pypilotClient(host)
+        self.emit = emit
+        self.enter_room = enter_room
+        self.leave_room = leave_room
+
+        self.sessions = {} # watches of each session
+        self.session_rooms = {}
+        self.rooms = {}
+        self.watchers = {} # periods each value is watched at by session
+        self.last = {} # last received value of each watched value
+        self.values_list = False
+        self.connected = False
+        self.connect_time = 0
+
+        # socket.io handlers may run in other threads, so requests
+        # are queued and applied only from poll
+        self.requests = deque()
+
+    def connect(self, sid):
+        self.requests.append((sid, False))
+
+    def disconnect(self, sid):
+        self.requests.append((sid, None))
+
+    def message(self, sid, msg):
+        self.requests.append((sid, msg))
+
+    def poll(self):
+        while self.requests:
+            sid, msg = self.requests.popleft()
+            if msg is False:
+                self.add_session(sid)
+            elif msg is None:
+                self.remove_session(sid)
+            elif sid in self.sessions:
+                self.handle(sid, msg)
+
+        t = time.monotonic()
+        if not self.client.connection:
+            if self.connected:
+                self.connected = False
+                self.emit('pypilot_disconnect', None, None)
+            if t - self.connect_time < reconnect_period:
+                return
+            self.connect_time = t
+
+        msgs = self.client.receive()
+        values = self.client.list_values()
+        if self.client.connection:
+            self.connected = True
+        if values:
+            self.values_list = values
+            self.emit('pypilot_values', pyjson.dumps(values), None)
+
+        self.last.update(msgs)
+        for room in self.rooms.values():
+            if msgs or room.pending:
+                room_msgs = room.take(msgs, t)
+                if room_msgs:
+                    self.emit('pypilot', pyjson.dumps(room_msgs), room.name)
+
+    def add_session(self, sid):
+        self.sessions[sid] = {}
+        self.session_rooms[sid] = False
+        if self.values_list:
+            self.emit('pypilot_values', pyjson.dumps(self.values_list), sid)
+        if not self.connected:
+            self.emit('pypilot_disconnect', None, sid)
+
+    def remove_session(self, sid):
+        if not sid in self.sessions:
+            return
+        self.watch(sid, dict.fromkeys(self.sessions[sid], False))
+        del self.sessions[sid]
+        del self.session_rooms[sid]
+
+    def handle(self, sid, msg):
+        try:
+            name, data = msg.split('=', 1)
+            if name == 'watch':
+                self.watch(sid, pyjson.loads(data))
+            else:
+                self.client.send(msg + '\n') # set value
+        except Exception as e:
+            print('invalid message from web client', msg, e)
+
+    def watch(self, sid, watches):
+        session = self.sessions[sid]
+        new = {}
+        for name, period in watches.items():
+            if period is False:
+                if not name in session:
+                    continue
+                del session[name]
+                del self.watchers[name][sid]
+            else:
+                if not period or period is True:
+                    period = True
+                if session.get(name) == period:
+                    continue
+                if not name in session and name in self.last:
+                    new[name] = self.last[name]
+                session[name] = period
+                self.watchers.setdefault(name, {})[sid] = period
+            self.update_watch(name)
+
+        self.update_room(sid)
+        if new: # send values already received to the new watcher
+            self.emit('pypilot', pyjson.dumps(new), sid)
+
+    # watch upstream at the fastest period of any session
+    def update_watch(self, name):
+        watchers = self.watchers.get(name)
+        if not watchers:
+            self.watchers.pop(name, None)
+            self.last.pop(name, None)
+            self.client.watch(name, False)
+            return
+
+        period = min(0 if p is True else p for p in watchers.values())
+        self.client.watch(name, period if period else True)
+
+    def update_room(self, sid):
+        watches = self.sessions[sid]
+        name = 'watch=' + pyjson.dumps(sorted(watches.items())) if watches else False
+        old = self.session_rooms[sid]
+        if old == name:
+            return
+        if old:
+            room = self.rooms[old]
+            room.sids.remove(sid)
+            self.leave_room(sid, old)
+            if not room.sids:
+                del self.rooms[old]
+        if name:
+            if not name in self.rooms:
+                self.rooms[name] = WatchRoom(name, dict(watches))
+            self.rooms[name].sids.add(sid)
+            self.enter_room(sid, name)
+        self.session_rooms[sid] = name
+
+# load test: 50 simulated browser sessions against a local server,
+# compared with a connection per session polled every 250ms as before
+# (only as many sessions as the server accepts connections)
+def load_test(count=50, rate=10, duration=5):
+    from pypilot.server import pypilotServer, max_connections
+    from pypilot.values import Value
+
+    server = pypilotServer()
+    producer = pypilotClient(server)
+    heading = producer.register(Value('ap.heading', 0))
+    others = [producer.register(Value(name, 0)) for name in ['ap.heading_command', 'imu.pitch', 'imu.roll']]
+    server.poll() # start server process
+    producer.poll(1)
+
+    class socketio(object): # stands in for socket.io rooms
+        def __init__(self):
+            self.rooms = {}
+            self.latencies = []
+            self.emits = self.deliveries = 0
+
+        def enter_room(self, sid, room):
+            self.rooms.setdefault(room, set()).add(sid)
+
+        def leave_room(self, sid, room):
+            self.rooms[room].discard(sid)
+
+        def emit(self, event, data, room):
+            self.emits += 1
+            sids = self.rooms.get(room, [room]) if room else sids_all
+            self.deliveries += len(sids)
+            if event == 'pypilot':
+                t = time.monotonic()
+                msgs = pyjson.loads(data)
+                if 'ap.heading' in msgs:
+                    self.latencies += [t - msgs['ap.heading']]*len(sids)
+
+    # watches sent by the control page, some sessions also plot imu values
+    def session_watches(i):
+        watches = {'ap.heading': True, 'ap.heading_command': .5}
+        if i % 2:
+            watches['imu.pitch'] = 1
+            watches['imu.roll'] = 1
+        return watches
+
+    def run(step):
+        t0 = time.monotonic()
+        next_set = t0
+        while time.monotonic() - t0 < duration:
+            t = time.monotonic()
+            if t >= next_set:
+                heading.set(t)
+                for v in others:
+                    v.set(t)
+                next_set += 1/rate
+            producer.poll()
+            server.poll()
+            step()
+            time.sleep(poll_period)
+
+    def report(name, latencies, emits, deliveries, connections):
+        latencies = sorted(latencies[len(latencies)//10:]) # skip startup
+        def percentile(p):
+            return 1000*latencies[min(int(p*len(latencies)), len(latencies)-1)]
+        print('%-9s %11d %6.1f %6.1f %8.1f %11.1f' % (name, connections, percentile(.5), percentile(.99),
+                                                      emits/duration, deliveries/duration))
+
+    print('%d sessions, ap.heading at %dHz' % (count, rate))
+    print('mode      connections p50 ms p99 ms  emits/s deliveries/s')
+
+    # shared upstream connection
+    sio = socketio()
+    sids_all = ['sid%d' % i for i in range(count)]
+    upstream = UpstreamClient(sio.emit, sio.enter_room, sio.leave_room, 'localhost')
+    for i, sid in enumerate(sids_all):
+        upstream.connect(sid)
+        upstream.message(sid, 'watch=' + pyjson.dumps(session_watches(i)))
+    run(upstream.poll)
+    report('shared', sio.latencies, sio.emits, sio.deliveries, 1)
+
+    # unwatching from every session stops the value upstream
+    for sid in sids_all:
+        upstream.message(sid, 'watch={"imu.pitch": false}')
+    upstream.poll()
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < .5:
+        others[1].set(time.monotonic())
+        producer.poll()
+        server.poll()
+        upstream.poll()
+        time.sleep(poll_period)
+    upstream.client.received = []
+    for i in range(10):
+        others[1].set(time.monotonic())
+        producer.poll()
+        server.poll()
+        upstream.client.poll(poll_period)
+    stopped = 'stopped' if not any(name == 'imu.pitch' for name, value in upstream.client.received) else 'still received'
+    print('imu.pitch after all sessions unwatched:', stopped)
+    for sid in sids_all:
+        upstream.disconnect(sid)
+    upstream.poll()
+    upstream.client.disconnect()
+
+    # a client per session, limited by the server connection limit
+    latencies, emits = [], [0]
+    clients = []
+    for i in range(min(count, max_connections - 1)):
+        client = pypilotClient('localhost')
+        for name, period in session_watches(i).items():
+            client.watch(name, period)
+        clients.append(client)
+    state = {'last': 0}
+    def step():
+        t = time.monotonic()
+        if t - state['last'] < .25:
+            return
+        state['last'] = t
+        for client in clients:
+            msgs = client.receive()
+            if msgs:
+                emits[0] += 1
+                if 'ap.heading' in msgs:
+                    latencies.append(time.monotonic() - msgs['ap.heading'])
+    run(step)
+    report('per-client', latencies, emits[0], emits[0], len(clients))
+    for client in clients:
+        client.disconnect()
+    server.process.terminate()
+
+if __name__ == '__main__':
+    load_test()
@@ -15,12 +15,13 @@ from flask_socketio import SocketIO, Namespace, emit, join_room, leave_room, \
 from engineio.payload import Payload
 Payload.max_decode_packets = 500
 
-from pypilot.client import pypilotClient
 from pypilot import pyjson
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 import tinypilot
+import upstream
+from upstream import UpstreamClient
 
 config = {'port': 8000, 'language': 'default'}
 configfilename = os.getenv('HOME')+'/.pypilot/web.conf'
@@ -203,50 +204,31 @@ def index():
 class pypilotWeb(Namespace):
     def __init__(self, name):
         super(Namespace, self).__init__(name)
+        # all browser sessions share one connection to pypilot
+        self.upstream = UpstreamClient(self.emit, self.enter_room, self.leave_room)
         socketio.start_background_task(target=self.background_thread)
-        self.clients = {}
 
     def background_thread(self):
         print('processing clients')
-        x = 0
         while True:
-            socketio.sleep(.25)
+            socketio.sleep(upstream.poll_period)
             sys.stdout.flush() # update log
-            sids = list(self.clients)
-            for sid in sids:
-                if not sid in self.clients:
-                    print('client was removed')
-                    continue # was removed
-
-                client = self.clients[sid]
-                values = client.list_values()
-                if values:
-                    socketio.emit('pypilot_values', pyjson.dumps(values), room=sid)
-                if not client.connection:
-                    socketio.emit('pypilot_disconnect', room=sid)
-                msgs = client.receive()
-                if msgs:
-                    # convert back to json (format is nicer)
-                    #print('msgs', msgs, sid)
-                    socketio.emit('pypilot', pyjson.dumps(msgs), room=sid)
+            self.upstream.poll()
 
     def on_pypilot(self, message):
         #print('message', message)
-        self.clients[request.sid].send(message + '\n')
+        self.upstream.message(request.sid, message)
 
     def on_ping(self):
         emit('pong')
 
     def on_connect(self):
         print('Client connected', request.sid)
-        client = pypilotClient()
-        self.clients[request.sid] = client
+        self.upstream.connect(request.sid)
 
     def on_disconnect(self):
         print('Client disconnected', request.sid)
-        client = self.clients[request.sid]
-        client.disconnect()
-        del self.clients[request.sid]
+        self.upstream.disconnect(request.sid)
 
     def on_language(self, language):
         config['language'] = language